@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+
+"""
+A high resolution clock for timing input events and the song position.
+
+The clock is in milliseconds and keeps running at a steady pace even if
+the system time is adjusted. The starting point is arbitrary, so only
+differences between two readings are meaningful.
+"""
+
+import os
+import time
+import pygame
+
+if os.name == "nt":
+    # time.clock() reads the high resolution performance counter on Windows
+    _clock = time.clock
+else:
+    _clock = time.time
+
+# SDL ticks in milliseconds
+_getTicks = pygame.time.get_ticks
+
+# How far the high resolution clock may drift from the SDL ticks between
+# two readings before it is considered to have been adjusted, in milliseconds
+MAX_DRIFT  = 2.0
+
+_lastTime  = 0.0
+_lastClock = _clock() * 1000.0
+_lastTicks = _getTicks()
+
+def getTime():
+    """
+    Read the clock.
+
+    The time advances by the elapsed time of the high resolution clock,
+    which may be the system time. The SDL ticks are monotonic but only
+    have a millisecond resolution, so they are used instead whenever the
+    two disagree, i.e. when the system time has been changed.
+
+    @return: Current time in milliseconds
+    """
+    global _lastTime, _lastClock, _lastTicks
+    now   = _clock() * 1000.0
+    ticks = _getTicks()
+    delta = now - _lastClock
+
+    # The ticks stay at zero until pygame has been initialized
+    if ticks and abs(delta - (ticks - _lastTicks)) > MAX_DRIFT:
+        delta = ticks - _lastTicks
+
+    _lastTime  += max(0.0, delta)
+    _lastClock  = now
+    _lastTicks  = ticks
+    return _lastTime
@@ -20,7 +20,7 @@
 # MA  02110-1301, USA.                                              #
 #####################################################################
 
-from Font import Font
+from Font import Font, GlyphAtlasCache, parseCharacterSet
 from Texture import Texture
 from Img import ImgDrawing
 from Texture import Texture
@@ -44,21 +44,22 @@ class Data(object):
         self.resource = resource
         self.img      = img
 
-        # load font customization images
-        self.loadImgDrawing(self, "star1",   "star1.png", textureSize = (128, 128))
-        self.loadImgDrawing(self, "star2",   "star2.png", textureSize = (128, 128))
-        self.loadImgDrawing(self, "left",    "left.png",  textureSize = (128, 128))
-        self.loadImgDrawing(self, "right",   "right.png", textureSize = (128, 128))
-        self.loadImgDrawing(self, "ball1",   "ball1.png", textureSize = (128, 128))
-        self.loadImgDrawing(self, "ball2",   "ball2.png", textureSize = (128, 128))
+        # load font customization images, the fonts need their sizes right away
+        self.loadImgDrawing(self, "star1",   "star1.png", textureSize = (128, 128), synch = True)
+        self.loadImgDrawing(self, "star2",   "star2.png", textureSize = (128, 128), synch = True)
+        self.loadImgDrawing(self, "left",    "left.png",  textureSize = (128, 128), synch = True)
+        self.loadImgDrawing(self, "right",   "right.png", textureSize = (128, 128), synch = True)
+        self.loadImgDrawing(self, "ball1",   "ball1.png", textureSize = (128, 128), synch = True)
+        self.loadImgDrawing(self, "ball2",   "ball2.png", textureSize = (128, 128), synch = True)
 
         # load misc images
-        self.loadImgDrawing(self, "loadingImage", "loading.png", textureSize = (256, 256))
+        self.loadImgDrawing(self, "loadingImage", "loading.png", textureSize = (256, 256), synch = True)
 
         # load all the data in parallel
         asciiOnly = not bool(Language.language)
         reversed  = _("__lefttoright__") == "__righttoleft__" and True or False
         scale     = Config.get("video", "fontscale")
+        sdf       = Config.get("video", "sdffonts")
         fontSize  = [22, 108]
 
         if asciiOnly:
@@ -69,10 +70,20 @@ class Data(object):
             bigFont = resource.fileName("international.ttf")
 
         # load fonts
-        font1     = lambda: Font(font,    fontSize[0], scale = scale, reversed = reversed, systemFont = not asciiOnly)
-        font2     = lambda: Font(bigFont, fontSize[1], scale = scale, reversed = reversed, systemFont = not asciiOnly)
-        resource.load(self, "font",         font1, onLoad = self.customizeFont)
-        resource.load(self, "bigFont",      font2, onLoad = self.customizeFont)
+        cache     = GlyphAtlasCache()
+        font1     = lambda: Font(font,    fontSize[0], scale = scale, reversed = reversed, systemFont = not asciiOnly, atlasCache = cache, sdf = sdf)
+        font2     = lambda: Font(bigFont, fontSize[1], scale = scale, reversed = reversed, systemFont = not asciiOnly, atlasCache = cache, sdf = sdf)
+        if sdf and font == bigFont:
+            # both sizes are drawn from the same distance field glyphs
+            def customizeFonts(font):
+                self.customizeFont(font)
+                self.bigFont = font.derive(fontSize[1])
+                self.customizeFont(self.bigFont)
+            self.bigFont = None
+            resource.load(self, "font",     font1, onLoad = customizeFonts)
+        else:
+            resource.load(self, "font",     font1, onLoad = self.customizeFont)
+            resource.load(self, "bigFont",  font2, onLoad = self.customizeFont)
 
         # load sounds
         resource.load(self, "screwUpSounds", self.loadScrewUpSounds)
@@ -91,19 +102,22 @@ class Data(object):
     def loadScrewUpSounds(self):
         return [Sound(self.resource.fileName("fiba%d.ogg" % i)) for i in range(1, 7)]
 
-    def loadImgDrawing(self, target, name, fileName, textureSize = None):
+    def loadImgDrawing(self, target, name, fileName, textureSize = None, synch = False):
         """
-        Load an image drawing synchronously.
+        Load an image drawing. The drawing is created right away, but unless
+        synch is set its image is decoded in the background and the drawing
+        stays transparent until the texture has been uploaded.
 
         @param target:      An object that will own the drawing
         @param name:        The name of the attribute the drawing will be assigned to
         @param fileName:    The name of the file in the data directory
         @param textureSize  Either None or (x, y), in which case the file will
                             be rendered to an x by y texture
+        @param synch:       Load the image before returning
         @return:            L{ImgDrawing} instance
         """
         fileName = self.resource.fileName(fileName)
-        drawing  = self.resource.load(target, name, lambda: ImgDrawing(self.img, fileName), synch = True)
+        drawing  = self.resource.load(target, name, lambda: ImgDrawing(self.img, fileName, background = not synch), synch = True)
         if textureSize:
             drawing.convertToTexture(textureSize[0], textureSize[1])
         return drawing
@@ -118,6 +132,9 @@ class Data(object):
         font.setCustomGlyph(BALL1, self.ball1.texture)
         font.setCustomGlyph(BALL2, self.ball2.texture)
 
+        # prepare the glyphs of the configured character set and the loading screen
+        font.warmUp([parseCharacterSet(Config.get("video", "fontcharset")), _("Loading...")])
+
     def getSelectSound(self):
         """@return: A randomly chosen selection sound."""
         return random.choice([self.selectSound1, self.selectSound2, self.selectSound3])
@@ -22,6 +22,7 @@
 
 from OpenGL.GL import *
 from View import Layer
+import GLState
 
 import gc
 import threading
@@ -85,6 +86,27 @@ class DebugLayer(Layer):
             font.render("%d threads" % threading.activeCount(), (x + .1, y), scale = scale)
             y += h
             font.render("%.2f fps" % self.engine.timer.fps, (x + .1, y), scale = scale)
+
+            scene = getattr(self.engine, "world", None) and self.engine.world.scene
+            song  = getattr(scene, "song", None)
+            if song:
+                clock = song.clock
+                y += h
+                font.render("%.1f ms clock jitter, %.1f ms max" % (clock.jitter, clock.maxJitter), (x + .1, y), scale = scale)
+                y += h
+                font.render("%d clock samples, %.4f rate" % (clock.samples, clock.rate), (x + .1, y), scale = scale)
+
+            # The counters of the frame being rendered are incomplete, so show the previous frame
+            calls = GLState.lastFrame
+            y += h
+            font.render("%d draws, %d vertices" % (calls.draws, calls.vertices), (x + .1, y), scale = scale)
+            y += h
+            font.render("%d binds, %d blend changes, %d state changes" % (calls.binds, calls.blendChanges, calls.stateChanges), (x + .1, y), scale = scale)
+            y += h
+            font.render("%d redundant calls skipped" % calls.skipped, (x + .1, y), scale = scale)
+            y += h
+            font.render("%d text cache hits, %d misses, %d evictions, %d kB" % \
+                        (font.stringCacheHits, font.stringCacheMisses, font.stringCacheEvictions, font.stringCacheBytes / 1024), (x + .1, y), scale = scale)
             #y += h
             #font.render("%d gc objects" % len(gc.get_objects()), (x + .1, y), scale = scale)
             #y += h
@@ -43,6 +43,8 @@ import Song
 import Data
 import Player
 import Guitar
+import GLState
+import TextLayout
 
 def wrapText(font, pos, text, rightMargin = 0.9, scale = 0.002, visibility = 0.0, hide = 0, hidestring = ""):
     """
@@ -55,28 +57,18 @@ def wrapText(font, pos, text, rightMargin = 0.9, scale = 0.002, visibility = 0.0
     @param visibility:  Visibility factor [0..1], 0 is fully visible
     @param hide:        Hide text instead of line wrap
     """
-    x, y = pos
-    space = font.getStringSize(" ", scale = scale)[0]
-    hidew, hideh = font.getStringSize(hidestring, scale = scale)
-    rightMargin = rightMargin - hidew
-    for n, word in enumerate(text.split(" ")):
-        w, h = font.getStringSize(word, scale = scale)
-        if x + w > rightMargin and hide:
-            word = hidestring
-        if (x + w > rightMargin and not hide) or word == "\n":
-            x = pos[0]
-            y += h
-        if word == "\n":
-            continue
-        glPushMatrix()
-        glRotate(visibility * (n + 1) * -45, 0, 0, 1)
-        font.render(word, (x, y + visibility * n), scale = scale)
-        glPopMatrix()
-        if x + w > rightMargin and hide:
-            x += hidew + space
-            break
-        x += w + space
-    return (x - space, y)
+    layout = TextLayout.wrapText(font, pos[0], text, rightMargin, scale, hide, hidestring)
+
+    # Fully visible text is drawn in one go from the cached layout
+    if not visibility:
+        layout.render(pos[1])
+    else:
+        for n, word, x, y in layout.words:
+            glPushMatrix()
+            glRotate(visibility * (n + 1) * -45, 0, 0, 1)
+            font.render(word, (x, pos[1] + y + visibility * n), scale = scale)
+            glPopMatrix()
+    return (layout.end[0], pos[1] + layout.end[1])
 
 def fadeScreen(v):
     """
@@ -84,11 +76,11 @@ def fadeScreen(v):
 
     @param v: Visibility factor [0..1], 0 is fully visible
     """
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-    glEnable(GL_COLOR_MATERIAL)
+    GLState.enable(GL_BLEND)
+    GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    GLState.enable(GL_COLOR_MATERIAL)
 
-    glBegin(GL_TRIANGLE_STRIP)
+    GLState.begin(GL_TRIANGLE_STRIP, 4)
     glColor4f(0, 0, 0, .3 - v * .3)
     glVertex2f(0, 0)
     glColor4f(0, 0, 0, .3 - v * .3)
@@ -97,7 +89,7 @@ def fadeScreen(v):
     glVertex2f(0, 1)
     glColor4f(0, 0, 0, .9 - v * .9)
     glVertex2f(1, 1)
-    glEnd()
+    GLState.end()
 
 
 class GetText(Layer, KeyListener):
@@ -215,12 +207,13 @@ class GetKey(Layer, KeyListener):
 
 class LoadingScreen(Layer, KeyListener):
     """Loading screen layer."""
-    def __init__(self, engine, condition, text, allowCancel = False):
+    def __init__(self, engine, condition, text, allowCancel = False, progress = None):
         self.engine       = engine
         self.text         = text
         self.condition    = condition
         self.ready        = False
         self.allowCancel  = allowCancel
+        self.progress     = progress
         self.time         = 0.0
 
     def shown(self):
@@ -265,6 +258,12 @@ class LoadingScreen(Layer, KeyListener):
 
             font.render(self.text, (x, y))
 
+            progress = self.progress and self.progress()
+            if progress is not None:
+                text = "%d%%" % int(progress * 100)
+                w, h = font.getStringSize(text)
+                font.render(text, (.5 - w / 2, y + h))
+
         finally:
             self.engine.view.resetProjection()
 
@@ -358,12 +357,17 @@ class SongChooser(Layer, KeyListener):
         self.engine.loadImgDrawing(self, "background", "cassette.png")
 
     def loadCollection(self):
-        self.loaded = False
+        self.loaded       = False
+        self.scanProgress = None
         self.engine.resource.load(self, "libraries", lambda: Song.getAvailableLibraries(self.engine, self.library), onLoad = self.libraryListLoaded)
-        showLoadingScreen(self.engine, lambda: self.loaded, text = _("Browsing Collection..."))
+        showLoadingScreen(self.engine, lambda: self.loaded, text = _("Browsing Collection..."), progress = lambda: self.scanProgress)
 
     def libraryListLoaded(self, libraries):
-        self.engine.resource.load(self, "songs",     lambda: Song.getAvailableSongs(self.engine, self.library), onLoad = self.songListLoaded)
+        self.engine.resource.load(self, "songs",     lambda: Song.getAvailableSongs(self.engine, self.library, progress = self.songScanned), onLoad = self.songListLoaded)
+
+    def songScanned(self, count, total):
+        # Called from the loader thread while new songs are being scanned
+        self.scanProgress = float(count) / total
 
     def songListLoaded(self, songs):
         if self.songLoader:
@@ -588,14 +592,14 @@ class SongChooser(Layer, KeyListener):
         if color:
             glColor3f(*color)
 
-        glEnable(GL_COLOR_MATERIAL)
+        GLState.enable(GL_COLOR_MATERIAL)
         self.cassette.render("Mesh_001")
         glColor3f(.1, .1, .1)
         self.cassette.render("Mesh")
 
         # Draw the label if there is one
         if label is not None:
-            glEnable(GL_TEXTURE_2D)
+            GLState.enable(GL_TEXTURE_2D)
             label.bind()
             glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
             glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
@@ -607,7 +611,7 @@ class SongChooser(Layer, KeyListener):
             glMatrixMode(GL_TEXTURE)
             glLoadIdentity()
             glMatrixMode(GL_MODELVIEW)
-            glDisable(GL_TEXTURE_2D)
+            GLState.disable(GL_TEXTURE_2D)
 
     def renderLibrary(self, color, label):
         if not self.libraryMesh:
@@ -617,14 +621,14 @@ class SongChooser(Layer, KeyListener):
             glColor3f(*color)
 
         glEnable(GL_NORMALIZE)
-        glEnable(GL_COLOR_MATERIAL)
+        GLState.enable(GL_COLOR_MATERIAL)
         self.libraryMesh.render("Mesh_001")
         glColor3f(.1, .1, .1)
         self.libraryMesh.render("Mesh")
 
         # Draw the label if there is one
         if label is not None:
-            glEnable(GL_TEXTURE_2D)
+            GLState.enable(GL_TEXTURE_2D)
             label.bind()
             glColor3f(1, 1, 1)
             glMatrixMode(GL_TEXTURE)
@@ -634,7 +638,7 @@ class SongChooser(Layer, KeyListener):
             glMatrixMode(GL_TEXTURE)
             glLoadIdentity()
             glMatrixMode(GL_MODELVIEW)
-            glDisable(GL_TEXTURE_2D)
+            GLState.disable(GL_TEXTURE_2D)
         glDisable(GL_NORMALIZE)
 
     def render(self, visibility, topMost):
@@ -663,9 +667,9 @@ class SongChooser(Layer, KeyListener):
                 glMatrixMode(GL_MODELVIEW)
                 glLoadIdentity()
 
-                glEnable(GL_DEPTH_TEST)
+                GLState.enable(GL_DEPTH_TEST)
                 glDisable(GL_CULL_FACE)
-                glDepthMask(1)
+                GLState.depthMask(1)
 
                 offset = 10 * (v ** 2)
                 self.camera.origin = (-10 + offset, -self.cameraOffset, 4   + offset)
@@ -709,9 +713,9 @@ class SongChooser(Layer, KeyListener):
                     glTranslatef(0, -h / 2, 0)
                     y += h
 
-                glDisable(GL_DEPTH_TEST)
+                GLState.disable(GL_DEPTH_TEST)
                 glDisable(GL_CULL_FACE)
-                glDepthMask(0)
+                GLState.depthMask(0)
 
             finally:
                 glMatrixMode(GL_PROJECTION)
@@ -722,24 +726,24 @@ class SongChooser(Layer, KeyListener):
             font = self.engine.data.font
 
             try:
-                glEnable(GL_BLEND)
-                glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-                glEnable(GL_COLOR_MATERIAL)
+                GLState.enable(GL_BLEND)
+                GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+                GLState.enable(GL_COLOR_MATERIAL)
                 n = (0, 0)
-                glBegin(GL_QUADS)
+                GLState.begin(GL_QUADS, 4)
                 glColor4f(0,0,0, .2)
                 glVertex2f(.04, .02)
                 glVertex2f(.04, .652)
                 glVertex2f(.58, .652)
                 glVertex2f(.58, .02)
-                glEnd()
-                glBegin(GL_LINE_LOOP)
+                GLState.end()
+                GLState.begin(GL_LINE_LOOP, 4)
                 Theme.setBaseColor(1 - v)
                 glVertex2f(.04, .02)
                 glVertex2f(.04, .652)
                 glVertex2f(.58, .652)
                 glVertex2f(.58, .02)
-                glEnd()
+                GLState.end()
 
                 length = 0
                 select = 0
@@ -761,10 +765,10 @@ class SongChooser(Layer, KeyListener):
                         it+=1
                         if it >= (select - 5) or it >= (select + 11):
                             if self.selectedIndex == i:
-                                glBegin(GL_QUADS)
+                                GLState.begin(GL_QUADS, 4)
                                 glColor4f(1,1,1, .1)
                             else:
-                                glBegin(GL_QUADS)
+                                GLState.begin(GL_QUADS, 4)
                                 if it % 2 == 0:
                                     glColor4f(0,0,0, .3)
                                 else:
@@ -773,7 +777,7 @@ class SongChooser(Layer, KeyListener):
                             glVertex2f(.045, n[1] + 3*font.getHeight() * scale)
                             glVertex2f(.575, n[1] + 3*font.getHeight() * scale)
                             glVertex2f(.575, n[1] + font.getHeight() * scale)
-                            glEnd()
+                            GLState.end()
                             Theme.setSelectedColor(1 - v)
                             if self.artistSort:
                                 n = wrapText(font, (.05, n[1] + font.getHeight() * scale), item.artist if isinstance(item, Song.SongInfo) else _("Songs library"), 0.57, visibility = 0.0, scale = scale, hide = 1, hidestring = "...")
@@ -788,7 +792,7 @@ class SongChooser(Layer, KeyListener):
 
                 # draw the scrollbar
                 perc = float(select - 1)/float(length - 1) if length > 1 else 0
-                glBegin(GL_QUADS)
+                GLState.begin(GL_QUADS, 4)
                 Theme.setBaseColor(1 - v)
                 glVertex2f(.575, .02 + .59*perc)
                 Theme.setBaseColor((1 - v) * .3)
@@ -798,7 +802,7 @@ class SongChooser(Layer, KeyListener):
                 Theme.setBaseColor((1 - v) * .3)
                 glVertex2f(.586, .02 + .59*perc + .04)
                 glVertex2f(.586, .02 + .59*perc)
-                glEnd()
+                GLState.end()
 
             finally:
                 self.engine.view.resetProjection()
@@ -806,9 +810,9 @@ class SongChooser(Layer, KeyListener):
         font = self.engine.data.font
         # render the song info
         try:
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(GL_COLOR_MATERIAL)
             Theme.setBaseColor(1 - v)
 
             if self.searchText:
@@ -962,9 +966,9 @@ class FileChooser(BackgroundLayer, KeyListener):
         font = self.engine.data.font
 
         try:
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(GL_COLOR_MATERIAL)
             Theme.setBaseColor(1 - v)
             wrapText(font, (.1, .05 - v), self.prompt)
         finally:
@@ -1028,9 +1032,9 @@ class ItemChooser(BackgroundLayer, KeyListener):
         font = self.engine.data.font
 
         try:
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(GL_COLOR_MATERIAL)
             Theme.setBaseColor(1 - v)
             wrapText(font, (.1, .05 - v), self.prompt)
         finally:
@@ -1089,9 +1093,9 @@ class BpmEstimator(Layer, KeyListener):
         fadeScreen(v)
 
         try:
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(GL_COLOR_MATERIAL)
             Theme.setBaseColor(1 - v)
             wrapText(font, (.1, .2 - v), self.prompt)
 
@@ -1143,9 +1147,9 @@ class KeyTester(Layer, KeyListener):
         fadeScreen(v)
 
         try:
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(GL_COLOR_MATERIAL)
             Theme.setBaseColor(1 - v)
             wrapText(font, (.1, .2 - v), self.prompt)
 
@@ -1251,7 +1255,7 @@ def testKeys(engine, prompt = _("Play with the keys and press Escape when you're
     d = KeyTester(engine, prompt = prompt)
     _runDialog(engine, d)
 
-def showLoadingScreen(engine, condition, text = _("Loading..."), allowCancel = False):
+def showLoadingScreen(engine, condition, text = _("Loading..."), allowCancel = False, progress = None):
     """
     Show a loading screen until a condition is met.
 
@@ -1260,6 +1264,8 @@ def showLoadingScreen(engine, condition, text = _("Loading..."), allowCancel = F
     @param text:        Text shown to the user
     @type  allowCancel: bool
     @param allowCancel: Can the loading be canceled
+    @param progress:    Optional function returning the completed fraction of
+                        the work between 0 and 1, or None if it is not known
     @return:            True if the condition was met, Fales if the loading was canceled.
     """
 
@@ -1271,7 +1277,7 @@ def showLoadingScreen(engine, condition, text = _("Loading..."), allowCancel = F
             return True
         engine.run()
 
-    d = LoadingScreen(engine, condition, text, allowCancel)
+    d = LoadingScreen(engine, condition, text, allowCancel, progress)
     _runDialog(engine, d)
     return d.ready
 
@@ -256,6 +256,7 @@ class Editor(Layer, KeyListener):
             return
 
         self.guitar.run(ticks, self.scrollPos, self.controls)
+        self.song.update(ticks)
 
         if not self.song.isPlaying():
             if self.controls.getState(Player.RIGHT) and not self.controls.getState(Player.LEFT):
@@ -23,29 +23,243 @@
 import pygame
 import numpy
 from OpenGL.GL import *
+import os
 import sys
+import sha
+import shutil
+import tempfile
+import copy
+from threading import Thread
+from collections import OrderedDict
+
+from fretwork import log
 
 from Texture import Texture, TextureAtlas, TextureAtlasFullException
+from Resource import getWritableResourcePath, getFileHash
+from TextLayout import GlyphTable, getCharacterCodes
+import GLState
+import Config
+
+Config.define("video", "fontcharset", str, "32-126,160-255")
+
+# Maximum length of the strings drawn with Font.renderHud
+HUD_TEXT_LENGTH = 32
+
+# Glyphs of SDF fonts are rasterized at this size and scaled when drawn
+SDF_RASTER_SIZE = 48
+# Width of the antialiased edge of SDF glyphs in texels
+SDF_RAMP        = 1.5
+# Offset of the drop shadow of SDF glyphs in texels
+SDF_SHADOW      = 3
+# Border around SDF glyphs for the shadow and the antialiased edge in texels
+SDF_PADDING     = SDF_SHADOW + 2
+
+def _getSquaredDistances(mask):
+    # Separable exact Euclidean distance transform, first along the columns,
+    # then along the rows
+    h, w  = mask.shape
+    far   = (h + w) ** 2
+    rows  = numpy.arange(h)
+    cols  = numpy.arange(w)
+    g     = numpy.where(mask[None, :, :], ((rows[:, None] - rows[None, :]) ** 2)[:, :, None], far).min(axis = 1)
+    return (g[:, None, :] + ((cols[:, None] - cols[None, :]) ** 2)[None, :, :]).min(axis = 2)
+
+def createDistanceField(coverage, shadow = 0):
+    """
+    Turn a rasterized glyph into a signed distance field texture.
+
+    The alpha channel holds the distance to the edge of the glyph together
+    with its drop shadow, mapped so that the edge falls on the middle value,
+    which keeps the edge sharp at any scale when the glyph is drawn with
+    alpha testing. The color channels are white inside the glyph and black
+    elsewhere, so the shadow is drawn in the same pass as the glyph.
+
+    @param coverage:  Array of glyph coverage values between 0 and 255
+    @param shadow:    Offset of the drop shadow in texels, 0 for no shadow
+    @return:          RGBA array padded by SDF_PADDING texels on each side
+    """
+    p    = SDF_PADDING
+    h, w = coverage.shape
+    mask = numpy.zeros((h + 2 * p, w + 2 * p), bool)
+    mask[p:p + h, p:p + w] = coverage >= 128
+
+    # Distance from the edge, positive inside the glyph
+    field = numpy.where(mask, numpy.sqrt(_getSquaredDistances(~mask)) - .5,
+                              .5 - numpy.sqrt(_getSquaredDistances(mask)))
+    outer = field
+    if shadow:
+        outer = numpy.empty_like(field)
+        outer.fill(field.min())
+        outer[shadow:, shadow:] = field[:-shadow, :-shadow]
+        outer = numpy.maximum(field, outer)
+
+    # The color saturates within a texel to keep thin strokes at full brightness
+    result = numpy.empty(field.shape + (4, ), numpy.uint8)
+    result[..., :3] = (numpy.clip(field + .5, 0, 1) * 255)[..., None]
+    result[..., 3]  =  numpy.clip(outer / SDF_RAMP + .5, 0, 1) * 255
+    return result
+
+def parseCharacterSet(spec):
+    """
+    Parse a character set given as a comma separated list of character
+    codes and code ranges, e.g. "32-126,160-255".
+
+    @param spec:  Character set specification
+    @return:      Unicode string with the characters of the set
+    """
+    chars = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            first, dash, last = part.partition("-")
+            first = int(first, 0)
+            if dash:
+                last = int(last, 0)
+            else:
+                last = first
+            if last < first:
+                raise ValueError()
+            chars.extend([unichr(code) for code in range(first, last + 1)])
+        except ValueError:
+            log.warn("Invalid character range in font character set: %s" % part)
+    return u"".join(chars)
+
+class GlyphAtlasCache(object):
+    """
+    A persistent cache of prerasterized glyph atlases.
+
+    Rendering each glyph with pygame and uploading it into the atlas the first
+    time it is drawn makes the first frames showing new text stutter, so the
+    used part of the glyph atlas of a font is stored along with the texture
+    coordinates and advances of its glyphs in the writable resource directory.
+    There is one entry per font file, size and style.
+    """
+    version = 1
+
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(getWritableResourcePath(), "cache", "fonts")
+        self.path = path
+
+    def getEntryFileName(self, key):
+        """
+        Get the name of the cache entry for a font.
+
+        @param key:   Font key as returned by L{Font.getCacheKey}
+        @return:      Path to the cache entry
+        """
+        return os.path.join(self.path, sha.new(repr(key)).hexdigest() + ".npz")
+
+    def read(self, key):
+        """
+        Read the cache entry of a font.
+
+        @param key:   Font key as returned by L{Font.getCacheKey}
+        @return:      Mapping of column names to arrays or None if there is
+                      no valid entry for the font
+        """
+        fileName = self.getEntryFileName(key)
+        if not os.path.isfile(fileName):
+            return None
+
+        try:
+            entry = numpy.load(fileName)
+            try:
+                if int(entry["version"]) != self.version or str(entry["key"]) != repr(key):
+                    return None
+                return dict(entry.items())
+            finally:
+                entry.close()
+        except Exception, e:
+            log.warn("Unable to read font cache entry %s: %s" % (fileName, e))
+            return None
+
+    def store(self, key, columns, background = True):
+        """
+        Write the cache entry of a font.
+
+        @param key:         Font key as returned by L{Font.getCacheKey}
+        @param columns:     Mapping of column names to arrays
+        @param background:  Write the entry in a separate thread
+        """
+        columns = dict(columns)
+        columns["version"] = numpy.array(self.version)
+        columns["key"]     = numpy.array(repr(key))
+
+        if background:
+            thread = Thread(target = self._write, args = (self.getEntryFileName(key), columns))
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self._write(self.getEntryFileName(key), columns)
+
+    def _write(self, fileName, columns):
+        tempName = None
+        try:
+            if not os.path.isdir(self.path):
+                try:
+                    os.makedirs(self.path)
+                except OSError:
+                    # Another writer may have created the directory meanwhile
+                    if not os.path.isdir(self.path):
+                        raise
+
+            # Several entries may be written at the same time, so each one
+            # gets a temporary file of its own
+            fd, tempName = tempfile.mkstemp(suffix = ".tmp", dir = self.path)
+            f = os.fdopen(fd, "wb")
+            try:
+                numpy.savez(f, **columns)
+            finally:
+                f.close()
+
+            # Rename the output file after it has been succesfully written
+            shutil.move(tempName, fileName)
+        except Exception, e:
+            log.warn("Unable to write font cache entry %s: %s" % (fileName, e))
+            if tempName and os.path.isfile(tempName):
+                os.unlink(tempName)
 
 class Font:
     """A texture-mapped font."""
     def __init__(self, fileName, size, bold = False, italic = False, underline = False, outline = True,
-                 scale = 1.0, reversed = False, systemFont = False):
+                 scale = 1.0, reversed = False, systemFont = False, atlasCache = None, sdf = False):
+        """
+        @param atlasCache:  Optional L{GlyphAtlasCache} for storing the glyph
+                            atlas of this font between runs
+        @param sdf:         Store the glyphs as signed distance fields, which
+                            can be drawn at any size, see L{derive}
+        """
         pygame.font.init()
-        self.size             = size
-        self.scale            = scale
-        self.glyphCache       = {}
-        self.glyphSizeCache   = {}
-        self.outline          = outline
-        self.glyphTextures    = []
-        self.reversed         = reversed
-        self.stringCache      = {}
-        self.stringCacheLimit = 256
+        self.size                 = size
+        self.scale                = scale
+        self.outline              = outline
+        self.glyphTextures        = []
+        self.reversed             = reversed
+        self.atlasCache           = atlasCache
+        self.atlasEntry           = None
+        self.cacheKey             = None
+        self.sdf                  = sdf
+        self.glyphPadding         = 0
+        self.glyphScale           = 1.0
+        self.glyphSource          = None
+        self._createCaches()
+
+        # Distance field glyphs are rasterized at a fixed size and scaled to the requested one
+        if sdf:
+            self.glyphScale       = size / float(SDF_RASTER_SIZE)
+            self.glyphPadding     = SDF_PADDING
+            size                  = SDF_RASTER_SIZE
+
         # Try loading a system font first if one was requested
         self.font           = None
         if systemFont and sys.platform != "win32":
             try:
                 self.font       = pygame.font.SysFont(None, size)
+                # The default system font is pygame's own font
+                fileName        = os.path.join(os.path.dirname(pygame.font.__file__), pygame.font.get_default_font())
             except:
                 pass
         if not self.font:
@@ -54,6 +268,84 @@ class Font:
         self.font.set_italic(italic)
         self.font.set_underline(underline)
 
+        # Read the cached glyph atlas here, it is uploaded by the main thread later
+        if atlasCache:
+            try:
+                self.cacheKey   = self.getCacheKey(fileName, size, bold, italic, underline, sdf, outline)
+                self.atlasEntry = atlasCache.read(self.cacheKey)
+            except IOError, e:
+                log.warn("Unable to use the glyph atlas cache for %s: %s" % (fileName, e))
+                self.atlasCache = None
+
+    def _createCaches(self):
+        self.glyphCache           = {}
+        self.glyphSizeCache       = {}
+        self.glyphTable           = GlyphTable(self)
+        self.stringCache          = OrderedDict()
+        self.stringCacheSizes     = {}
+        self.stringCacheBytes     = 0
+        self.stringCacheBudget    = 1024 * 1024
+        self.stringCacheHits      = 0
+        self.stringCacheMisses    = 0
+        self.stringCacheEvictions = 0
+        self.hudAdvances          = None
+
+    @staticmethod
+    def getCacheKey(fileName, size, bold, italic, underline, sdf = False, outline = True):
+        """
+        Get the key identifying the glyphs of a font in a L{GlyphAtlasCache}.
+
+        @param fileName:  Path to the font file
+        @param size:      Font size
+        @param sdf:       Distance field glyphs
+        @param outline:   Distance field glyphs with a drop shadow
+        @return:          Key tuple
+        """
+        return (getFileHash(fileName), size, bool(bold), bool(italic), bool(underline), bool(sdf), bool(sdf and outline))
+
+    def derive(self, size):
+        """
+        Create a font that draws the glyphs of this one at another size. The
+        fonts share the glyph atlas, so this is meant for SDF fonts, whose
+        glyphs stay sharp when scaled.
+
+        @param size:  Font size
+        @return:      L{Font} instance
+        """
+        font             = copy.copy(self)
+        font.size        = size
+        font.glyphScale  = self.glyphScale * size / float(self.size)
+        font.glyphSource = self
+        font.atlasCache  = None
+        font.atlasEntry  = None
+        font._createCaches()
+        return font
+
+    def getGlyphPadding(self, texture):
+        """
+        Get the size of the empty border around the glyphs in a texture.
+
+        @param texture:   Glyph texture as returned by L{getGlyph}
+        @return:          Border width in unscaled pixels
+        """
+        if texture in self.glyphTextures:
+            return self.glyphPadding * self.glyphScale
+        return 0
+
+    def getGlyphSize(self, ch):
+        """
+        Get the unscaled dimensions of a single character.
+
+        @param ch:    Character
+        @return:      (width, height) tuple
+        """
+        try:
+            w, h = self.glyphSizeCache[ch]
+        except KeyError:
+            w, h = self.glyphSizeCache[ch] = self.font.size(ch)
+        # Distance field glyphs are rasterized at a different size
+        return (w * self.glyphScale, h * self.glyphScale)
+
     def getStringSize(self, s, scale = 0.002):
         """
         Get the dimensions of a string when rendered with this font.
@@ -62,25 +354,19 @@ class Font:
         @param scale:   Scale factor
         @return:        (width, height) tuple
         """
-        w = 0
-        h = 0
+        if not s:
+            return (0.0, 0.0)
         scale *= self.scale
-        for ch in s:
-            try:
-                s = self.glyphSizeCache[ch]
-            except:
-                s = self.glyphSizeCache[ch] = self.font.size(ch)
-            w += s[0]
-            h = max(s[1], h)
-        return (w * scale, h * scale)
+        advances, heights = self.glyphTable.measure(getCharacterCodes(s))
+        return (float(advances.sum()) * scale, float(heights.max()) * scale)
 
     def getHeight(self):
         """@return: The height of this font"""
-        return self.font.get_height() * self.scale
+        return self.font.get_height() * self.glyphScale * self.scale
 
     def getLineSpacing(self):
         """@return: The line spacing of this font"""
-        return self.font.get_linesize() * self.scale
+        return self.font.get_linesize() * self.glyphScale * self.scale
 
     def setCustomGlyph(self, character, texture):
         """
@@ -92,106 +378,376 @@ class Font:
         texture.setFilter(GL_LINEAR, GL_LINEAR)
         texture.setRepeat(GL_CLAMP, GL_CLAMP)
         self.glyphCache[character]     = (texture, (0.0, 0.0, texture.size[0], texture.size[1]))
-        s = .75 * self.getHeight() / float(texture.pixelSize[0])
+        # The glyph size cache is in rasterized pixels
+        s = .75 * self.font.get_height() / float(texture.pixelSize[0])
         self.glyphSizeCache[character] = (texture.pixelSize[0] * s, texture.pixelSize[1] * s)
+        self.glyphTable.invalidate(character)
+        if self.hudAdvances is not None and ord(character) < 256:
+            self.hudLoaded[ord(character)] = False
+
+    def _getGeometry(self, vertices, texCoords, textureIds):
+        # Split the glyph quads into runs sharing a texture
+        geometry = []
+        for texture, first, count in self.glyphTable.getRuns(textureIds):
+            geometry.append((texture, count * 4, vertices[first:first + count].reshape((-1, 2)),
+                             texCoords[first:first + count].reshape((-1, 2))))
+        return geometry
+
+    def _getStringGeometry(self, text, direction, scale):
+        """
+        Get the glyph quads of a string from the string cache, building them
+        if needed. The least recently used strings are evicted when the
+        geometry in the cache exceeds stringCacheBudget bytes.
 
-    def _renderString(self, text, pos, direction, scale):
-        if not text:
-            return
+        @return: List of (texture, vertex count, vertices, texture coordinates)
+                 tuples, one for each run of glyphs sharing a texture
+        """
+        key = (text, scale, direction[0], direction[1])
+        try:
+            cacheEntry = self.stringCache.pop(key)
+            self.stringCache[key] = cacheEntry
+            self.stringCacheHits += 1
+            return cacheEntry
+        except KeyError:
+            self.stringCacheMisses += 1
 
-        if not (text, scale) in self.stringCache:
-            currentTexture = None
-            #x, y           = pos[0], pos[1]
-            x, y           = 0.0, 0.0
-            vertices       = numpy.empty((4 * len(text), 2), numpy.float32)
-            texCoords      = numpy.empty((4 * len(text), 2), numpy.float32)
-            vertexCount    = 0
-            cacheEntry     = []
-
-            for i, ch in enumerate(text):
-                g, coordinates     = self.getGlyph(ch)
-                w, h               = self.getStringSize(ch, scale = scale)
-                tx1, ty1, tx2, ty2 = coordinates
-
-                # Set the initial texture
-                if currentTexture is None:
-                    currentTexture = g
-
-                # If the texture changed, flush the geometry
-                if currentTexture != g:
-                    cacheEntry.append((currentTexture, vertexCount, numpy.array(vertices[:vertexCount]), numpy.array(texCoords[:vertexCount])))
-                    currentTexture = g
-                    vertexCount = 0
-
-                vertices[vertexCount + 0]  = (x,     y)
-                vertices[vertexCount + 1]  = (x + w, y)
-                vertices[vertexCount + 2]  = (x + w, y + h)
-                vertices[vertexCount + 3]  = (x,     y + h)
-                texCoords[vertexCount + 0] = (tx1, ty2)
-                texCoords[vertexCount + 1] = (tx2, ty2)
-                texCoords[vertexCount + 2] = (tx2, ty1)
-                texCoords[vertexCount + 3] = (tx1, ty1)
-                vertexCount += 4
-
-                x += w * direction[0]
-                y += w * direction[1]
-            cacheEntry.append((currentTexture, vertexCount, vertices[:vertexCount], texCoords[:vertexCount]))
-
-            # Don't store very short strings
-            if len(text) > 5:
-                # Limit the cache size
-                if len(self.stringCache) > self.stringCacheLimit:
-                    del self.stringCache[self.stringCache.keys()[0]]
-                self.stringCache[(text, scale)] = cacheEntry
-        else:
-            cacheEntry = self.stringCache[(text, scale)]
+        vertices, texCoords, textureIds = self.glyphTable.getQuads(getCharacterCodes(text), scale, direction)
+        cacheEntry = self._getGeometry(vertices, texCoords, textureIds)
+
+        size = vertices.nbytes + texCoords.nbytes
+        if size > self.stringCacheBudget:
+            return cacheEntry
 
+        # Evict the least recently used strings until the new one fits
+        while self.stringCacheBytes + size > self.stringCacheBudget:
+            oldKey, oldEntry = self.stringCache.popitem(last = False)
+            self.stringCacheBytes -= self.stringCacheSizes.pop(oldKey)
+            self.stringCacheEvictions += 1
+
+        self.stringCache[key]       = cacheEntry
+        self.stringCacheSizes[key]  = size
+        self.stringCacheBytes      += size
+        return cacheEntry
+
+    def getWordsGeometry(self, words, scale = 0.002):
+        """
+        Build the glyph quads of several strings drawn at different positions
+        for drawing them all at once with L{renderGeometry}.
+
+        @param words:   List of (text, x, y) tuples
+        @param scale:   Scale factor
+        @return:        Geometry that can be passed to L{renderGeometry}
+        """
+        scale *= self.scale
+        parts  = []
+        for text, x, y in words:
+            if self.reversed:
+                text = text[::-1]
+            vertices, texCoords, textureIds = self.glyphTable.getQuads(getCharacterCodes(text), scale)
+            vertices += (x, y)
+            parts.append((vertices, texCoords, textureIds))
+
+        if not parts:
+            return []
+        return self._getGeometry(*[numpy.concatenate(p) for p in zip(*parts)])
+
+    def _drawString(self, cacheEntry, pos, setup = True):
         glPushMatrix()
         glTranslatef(pos[0], pos[1], 0)
         for texture, vertexCount, vertices, texCoords in cacheEntry:
-            texture.bind()
-            glVertexPointer(2, GL_FLOAT, 0, vertices)
-            glTexCoordPointer(2, GL_FLOAT, 0, texCoords)
-            glDrawArrays(GL_QUADS, 0, vertexCount)
+            if setup:
+                texture.bind()
+                glVertexPointer(2, GL_FLOAT, 0, vertices)
+                glTexCoordPointer(2, GL_FLOAT, 0, texCoords)
+            GLState.drawArrays(GL_QUADS, 0, vertexCount)
         glPopMatrix()
 
-    def render(self, text, pos = (0, 0), direction = (1, 0), scale = 0.002):
+    def _createHudTables(self):
+        # Glyph metrics indexed by character code
+        self.hudAdvances     = numpy.zeros(256, numpy.float32)
+        self.hudGlyphHeights = numpy.zeros(256, numpy.float32)
+        self.hudGlyphCoords  = numpy.zeros((256, 4, 2), numpy.float32)
+        self.hudLoaded       = numpy.zeros(256, bool)
+        self.hudUsable       = numpy.zeros(256, bool)
+        self.hudTexture      = None
+        self.hudPadding      = 0
+
+        # Buffers for the string being drawn
+        self.hudFlags        = numpy.zeros(HUD_TEXT_LENGTH, bool)
+        self.hudWidths       = numpy.zeros(HUD_TEXT_LENGTH, numpy.float32)
+        self.hudHeights      = numpy.zeros(HUD_TEXT_LENGTH, numpy.float32)
+        self.hudX            = numpy.zeros(HUD_TEXT_LENGTH + 1, numpy.float32)
+        self.hudVertices     = numpy.zeros((HUD_TEXT_LENGTH, 4, 2), numpy.float32)
+        self.hudTexCoords    = numpy.zeros((HUD_TEXT_LENGTH, 4, 2), numpy.float32)
+
+    def _loadHudGlyph(self, code):
+        ch                          = unichr(code)
+        texture, coordinates        = self.getGlyph(ch)
+        w, h                        = self.getGlyphSize(ch)
+        tx1, ty1, tx2, ty2          = coordinates
+
+        # All the glyphs must come from the same texture to be drawn with one call
+        if self.hudTexture is None:
+            self.hudTexture         = texture
+            self.hudPadding         = self.getGlyphPadding(texture)
+        self.hudAdvances[code]      = w
+        self.hudGlyphHeights[code]  = h
+        self.hudGlyphCoords[code]   = ((tx1, ty2), (tx2, ty2), (tx2, ty1), (tx1, ty1))
+        self.hudUsable[code]        = texture is self.hudTexture
+        self.hudLoaded[code]        = True
+
+    def _layoutHud(self, text, scale):
         """
-        Draw some text.
+        Write the quads of a string into the HUD buffers.
+
+        @return: Number of glyphs or None if the string can not be drawn
+                 from the HUD buffers
+        """
+        if self.reversed:
+            text = text[::-1]
+        if isinstance(text, unicode):
+            try:
+                text = text.encode("latin-1")
+            except UnicodeEncodeError:
+                return None
+
+        n = len(text)
+        if not n or n > HUD_TEXT_LENGTH:
+            return None
+
+        if self.hudAdvances is None:
+            self._createHudTables()
+
+        codes = numpy.frombuffer(text, numpy.uint8)
+        if not numpy.take(self.hudLoaded, codes, out = self.hudFlags[:n]).all():
+            for code in set(codes.tolist()):
+                if not self.hudLoaded[code]:
+                    self._loadHudGlyph(code)
+        if not numpy.take(self.hudUsable, codes, out = self.hudFlags[:n]).all():
+            return None
+
+        widths  = numpy.take(self.hudAdvances, codes, out = self.hudWidths[:n])
+        heights = numpy.take(self.hudGlyphHeights, codes, out = self.hudHeights[:n])
+        widths  *= scale
+        heights *= scale
+        x        = self.hudX[:n + 1]
+        numpy.cumsum(widths, out = x[1:])
+
+        pad      = self.hudPadding * scale
+        vertices = self.hudVertices[:n]
+        vertices[:, 0, 0] = x[:-1] - pad
+        vertices[:, 1, 0] = x[1:]  + pad
+        vertices[:, 2, 0] = x[1:]  + pad
+        vertices[:, 3, 0] = x[:-1] - pad
+        vertices[:, 0, 1] = -pad
+        vertices[:, 1, 1] = -pad
+        vertices[:, 2, 1] = heights + pad
+        vertices[:, 3, 1] = heights + pad
+        numpy.take(self.hudGlyphCoords, codes, axis = 0, out = self.hudTexCoords[:n])
+        return n
+
+    def getHudSize(self, text, scale = 0.002):
+        """
+        Get the dimensions of a string when rendered with L{renderHud}.
+
+        @param text:    String
+        @param scale:   Scale factor
+        @return:        (width, height) tuple
+        """
+        n = self._layoutHud(text, scale * self.scale)
+        if n is None:
+            return self.getStringSize(text, scale = scale)
+        return (float(self.hudX[n]), float(self.hudHeights[:n].max()))
+
+    def renderHud(self, text, pos = (0, 0), scale = 0.002, align = (0, 0)):
+        """
+        Draw a short string that changes often, such as a score counter.
+
+        The glyph quads are written into preallocated buffers instead of
+        allocating new geometry for every string, and the outline is drawn
+        from the same buffers. Strings with glyphs that are not available
+        for this are drawn with L{render}.
 
         @param text:      Text to draw
         @param pos:       Text coordinate tuple (x, y)
-        @param direction: Text direction vector (x, y, z)
         @param scale:     Scale factor
+        @param align:     Fractions (x, y) of the text size to move the text
+                          left and up by, e.g. (.5, .5) centers it on pos
         """
-        glEnable(GL_TEXTURE_2D)
-        glEnableClientState(GL_VERTEX_ARRAY)
-        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        # Lay out the glyphs at the same size as render() does
+        n = self._layoutHud(text, scale * self.scale)
+        if n is None:
+            if text:
+                w, h = self.getStringSize(text, scale = scale)
+                self.render(text, (pos[0] - w * align[0], pos[1] - h * align[1]), scale = scale)
+            return
 
-        scale *= self.scale
+        if align[0] or align[1]:
+            w, h = float(self.hudX[n]), float(self.hudHeights[:n].max())
+            pos  = (pos[0] - w * align[0], pos[1] - h * align[1])
 
-        if self.reversed:
-            text = "".join(reversed(text))
+        GLState.enable(GL_TEXTURE_2D)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        self.hudTexture.bind()
+        glVertexPointer(2, GL_FLOAT, 0, self.hudVertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self.hudTexCoords)
+        self._beginSdf()
 
-        if self.outline:
+        if self.outline and not self.sdf:
             glPushAttrib(GL_CURRENT_BIT)
             glColor4f(0, 0, 0, glGetFloatv(GL_CURRENT_COLOR)[3])
-            self._renderString(text, (pos[0] + 0.003, pos[1] + 0.003), direction, scale)
+            glPushMatrix()
+            glTranslatef(pos[0] + 0.003, pos[1] + 0.003, 0)
+            GLState.drawArrays(GL_QUADS, 0, n * 4)
+            glPopMatrix()
             glPopAttrib()
 
-        self._renderString(text, pos, direction, scale)
+        glPushMatrix()
+        glTranslatef(pos[0], pos[1], 0)
+        GLState.drawArrays(GL_QUADS, 0, n * 4)
+        glPopMatrix()
+
+        self._endSdf()
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        GLState.disable(GL_TEXTURE_2D)
+
+    def _beginSdf(self):
+        if self.sdf:
+            # Keep the glyph shape independent of the text transparency
+            GLState.enable(GL_ALPHA_TEST)
+            glAlphaFunc(GL_GREATER, .5 * glGetFloatv(GL_CURRENT_COLOR)[3])
+
+    def _endSdf(self):
+        if self.sdf:
+            GLState.disable(GL_ALPHA_TEST)
+
+    def renderGeometry(self, geometry, pos = (0, 0)):
+        """
+        Draw text from prebuilt glyph quads.
+
+        @param geometry:  Geometry returned by L{getWordsGeometry}
+        @param pos:       Text coordinate tuple (x, y)
+        """
+        GLState.enable(GL_TEXTURE_2D)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+
+        if geometry:
+            setup = True
+            self._beginSdf()
+
+            # Distance field glyphs include the outline
+            if self.outline and not self.sdf:
+                glPushAttrib(GL_CURRENT_BIT)
+                glColor4f(0, 0, 0, glGetFloatv(GL_CURRENT_COLOR)[3])
+                self._drawString(geometry, (pos[0] + 0.003, pos[1] + 0.003))
+                glPopAttrib()
+
+                # The outline leaves the arrays of a single texture in place
+                setup = len(geometry) > 1
+
+            self._drawString(geometry, pos, setup)
+            self._endSdf()
 
         glDisableClientState(GL_VERTEX_ARRAY)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-        glDisable(GL_TEXTURE_2D)
+        GLState.disable(GL_TEXTURE_2D)
+
+    def render(self, text, pos = (0, 0), direction = (1, 0), scale = 0.002):
+        """
+        Draw some text.
 
-    def _allocateGlyphTexture(self):
-        t = TextureAtlas(size = (glGetInteger(GL_MAX_TEXTURE_SIZE) / 2))
+        @param text:      Text to draw
+        @param pos:       Text coordinate tuple (x, y)
+        @param direction: Text direction vector (x, y, z)
+        @param scale:     Scale factor
+        """
+        if self.reversed:
+            text = "".join(reversed(text))
+
+        if text:
+            self.renderGeometry(self._getStringGeometry(text, direction, scale * self.scale), pos)
+        else:
+            self.renderGeometry([], pos)
+
+    def _allocateGlyphTexture(self, size = None, pixels = None):
+        # Only the first atlas is stored in the glyph atlas cache
+        mirror = bool(self.atlasCache) and not self.glyphTextures
+        t = TextureAtlas(size = size or (glGetInteger(GL_MAX_TEXTURE_SIZE) / 2), pixels = pixels, mirror = mirror)
         t.texture.setFilter(GL_LINEAR, GL_LINEAR)
         t.texture.setRepeat(GL_CLAMP, GL_CLAMP)
         self.glyphTextures.append(t)
         return t
 
+    def _loadAtlasEntry(self):
+        entry, self.atlasEntry = self.atlasEntry, None
+        if entry is None or self.glyphTextures:
+            return
+
+        size = int(entry["atlasSize"])
+        if size > glGetInteger(GL_MAX_TEXTURE_SIZE):
+            return
+
+        texture              = self._allocateGlyphTexture(size, entry["pixels"])
+        texture.cursor       = tuple(entry["cursor"].tolist())
+        texture.rowHeight    = int(entry["rowHeight"])
+        texture.surfaceCount = len(entry["chars"])
+
+        for code, coordinates, glyphSize in zip(entry["chars"].tolist(), entry["coordinates"].tolist(), entry["sizes"].tolist()):
+            ch = unichr(code)
+            # Custom glyphs take precedence
+            if not ch in self.glyphCache:
+                self.glyphCache[ch]     = (texture, tuple(coordinates))
+                self.glyphSizeCache[ch] = tuple(glyphSize)
+
+    def saveGlyphAtlas(self, background = True):
+        """
+        Store the glyph atlas of this font in the glyph atlas cache.
+
+        @param background:  Write the cache entry in a separate thread
+        """
+        if not self.atlasCache or not self.glyphTextures or self.glyphTextures[0].pixels is None:
+            return
+
+        texture = self.glyphTextures[0]
+        glyphs  = [(ch, coordinates) for ch, (t, coordinates) in self.glyphCache.items() if t is texture]
+        columns = {
+          "atlasSize":   numpy.array(texture.texture.pixelSize[0]),
+          "pixels":      numpy.array(texture.pixels),
+          "cursor":      numpy.array(texture.cursor),
+          "rowHeight":   numpy.array(texture.rowHeight),
+          "chars":       numpy.array([ord(ch) for ch, coordinates in glyphs], numpy.int32),
+          "coordinates": numpy.array([coordinates for ch, coordinates in glyphs], numpy.float64).reshape((-1, 4)),
+          "sizes":       numpy.array([self.font.size(ch) for ch, coordinates in glyphs], numpy.int32).reshape((-1, 2)),
+        }
+        self.atlasCache.store(self.cacheKey, columns, background)
+
+    def warmUp(self, strings):
+        """
+        Load the glyphs of some strings before they are drawn, so that the
+        first frames showing them do not need to rasterize and upload new
+        glyphs. The cached glyph atlas of the font is uploaded first and
+        any glyphs added to it are written back to the cache.
+
+        Must be called from the thread owning the OpenGL context.
+
+        @param strings:   Sequence of strings, e.g. loading screen and menu texts
+        """
+        if self.glyphSource:
+            self.glyphSource.warmUp(strings)
+        self._loadAtlasEntry()
+
+        glyphCount = len(self.glyphCache)
+        for text in strings:
+            for ch in text:
+                self.getGlyph(ch)
+                self.getStringSize(ch)
+
+        if len(self.glyphCache) > glyphCount:
+            self.saveGlyphAtlas()
+
     def getGlyph(self, ch):
         """
         Get a (L{Texture}, coordinate tuple) pair for a given character.
@@ -202,8 +758,22 @@ class Font:
         try:
             return self.glyphCache[ch]
         except KeyError:
+            if self.glyphSource:
+                glyph = self.glyphCache[ch] = self.glyphSource.getGlyph(ch)
+                return glyph
+
+            if self.atlasEntry is not None:
+                self._loadAtlasEntry()
+                return self.getGlyph(ch)
+
             s = self.font.render(ch, True, (255, 255, 255))
 
+            if self.sdf:
+                w, h     = s.get_size()
+                coverage = numpy.frombuffer(pygame.image.tostring(s, "RGBA"), numpy.uint8).reshape((h, w, 4))[..., 3]
+                field    = createDistanceField(coverage, self.outline and SDF_SHADOW or 0)
+                s        = pygame.image.fromstring(field.tostring(), (field.shape[1], field.shape[0]), "RGBA")
+
             if not self.glyphTextures:
                 texture = self._allocateGlyphTexture()
             else:
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+
+
+"""
+A thin layer over the OpenGL state that skips redundant state changes.
+
+The render code sets the texture, blending and depth state through this
+module instead of calling OpenGL directly. The last value of each piece of
+state is remembered, and calls that would not change it are skipped.
+Draw calls are counted too, so that the per-frame figures can be shown in
+the debug layer.
+
+Only the state set through this module is tracked. Any capability that is
+enabled or disabled here must never be changed with plain OpenGL calls,
+or the remembered state goes stale. If the state may have been changed
+behind the tracker's back, for example by deleting a bound texture, call
+L{invalidate}.
+"""
+
+from OpenGL.GL import *
+
+class Counters(object):
+    """OpenGL calls made during a frame."""
+    def __init__(self):
+        self.binds        = 0
+        self.blendChanges = 0
+        self.stateChanges = 0
+        self.skipped      = 0
+        self.draws        = 0
+        self.vertices     = 0
+
+# Counters of the frame being rendered and of the previous complete frame
+counters  = Counters()
+lastFrame = Counters()
+
+_enabled   = {}
+_textures  = {}
+_blendFunc = None
+_depthMask = None
+_texEnv    = None
+
+def invalidate():
+    """Forget the tracked state, so that the next calls are made unconditionally."""
+    global _blendFunc, _depthMask, _texEnv
+    _enabled.clear()
+    _textures.clear()
+    _blendFunc = None
+    _depthMask = None
+    _texEnv    = None
+
+def beginFrame():
+    """
+    Start counting the calls of a new frame. The state is also forgotten,
+    since nothing guarantees it was left untouched between the frames.
+    """
+    global counters, lastFrame
+    lastFrame = counters
+    counters  = Counters()
+    invalidate()
+
+def enable(cap):
+    if _enabled.get(cap) is True:
+        counters.skipped += 1
+        return
+    _enabled[cap] = True
+    counters.stateChanges += 1
+    glEnable(cap)
+
+def disable(cap):
+    if _enabled.get(cap) is False:
+        counters.skipped += 1
+        return
+    _enabled[cap] = False
+    counters.stateChanges += 1
+    glDisable(cap)
+
+def blendFunc(src, dst):
+    global _blendFunc
+    if _blendFunc == (src, dst):
+        counters.skipped += 1
+        return
+    _blendFunc = (src, dst)
+    counters.blendChanges += 1
+    glBlendFunc(src, dst)
+
+def depthMask(flag):
+    global _depthMask
+    flag = bool(flag)
+    if _depthMask is flag:
+        counters.skipped += 1
+        return
+    _depthMask = flag
+    counters.stateChanges += 1
+    glDepthMask(flag)
+
+def bindTexture(target, texture):
+    if _textures.get(target) == texture:
+        counters.skipped += 1
+        return
+    _textures[target] = texture
+    counters.binds += 1
+    glBindTexture(target, texture)
+
+def texEnv(mode):
+    """Set the texture environment mode."""
+    global _texEnv
+    if _texEnv == mode:
+        counters.skipped += 1
+        return
+    _texEnv = mode
+    counters.stateChanges += 1
+    glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, mode)
+
+def begin(mode, vertices):
+    """
+    Start an immediate mode primitive.
+
+    @param mode:      Primitive type
+    @param vertices:  Number of vertices that will be given before L{end}
+    """
+    counters.draws    += 1
+    counters.vertices += vertices
+    glBegin(mode)
+
+def end():
+    glEnd()
+
+def drawArrays(mode, first, count):
+    counters.draws    += 1
+    counters.vertices += count
+    glDrawArrays(mode, first, count)
+
+def callList(list):
+    counters.draws += 1
+    glCallList(list)
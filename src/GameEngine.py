@@ -46,6 +46,9 @@ import MainMenu
 import Theme
 import Version
 import Mod
+import Clock
+import GLState
+import Texture
 
 # define configuration keys
 Config.define("game",   "uploadscores", bool,  False, text = _("Upload Highscores"),    options = {False: _("No"), True: _("Yes")})
@@ -69,6 +72,7 @@ Config.define("audio",  "guitarvol",  float,    1.0,  text = _("Guitar Volume"),
 Config.define("audio",  "songvol",    float,    1.0,  text = _("Song Volume"),     options = dict([(n / 100.0, "%02d/10" % (n / 9)) for n in range(0, 110, 10)]))
 Config.define("audio",  "rhythmvol",  float,    1.0,  text = _("Rhythm Volume"),   options = dict([(n / 100.0, "%02d/10" % (n / 9)) for n in range(0, 110, 10)]))
 Config.define("video",  "fontscale",  float,    1.0,  text = _("Text scale"),      options = dict([(n / 100.0, "%3d%%" % n) for n in range(50, 260, 10)]))
+Config.define("video",  "sdffonts",   bool,    False, text = _("Scalable fonts"),  options = {False: _("No"), True: _("Yes")})
 
 class FullScreenSwitcher(KeyListener):
     """
@@ -181,7 +185,9 @@ class GameEngine(object):
         self.running = True
         self.timer = FpsTimer()
         self.tickDelta = 0
+        self.frameTime = Clock.getTime()
         self.task = TaskEngine(self)
+        self.textureUploadBudget = self.config.get("opengl", "uploadbudget") / 1000.0
 
         self.task.addTask(self.input, synced = False)
         self.task.addTask(self.view)
@@ -282,18 +288,19 @@ class GameEngine(object):
         self.world = None
         self.view.pushLayer(MainMenu.MainMenu(self))
 
-    def loadImgDrawing(self, target, name, fileName, textureSize = None):
+    def loadImgDrawing(self, target, name, fileName, textureSize = None, synch = False):
         """
-        Load an SVG drawing synchronously.
+        Load an image drawing, in the background unless synch is set.
 
         @param target:      An object that will own the drawing
         @param name:        The name of the attribute the drawing will be assigned to
         @param fileName:    The name of the file in the data directory
         @param textureSize  Either None or (x, y), in which case the file will
                             be rendered to an x by y texture
+        @param synch:       Load the image before returning
         @return:            L{ImgDrawing} instance
         """
-        return self.data.loadImgDrawing(target, name, fileName, textureSize)
+        return self.data.loadImgDrawing(target, name, fileName, textureSize, synch)
 
     def loading(self):
         """Loading state loop."""
@@ -317,10 +324,29 @@ class GameEngine(object):
         if self.debugLayer:
             self.debugLayer.render(1.0, True)
 
+    def waitForNextFrame(self):
+        """
+        Wait until it is time to render the next frame. The input is polled
+        while waiting so that the input events are time stamped accurately
+        regardless of the frame rate.
+        """
+        frameEnd = self.frameTime + 1000.0 / self.fps
+        # Each wait takes at least a millisecond, so this can not take much
+        # longer than a frame even if the clock misbehaves
+        for i in range(int(1000.0 / self.fps) + 1):
+            if Clock.getTime() >= frameEnd - 1.0:
+                break
+            self.input.pollEvents()
+            pygame.time.wait(1)
+        self.timer.delay(self.fps)
+
     def run(self):
         try:
+            self.frameTime = Clock.getTime()
             self.tickDelta = self.timer.tick()
             done = self.task.run()
+            Texture.processUploads(self.textureUploadBudget)
+            GLState.beginFrame()
             self.clearScreen()
 
             self.mainloop()
@@ -332,7 +358,7 @@ class GameEngine(object):
                 self.fpsEstimate = self.timer.get_fps()
                 print ("%.2f fps" % self.fpsEstimate)
 
-            self.timer.delay(self.fps)
+            self.waitForNextFrame()
 
             return done
         except KeyboardInterrupt:
@@ -27,6 +27,7 @@ import Dialogs
 import Song
 import Data
 import Theme
+import GLState
 from fretwork.audio import Sound
 from Language import _
 
@@ -151,9 +152,9 @@ class GameResultsScene(Scene):
 
         v = ((1 - visibility) ** 2)
 
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        glEnable(GL_COLOR_MATERIAL)
+        GLState.enable(GL_BLEND)
+        GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        GLState.enable(GL_COLOR_MATERIAL)
 
         self.engine.view.setOrthogonalProjection(normalize = True)
         try:
@@ -21,9 +21,10 @@
 #####################################################################
 
 import Player
-from Song import Note, Tempo
+from Song import NoteScheduler, CHORD_MASK, EVENT_NOTE, EVENT_TEMPO, FLAG_TAPPABLE
 from Mesh import Mesh
 import Theme
+import GLState
 
 import OpenGL.GL as gl
 import math
@@ -31,6 +32,29 @@ import numpy
 
 KEYS = [Player.KEY1, Player.KEY2, Player.KEY3, Player.KEY4, Player.KEY5]
 
+# Vertex coefficients of the waveform amplitudes at the near and far ends of
+# a waveform step, and of the step length
+WAVEFORM_A1 = numpy.array([-1, 0, 0, 0, 1, 0, 0,  0], numpy.float32)
+WAVEFORM_A2 = numpy.array([ 0,-1, 0, 0, 0, 1, 1, -1], numpy.float32)
+WAVEFORM_Z  = numpy.array([ 0, 1, 0, 1, 0, 1, 1,  1], numpy.float32)
+
+# Corners of the textured quads in the order they are drawn
+QUAD_X         = numpy.array([-1, 1, 1, -1], numpy.float32)
+QUAD_Z         = numpy.array([ 0, 0, 1,  1], numpy.float32)
+QUAD_TEXCOORDS = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1)], numpy.float32)
+BAR_Z          = numpy.array([ 1, 1, -1, -1], numpy.float32)
+
+# Note mesh parts as (name, color shade, tappable notes only) in drawing order
+NOTE_PARTS = [
+    ("Mesh_001", 1.0,  False),
+    ("Mesh_003", 1.0,  True),
+    ("Mesh",     .75,  False),
+    ("Mesh_002", .25,  False),
+]
+
+# The fret keys are consecutive bits of the control flags
+KEY_SHIFT = Player.KEY1.bit_length() - 1
+
 class Guitar(object):
     def __init__(self, engine, editorMode = False):
         self.engine         = engine
@@ -42,6 +66,7 @@ class Guitar(object):
         self.fretActivity   = [0.0] * self.strings
         self.fretColors     = Theme.fretColors
         self.playedNotes    = []
+        self.noteScheduler  = None
         self.editorMode     = editorMode
         self.selectedString = 0
         self.time           = 0.0
@@ -53,8 +78,17 @@ class Guitar(object):
         self.lastBpmChange  = -1.0
         self.baseBeat       = 0.0
         self.setBPM(self.currentBpm)
+
+        # The state of the previous run is kept for interpolating the
+        # rendered state between two fixed simulation steps
+        self.previousFretWeight   = self.fretWeight[:]
+        self.previousFretActivity = self.fretActivity[:]
+        self.previousBpm          = self.currentBpm
+        self.interpolation        = 1.0
         self.vertexCache    = numpy.empty((8 * 4096, 3), numpy.float32)
         self.colorCache     = numpy.empty((8 * 4096, 4), numpy.float32)
+        self.waveformSteps  = numpy.arange(513, dtype = numpy.float64)
+        self.createHighwayArrays()
 
         engine.resource.load(self,  "noteMesh", lambda: Mesh(engine.resource.fileName("note.dae")))
         engine.resource.load(self,  "keyMesh",  lambda: Mesh(engine.resource.fileName("key.dae")))
@@ -80,50 +114,102 @@ class Guitar(object):
         self.bpm               = bpm
         self.baseBeat          = 0.0
 
+    def createHighwayArrays(self):
+        """
+        Build the vertex arrays of the neck, the strings and the beat bars.
+        Only the parts that change between frames are updated when rendering.
+        """
+        w = self.boardWidth
+        l = self.boardLength
+
+        # The neck texture coordinates are offset with the texture matrix when the neck scrolls
+        z = numpy.array([-2, -1, l * .7, l], numpy.float32)
+        self.neckVertices           = numpy.zeros((8, 3), numpy.float32)
+        self.neckVertices[0::2, 0]  = -w / 2
+        self.neckVertices[1::2, 0]  =  w / 2
+        self.neckVertices[:, 2]     = numpy.repeat(z, 2)
+        self.neckTexCoords          = numpy.zeros((8, 2), numpy.float32)
+        self.neckTexCoords[1::2, 0] = 1.0
+        self.neckTexCoords[:, 1]    = .5 * self.neckVertices[:, 2]
+        self.neckColors             = numpy.ones((8, 4), numpy.float32)
+
+        # The neck fades in and out at the ends
+        self.neckColors[0:2, 3]     = 0.0
+        self.neckColors[6:8, 3]     = 0.0
+
+        # The strings are drawn from the last to the first one
+        sw = 0.035
+        x  = (numpy.arange(self.strings - 1, -1, -1) - self.strings / 2) * (w / self.strings)
+        self.stringVertices          = numpy.zeros((self.strings, 4, 3), numpy.float32)
+        self.stringVertices[:, :, 0] = x[:, numpy.newaxis] + QUAD_X * sw
+        self.stringVertices[:, :, 2] = QUAD_Z * (l + 2) - 2
+        self.stringTexCoords         = numpy.tile(QUAD_TEXCOORDS, (self.strings, 1))
+        self.stringHeights           = -2.0 ** numpy.arange(self.strings)
+
+        self.barVertices = None
+        self.reserveBars(64)
+
+    def reserveBars(self, count):
+        """
+        Make room for a number of beat bars in the bar vertex arrays. The
+        arrays have room for one more bar for the bar at the current position.
+
+        @param count:   Number of beat bars
+        """
+        if self.barVertices is not None and len(self.barVertices) > count:
+            return
+        self.barVertices  = numpy.zeros((count + 1, 4, 3), numpy.float32)
+        self.barColors    = numpy.zeros((count + 1, 4, 4), numpy.float32)
+        self.barTexCoords = numpy.tile(QUAD_TEXCOORDS, (count + 1, 1))
+
+    def drawArrays(self, mode, vertices, texCoords, colors = None, count = None):
+        """
+        Draw textured vertex arrays.
+
+        @param mode:        Primitive type
+        @param vertices:    Vertex array
+        @param texCoords:   Texture coordinate array
+        @param colors:      Color array or None to use the current color
+        @param count:       Number of vertices to draw or None to draw all of them
+        """
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, vertices)
+        gl.glTexCoordPointer(2, gl.GL_FLOAT, 0, texCoords)
+        if colors is not None:
+            gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+            gl.glColorPointer(4, gl.GL_FLOAT, 0, colors)
+        if count is None:
+            count = len(vertices.reshape((-1, 3)))
+        GLState.drawArrays(mode, 0, count)
+        if colors is not None:
+            gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+
     def renderNeck(self, visibility, song, pos):
         if not song:
             return
 
-        def project(beat):
-            return .5 * beat / beatsPerUnit
-
-        v            = visibility
-        w            = self.boardWidth
-        l            = self.boardLength
         beatsPerUnit = self.beatsPerBoard / self.boardLength
-        offset       = (pos - self.lastBpmChange) / self.currentPeriod + self.baseBeat
+        offset       = song.tempoMap.timeToBeats(pos)
+
+        self.neckColors[2:6, 3] = visibility
 
-        gl.glEnable(gl.GL_TEXTURE_2D)
+        GLState.enable(gl.GL_TEXTURE_2D)
         self.neckDrawing.texture.bind()
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT)
 
-        gl.glBegin(gl.GL_TRIANGLE_STRIP)
-        gl.glColor4f(1, 1, 1, 0)
-        gl.glTexCoord2f(0.0, project(offset - 2 * beatsPerUnit))
-        gl.glVertex3f(-w / 2, 0, -2)
-        gl.glTexCoord2f(1.0, project(offset - 2 * beatsPerUnit))
-        gl.glVertex3f( w / 2, 0, -2)
-
-        gl.glColor4f(1, 1, 1, v)
-        gl.glTexCoord2f(0.0, project(offset - 1 * beatsPerUnit))
-        gl.glVertex3f(-w / 2, 0, -1)
-        gl.glTexCoord2f(1.0, project(offset - 1 * beatsPerUnit))
-        gl.glVertex3f( w / 2, 0, -1)
-
-        gl.glTexCoord2f(0.0, project(offset + l * beatsPerUnit * .7))
-        gl.glVertex3f(-w / 2, 0, l * .7)
-        gl.glTexCoord2f(1.0, project(offset + l * beatsPerUnit * .7))
-        gl.glVertex3f( w / 2, 0, l * .7)
-
-        gl.glColor4f(1, 1, 1, 0)
-        gl.glTexCoord2f(0.0, project(offset + l * beatsPerUnit))
-        gl.glVertex3f(-w / 2, 0, l)
-        gl.glTexCoord2f(1.0, project(offset + l * beatsPerUnit))
-        gl.glVertex3f( w / 2, 0, l)
-        gl.glEnd()
-
-        gl.glDisable(gl.GL_TEXTURE_2D)
+        # The texture repeats, so only the fraction of the offset matters
+        gl.glMatrixMode(gl.GL_TEXTURE)
+        gl.glPushMatrix()
+        gl.glTranslatef(0, (.5 * offset / beatsPerUnit) % 1.0, 0)
+        self.drawArrays(gl.GL_TRIANGLE_STRIP, self.neckVertices, self.neckTexCoords, self.neckColors)
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+
+        GLState.disable(gl.GL_TEXTURE_2D)
 
     def renderTracks(self, visibility):
         w = self.boardWidth / self.strings
@@ -137,281 +223,364 @@ class Guitar(object):
 
             gl.glColor4f(1, 1, 1, .15)
 
-            gl.glBegin(gl.GL_TRIANGLE_STRIP)
+            GLState.begin(gl.GL_TRIANGLE_STRIP, 4)
             gl.glVertex3f(x - s, 0, z1)
             gl.glVertex3f(x + s, 0, z1)
             gl.glVertex3f(x - s, 0, z2)
             gl.glVertex3f(x + s, 0, z2)
-            gl.glEnd()
+            GLState.end()
 
-        sw = 0.035
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        # The strings drop away one after another when the guitar is hidden
+        self.stringVertices[:, :, 1] = (v * self.stringHeights)[:, numpy.newaxis]
+
+        GLState.enable(gl.GL_TEXTURE_2D)
+        GLState.enable(gl.GL_BLEND)
+        GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
         Theme.setBaseColor(1 - v)
         self.stringDrawing.texture.bind()
-        for n in range(self.strings - 1, -1, -1):
-            gl.glBegin(gl.GL_TRIANGLE_STRIP)
-            gl.glTexCoord2f(0.0, 0.0)
-            gl.glVertex3f((n - self.strings / 2) * w - sw, -v, -2)
-            gl.glTexCoord2f(1.0, 0.0)
-            gl.glVertex3f((n - self.strings / 2) * w + sw, -v, -2)
-            gl.glTexCoord2f(0.0, 1.0)
-            gl.glVertex3f((n - self.strings / 2) * w - sw, -v, self.boardLength)
-            gl.glTexCoord2f(1.0, 1.0)
-            gl.glVertex3f((n - self.strings / 2) * w + sw, -v, self.boardLength)
-            gl.glEnd()
-            v *= 2
-        gl.glDisable(gl.GL_TEXTURE_2D)
+        self.drawArrays(gl.GL_QUADS, self.stringVertices, self.stringTexCoords)
+        GLState.disable(gl.GL_TEXTURE_2D)
 
     def renderBars(self, visibility, song, pos):
         if not song:
             return
 
         w            = self.boardWidth
+        l            = self.boardLength
         v            = 1.0 - visibility
         sw           = 0.04
         beatsPerUnit = self.beatsPerBoard / self.boardLength
-        pos         -= self.lastBpmChange
-        offset       = pos / self.currentPeriod * beatsPerUnit
-        currentBeat  = pos / self.currentPeriod
-        beat         = int(currentBeat)
-
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-        gl.glEnable(gl.GL_TEXTURE_2D)
+        tempoMap     = song.tempoMap
+        beat         = int(tempoMap.timeToBeats(pos))
+
+        if self.editorMode:
+            step = 1.0 / 4.0
+        else:
+            step = 1.0
+
+        # Place the bars like the notes so that they stay in sync over tempo changes
+        endBeat = tempoMap.timeToBeats(pos + l * beatsPerUnit * self.currentPeriod)
+        beats   = beat + step * numpy.arange(max(0, int((endBeat - beat) / step)) + 2)
+        z       = ((tempoMap.beatsToTimes(beats) - pos) / self.currentPeriod) / beatsPerUnit
+        count   = int(z.searchsorted(l))
+        beats   = beats[:count]
+        z       = z[:count]
+
+        c = numpy.ones(count)
+        c[z > l * .8] = (l - z[z > l * .8]) / (l * .2)
+        c[z < 0]      = numpy.maximum(0, 1 + z[z < 0])
+        c *= numpy.where(beats % 1.0 < 0.001, .75, .5) * visibility
+
+        self.reserveBars(count)
+        vertices = self.barVertices[:count + 1]
+        colors   = self.barColors[:count + 1]
+
+        # The bars are fanned out with an increasing rotation when the guitar is hidden
+        angle = numpy.radians(v * 90 * numpy.arange(1, count + 1))[:, numpy.newaxis]
+        x     = QUAD_X * (w / 2)
+        vertices[:count, :, 0] = x * numpy.cos(angle) + v * numpy.sin(angle)
+        vertices[:count, :, 1] = x * numpy.sin(angle) - v * numpy.cos(angle)
+        vertices[:count, :, 2] = z[:, numpy.newaxis] + BAR_Z * sw
+        colors[:count, :, :3]  = Theme.baseColor
+        colors[:count, :, 3]   = c[:, numpy.newaxis]
+
+        # The last bar marks the current position
+        vertices[count, :, 0]  = x
+        vertices[count, :, 1]  = 0
+        vertices[count, :, 2]  = BAR_Z * sw
+        colors[count, :, :3]   = Theme.selectedColor
+        colors[count, :, 3]    = visibility * .5
+
+        GLState.enable(gl.GL_BLEND)
+        GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        GLState.enable(gl.GL_TEXTURE_2D)
         self.barDrawing.texture.bind()
+        self.drawArrays(gl.GL_QUADS, vertices, self.barTexCoords, colors, (count + 1) * 4)
+        GLState.disable(gl.GL_TEXTURE_2D)
 
-        gl.glPushMatrix()
-        while beat < currentBeat + self.beatsPerBoard:
-            z = (beat - currentBeat) / beatsPerUnit
+    def renderNoteTails(self, offsets, lengths, colors):
+        """
+        Draw the tails of a batch of notes with a single call.
 
-            if z > self.boardLength * .8:
-                c = (self.boardLength - z) / (self.boardLength * .2)
-            elif z < 0:
-                c = max(0, 1 + z)
-            else:
-                c = 1.0
+        @param offsets:   Note positions as an (n, 3) array
+        @param lengths:   Tail lengths
+        @param colors:    Note colors as an (n, 4) array
+        """
+        n = len(offsets)
+        if not n:
+            return
 
-            gl.glRotate(v * 90, 0, 0, 1)
+        vertices = numpy.empty((n, 4, 3), numpy.float32)
+        vertices[:]        = offsets[:, numpy.newaxis, :]
+        vertices[:, :, 0] += QUAD_X * .1
+        vertices[:, :, 2] += numpy.outer(lengths + 0.00001, QUAD_Z)
+        texcoords = numpy.tile(QUAD_TEXCOORDS, (n, 1))
+        colors    = numpy.repeat(colors.astype(numpy.float32), 4, axis = 0)
 
-            if (beat % 1.0) < 0.001:
-                Theme.setBaseColor(visibility * c * .75)
-            else:
-                Theme.setBaseColor(visibility * c * .5)
-
-            gl.glBegin(gl.GL_TRIANGLE_STRIP)
-            gl.glTexCoord2f(0.0, 0.0)
-            gl.glVertex3f(-(w / 2), -v, z + sw)
-            gl.glTexCoord2f(0.0, 1.0)
-            gl.glVertex3f(-(w / 2), -v, z - sw)
-            gl.glTexCoord2f(1.0, 0.0)
-            gl.glVertex3f(w / 2,    -v, z + sw)
-            gl.glTexCoord2f(1.0, 1.0)
-            gl.glVertex3f(w / 2,    -v, z - sw)
-            gl.glEnd()
-
-            if self.editorMode:
-                beat += 1.0 / 4.0
-            else:
-                beat += 1
-        gl.glPopMatrix()
+        GLState.enable(gl.GL_TEXTURE_2D)
+        self.noteDrawing.texture.bind()
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, vertices)
+        gl.glTexCoordPointer(2, gl.GL_FLOAT, 0, texcoords)
+        gl.glColorPointer(4, gl.GL_FLOAT, 0, colors)
+        GLState.drawArrays(gl.GL_QUADS, 0, n * 4)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+        GLState.disable(gl.GL_TEXTURE_2D)
 
-        Theme.setSelectedColor(visibility * .5)
-        gl.glBegin(gl.GL_TRIANGLE_STRIP)
-        gl.glTexCoord2f(0.0, 0.0)
-        gl.glVertex3f(-w / 2, 0,  sw)
-        gl.glTexCoord2f(0.0, 1.0)
-        gl.glVertex3f(-w / 2, 0, -sw)
-        gl.glTexCoord2f(1.0, 0.0)
-        gl.glVertex3f(w / 2,  0,  sw)
-        gl.glTexCoord2f(1.0, 1.0)
-        gl.glVertex3f(w / 2,  0, -sw)
-        gl.glEnd()
-
-        gl.glDisable(gl.GL_TEXTURE_2D)
-
-    def renderNote(self, length, color, flat = False, tailOnly = False, isTappable = False):
-        if not self.noteMesh:
-            return
+    def renderNoteHeads(self, offsets, colors, flat, tappable):
+        """
+        Draw the note meshes of a batch of notes with one call per mesh part.
 
-        gl.glColor4f(*color)
-        gl.glEnable(gl.GL_TEXTURE_2D)
-        self.noteDrawing.texture.bind()
+        Fixed function OpenGL has no instancing, so the mesh parts are
+        expanded on the CPU: every note gets a copy of the part vertices
+        moved to the note position, and flat notes are squashed vertically.
 
-        if flat:
-            gl.glScalef(1, .1, 1)
-
-        size = (.1, length + 0.00001)
-        gl.glBegin(gl.GL_TRIANGLE_STRIP)
-        gl.glTexCoord2f(0.0, 0.0)
-        gl.glVertex3f(-size[0], 0, 0)
-        gl.glTexCoord2f(1.0, 0.0)
-        gl.glVertex3f( size[0], 0, 0)
-        gl.glTexCoord2f(0.0, 1.0)
-        gl.glVertex3f(-size[0], 0, size[1])
-        gl.glTexCoord2f(1.0, 1.0)
-        gl.glVertex3f( size[0], 0, size[1])
-        gl.glEnd()
-        gl.glDisable(gl.GL_TEXTURE_2D)
-
-        if tailOnly:
+        @param offsets:   Note positions as an (n, 3) array
+        @param colors:    Note colors as an (n, 4) array
+        @param flat:      Boolean array of notes to squash
+        @param tappable:  Boolean array of notes to draw with the tappable marker
+        """
+        if not len(offsets):
             return
 
-        gl.glPushMatrix()
-        gl.glEnable(gl.GL_DEPTH_TEST)
-        gl.glDepthMask(1)
-        if color[3] > .9:
-            gl.glDisable(gl.GL_BLEND)
+        GLState.enable(gl.GL_DEPTH_TEST)
+        GLState.depthMask(1)
         gl.glShadeModel(gl.GL_SMOOTH)
-        self.noteMesh.render("Mesh_001")
-        if isTappable:
-            self.noteMesh.render("Mesh_003")
-        gl.glColor4f(.75 * color[0], .75 * color[1], .75 * color[2], color[3])
-        self.noteMesh.render("Mesh")
-        gl.glColor4f(.25 * color[0], .25 * color[1], .25 * color[2], color[3])
-        self.noteMesh.render("Mesh_002")
-        gl.glDepthMask(0)
-        gl.glPopMatrix()
-        gl.glEnable(gl.GL_BLEND)
+        self.noteMesh.setupLights()
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_NORMAL_ARRAY)
+        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+
+        for part, shade, selected in NOTE_PARTS:
+            vertices, normals = self.noteMesh.getGeometry(part)
+            m = len(vertices)
+            if selected:
+                notes = tappable
+            else:
+                notes = numpy.ones(len(offsets), bool)
+            n = int(notes.sum())
+            if not n or not m:
+                continue
+
+            squashed = flat[notes]
+            v = numpy.empty((n, m, 3), numpy.float32)
+            v[:] = vertices
+            v[squashed, :, 1] *= .1
+            v += offsets[notes][:, numpy.newaxis, :]
+
+            # The normals of the squashed notes are transformed like OpenGL would do it
+            nv = numpy.empty((n, m, 3), numpy.float32)
+            nv[:] = normals
+            nv[squashed, :, 1] *= 10.0
+
+            c = colors[notes].astype(numpy.float32)
+            c[:, :3] *= shade
+            c = numpy.repeat(c, m, axis = 0)
+
+            gl.glVertexPointer(3, gl.GL_FLOAT, 0, v)
+            gl.glNormalPointer(gl.GL_FLOAT, 0, nv)
+            gl.glColorPointer(4, gl.GL_FLOAT, 0, c)
+            GLState.drawArrays(gl.GL_TRIANGLES, 0, n * m)
+
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glDisableClientState(gl.GL_NORMAL_ARRAY)
+        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+        self.noteMesh.disableLights()
+        GLState.depthMask(0)
+
+    def getVisibleNotes(self, visibility, track, indices, pos, beatsPerUnit):
+        """
+        Compute the placement and the look of the visible notes.
+
+        @param visibility:    Guitar visibility
+        @param track:         L{Track} of the notes
+        @param indices:       Indices of the visible notes in the track columns
+        @param pos:           Song position
+        @param beatsPerUnit:  Beats per board unit
+        @return:              (offsets, lengths, colors, flat, head, tappable)
+                              tuple of arrays with one element per note
+        """
+        times   = track.times[indices]
+        lengths = track.lengths[indices]
+        numbers = track.numbers[indices].astype(numpy.int32)
+        l       = self.boardLength
+        w       = self.boardWidth / self.strings
+
+        z  = ((times - pos) / self.currentPeriod) / beatsPerUnit
+        z2 = ((times + lengths - pos) / self.currentPeriod) / beatsPerUnit
+
+        f      = numpy.ones(len(indices))
+        far    = z > l * .8
+        behind = z < 0
+        f[far]    = (l - z[far]) / (l * .2)
+        f[behind] = numpy.clip(1 + z2[behind], 0, 1)
+
+        fretColors     = numpy.array([c[:3] for c in self.fretColors])
+        colors         = numpy.empty((len(indices), 4))
+        colors[:, :3]  = .1 + .8 * fretColors[numbers]
+        colors[:, 3]   = visibility * f
+        lengths        = lengths / self.currentPeriod / beatsPerUnit
+
+        # Clip the played notes to the origin and flatten the missed ones
+        played = numpy.zeros(len(indices), bool)
+        played[behind] = [event.played for event in track.objects[indices[behind]]]
+        tailOnly = behind & played
+        flat     = behind & ~played
+        lengths[tailOnly] += z[tailOnly]
+        z[tailOnly]        = 0
+        colors[flat, :3]   = .2 + .4
+        colors[flat, 3]   *= .5
+
+        shown   = ~tailOnly | (lengths > 0)
+        offsets = numpy.empty((len(indices), 3), numpy.float32)
+        offsets[:, 0] = (self.strings / 2 - numbers) * w
+        offsets[:, 1] = (1.0 - visibility) ** (numbers + 1)
+        offsets[:, 2] = z
+
+        tappable = (track.flags[indices] & FLAG_TAPPABLE) != 0
+        return (offsets[shown], lengths[shown], colors[shown], flat[shown],
+                ~tailOnly[shown], tappable[shown])
 
     def renderNotes(self, visibility, song, pos):
         if not song:
             return
 
         # Update dynamic period
-        self.currentPeriod = 60000.0 / self.currentBpm
+        self.currentPeriod = 60000.0 / self.interpolate(self.previousBpm, self.currentBpm)
         self.targetPeriod  = 60000.0 / self.targetBpm
 
         beatsPerUnit = self.beatsPerBoard / self.boardLength
-        w = self.boardWidth / self.strings
         track = song.track
 
-        for time, event in track.getEvents(pos - self.currentPeriod * 2, pos + self.currentPeriod * self.beatsPerBoard):
-            if isinstance(event, Tempo):
-                if (pos - time > self.currentPeriod or self.lastBpmChange < 0) and time > self.lastBpmChange:
-                    self.baseBeat         += (time - self.lastBpmChange) / self.currentPeriod
-                    self.targetBpm         = event.bpm
-                    self.lastBpmChange     = time
-                continue
-
-            if not isinstance(event, Note):
-                continue
-
-            c = self.fretColors[event.number]
-
-            x  = (self.strings / 2 - event.number) * w
-            z  = ((time - pos) / self.currentPeriod) / beatsPerUnit
-            z2 = ((time + event.length - pos) / self.currentPeriod) / beatsPerUnit
-
-            if z > self.boardLength * .8:
-                f = (self.boardLength - z) / (self.boardLength * .2)
-            elif z < 0:
-                f = min(1, max(0, 1 + z2))
-            else:
-                f = 1.0
-
-            color      = (.1 + .8 * c[0], .1 + .8 * c[1], .1 + .8 * c[2], 1 * visibility * f)
-            length     = event.length / self.currentPeriod / beatsPerUnit
-            flat       = False
-            tailOnly   = False
-            isTappable = event.tappable
-
-            # Clip the played notes to the origin
-            if z < 0:
-                if event.played:
-                    tailOnly = True
-                    length += z
-                    z = 0
-                    if length <= 0:
-                        continue
-                else:
-                    color = (.2 + .4, .2 + .4, .2 + .4, .5 * visibility * f)
-                    flat  = True
-
-            gl.glPushMatrix()
-            gl.glTranslatef(x, (1.0 - visibility) ** (event.number + 1), z)
-            self.renderNote(length, color = color, flat = flat, tailOnly = tailOnly, isTappable = isTappable)
-            gl.glPopMatrix()
+        startTime   = pos - self.currentPeriod * 2
+        endTime     = pos + self.currentPeriod * self.beatsPerBoard
+        first, last = track.getOverlappingRange(startTime, endTime)
+        visible     = track.ends[first:last] >= startTime
+        kinds       = track.kinds[first:last]
+
+        for i in (numpy.flatnonzero(visible & (kinds == EVENT_TEMPO)) + first).tolist():
+            time  = float(track.times[i])
+            event = track.objects[i]
+            if (pos - time > self.currentPeriod or self.lastBpmChange < 0) and time > self.lastBpmChange:
+                self.baseBeat         += (time - self.lastBpmChange) / self.currentPeriod
+                self.targetBpm         = event.bpm
+                self.lastBpmChange     = time
+
+        indices = numpy.flatnonzero(visible & (kinds == EVENT_NOTE)) + first
+        if len(indices) and self.noteMesh:
+            offsets, lengths, colors, flat, head, tappable = self.getVisibleNotes(visibility, track, indices, pos, beatsPerUnit)
+            self.renderNoteTails(offsets, lengths, colors)
+            self.renderNoteHeads(offsets[head], colors[head], flat[head], tappable[head])
 
         # Draw a waveform shape over the currently playing notes
-        vertices = self.vertexCache
-        colors   = self.colorCache
-
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
-        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
-        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-        gl.glVertexPointer(3, gl.GL_FLOAT, 0, vertices)
-        gl.glColorPointer(4, gl.GL_FLOAT, 0, colors)
-
+        count = 0
         for time, event in self.playedNotes:
-            t     = time + event.length
-            dt    = t - pos
-            proj  = 1.0 / self.currentPeriod / beatsPerUnit
-
-            # Increase these values to improve performance
-            step1 = dt * proj * 25
-            step2 = 10.0
-
-            if dt < 1e-3:
-                continue
-
-            dStep = (step2 - step1) / dt
-            x     = (self.strings / 2 - event.number) * w
-            c     = self.fretColors[event.number]
-            s     = t
-            step  = step1
-
-            vertexCount    = 0
-
-            def waveForm(t):
-                u = ((t - time) * -.1 + pos - time) / 64.0 + .0001
-                return (math.sin(event.number + self.time * -.01 + t * .03) + math.cos(event.number + self.time * .01 + t * .02)) * .1 + .1 + math.sin(u) / (5 * u)
-
-            i     = 0
-            a1    = 0.0
-            zStep = step * proj
-
-            while t > time and t - step > pos and i < len(vertices) / 8:
-                z  = (t - pos) * proj
-                a2 = waveForm(t - step)
-
-                colors[i    ]   = \
-                colors[i + 1]   = (c[0], c[1], c[2], .5)
-                colors[i + 2]   = \
-                colors[i + 3]   = (1, 1, 1, .75)
-                colors[i + 4]   = \
-                colors[i + 5]   = \
-                colors[i + 6]   = \
-                colors[i + 7]   = (c[0], c[1], c[2], .5)
-                vertices[i    ] = (x - a1, 0, z)
-                vertices[i + 1] = (x - a2, 0, z - zStep)
-                vertices[i + 2] = (x, 0, z)
-                vertices[i + 3] = (x, 0, z - zStep)
-                vertices[i + 4] = (x + a1, 0, z)
-                vertices[i + 5] = (x + a2, 0, z - zStep)
-                vertices[i + 6] = (x + a2, 0, z - zStep)
-                vertices[i + 7] = (x - a2, 0, z - zStep)
-
-                i    += 8
-                t    -= step
-                a1    = a2
-                step  = step1 + dStep * (s - t)
-                zStep = step * proj
-
-            gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, i)
-        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
-        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+            count = self.updateWaveform(count, time, event, pos, beatsPerUnit)
+
+        if count:
+            GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
+            gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+            gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+            gl.glVertexPointer(3, gl.GL_FLOAT, 0, self.vertexCache)
+            gl.glColorPointer(4, gl.GL_FLOAT, 0, self.colorCache)
+            GLState.drawArrays(gl.GL_TRIANGLE_STRIP, 0, count)
+            gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+            gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+            GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+    def updateWaveform(self, offset, time, event, pos, beatsPerUnit):
+        """
+        Append the waveform of a played note to the vertex and color caches.
+
+        The waveform is a triangle strip of eight vertices per step, drawn
+        from the end of the note towards the current position. The steps
+        start short at the end of the note and grow linearly with the
+        distance, so the distances of the step boundaries form a geometric
+        series that can be computed for all the steps at once. Successive
+        waveforms are joined with degenerate triangles so that all of them
+        can be drawn with a single call.
+
+        @param offset:        Number of vertices already in the caches
+        @param time:          Note start time
+        @param event:         Played L{Note}
+        @param pos:           Song position
+        @param beatsPerUnit:  Beats per board unit
+        @return:              Number of vertices in the caches
+        """
+        t    = time + event.length
+        dt   = t - pos
+        proj = 1.0 / self.currentPeriod / beatsPerUnit
+
+        if dt < 1e-3:
+            return offset
+
+        # Increase these values to improve performance
+        step1 = dt * proj * 25
+        step2 = 10.0
+        dStep = (step2 - step1) / dt
+
+        # Leave room for joining the strips
+        join      = offset and 2 or 0
+        available = min((len(self.vertexCache) - offset - join) / 8, len(self.waveformSteps) - 1)
+        if available <= 0:
+            return offset
+
+        # Distances of the step boundaries from the end of the note
+        k = self.waveformSteps[:available + 1]
+        if abs(dStep) < 1e-9:
+            d = step1 * k
+        else:
+            # The far boundaries may overflow, but they are never reached
+            with numpy.errstate(over = "ignore"):
+                d = step1 * ((1.0 + dStep) ** k - 1.0) / dStep
+
+        # The steps go on while they are inside the note and ahead of the current position
+        valid = (d[:-1] < event.length) & (d[1:] < dt)
+        steps = valid.all() and len(valid) or int(valid.argmin())
+        if not steps:
+            return offset
+
+        ts = t - d[:steps + 1]
+        u  = ((ts - time) * -.1 + pos - time) / 64.0 + .0001
+        n  = event.number
+        a  = (numpy.sin(n + self.time * -.01 + ts * .03) + numpy.cos(n + self.time * .01 + ts * .02)) * .1 + .1 + numpy.sin(u) / (5 * u)
+        a[0] = 0.0
+
+        x      = (self.strings / 2 - n) * (self.boardWidth / self.strings)
+        z      = (ts[:-1] - pos) * proj
+        zStep  = (ts[:-1] - ts[1:]) * proj
+        start  = offset + join
+        end    = start + steps * 8
+
+        vertices = self.vertexCache[start:end].reshape((steps, 8, 3))
+        vertices[:, :, 0] = x + numpy.outer(a[:-1], WAVEFORM_A1) + numpy.outer(a[1:], WAVEFORM_A2)
+        vertices[:, :, 1] = 0.0
+        vertices[:, :, 2] = z[:, numpy.newaxis] - numpy.outer(zStep, WAVEFORM_Z)
+
+        c = self.fretColors[event.number]
+        colors = self.colorCache[start:end].reshape((steps, 8, 4))
+        colors[:] = (c[0], c[1], c[2], .5)
+        colors[:, 2:4] = (1, 1, 1, .75)
+
+        if join:
+            self.vertexCache[offset]     = self.vertexCache[offset - 1]
+            self.vertexCache[offset + 1] = self.vertexCache[start]
+            self.colorCache[offset:start] = 0.0
+
+        return end
 
     def renderFrets(self, visibility, song, controls):
         w = self.boardWidth / self.strings
         v = 1.0 - visibility
 
-        gl.glEnable(gl.GL_DEPTH_TEST)
+        GLState.enable(gl.GL_DEPTH_TEST)
 
         for n in range(self.strings):
-            f = self.fretWeight[n]
+            f = self.interpolate(self.previousFretWeight[n], self.fretWeight[n])
             c = self.fretColors[n]
 
             if f and (controls.getState(Player.ACTION1) or controls.getState(Player.ACTION2)):
@@ -424,7 +593,7 @@ class Guitar(object):
             if self.keyMesh:
                 gl.glPushMatrix()
                 gl.glTranslatef(x, y + v * 6, 0)
-                gl.glDepthMask(1)
+                GLState.depthMask(1)
                 gl.glEnable(gl.GL_LIGHTING)
                 gl.glEnable(gl.GL_LIGHT0)
                 gl.glShadeModel(gl.GL_SMOOTH)
@@ -437,18 +606,18 @@ class Guitar(object):
                 self.keyMesh.render()
                 gl.glDisable(gl.GL_LIGHTING)
                 gl.glDisable(gl.GL_LIGHT0)
-                gl.glDepthMask(0)
+                GLState.depthMask(0)
                 gl.glPopMatrix()
 
-            f = self.fretActivity[n]
+            f = self.interpolate(self.previousFretActivity[n], self.fretActivity[n])
 
             if f:
-                gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
+                GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
                 s = 0.0
                 self.glowDrawing.texture.bind()
 
-                gl.glEnable(gl.GL_TEXTURE_2D)
-                gl.glDisable(gl.GL_DEPTH_TEST)
+                GLState.enable(gl.GL_TEXTURE_2D)
+                GLState.disable(gl.GL_DEPTH_TEST)
                 gl.glPushMatrix()
                 gl.glTranslate(x, y, 0)
                 gl.glRotate(f + self.time * .1, 0, 1, 0)
@@ -462,7 +631,7 @@ class Guitar(object):
                 while s < .5:
                     ms = (1 - s) * f * t * .25 + .75
                     gl.glColor3f(c[0] * ms, c[1] * ms, c[2] * ms)
-                    gl.glBegin(gl.GL_TRIANGLE_STRIP)
+                    GLState.begin(gl.GL_TRIANGLE_STRIP, 4)
                     gl.glTexCoord2f(0.0, 0.0)
                     gl.glVertex3f(-size[0] * f, 0, -size[1] * f)
                     gl.glTexCoord2f(1.0, 0.0)
@@ -471,25 +640,25 @@ class Guitar(object):
                     gl.glVertex3f(-size[0] * f, 0,  size[1] * f)
                     gl.glTexCoord2f(1.0, 1.0)
                     gl.glVertex3f( size[0] * f, 0,  size[1] * f)
-                    gl.glEnd()
+                    GLState.end()
                     gl.glTranslatef(0, ms * .2, 0)
                     gl.glScalef(.8, 1, .8)
                     gl.glRotate(ms * 20, 0, 1, 0)
                     s += 0.2
 
                 gl.glPopMatrix()
-                gl.glEnable(gl.GL_DEPTH_TEST)
+                GLState.enable(gl.GL_DEPTH_TEST)
 
-                gl.glDisable(gl.GL_TEXTURE_2D)
-                gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+                GLState.disable(gl.GL_TEXTURE_2D)
+                GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
             v *= 1.5
-        gl.glDisable(gl.GL_DEPTH_TEST)
+        GLState.disable(gl.GL_DEPTH_TEST)
 
     def render(self, visibility, song, pos, controls):
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-        gl.glEnable(gl.GL_COLOR_MATERIAL)
+        GLState.enable(gl.GL_BLEND)
+        GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        GLState.enable(gl.GL_COLOR_MATERIAL)
         if self.leftyMode:
             gl.glScalef(-1, 1, 1)
 
@@ -501,63 +670,39 @@ class Guitar(object):
         if self.leftyMode:
             gl.glScalef(-1, 1, 1)
 
+    def getNoteScheduler(self, song):
+        track = song.track
+        if not self.noteScheduler or self.noteScheduler.track is not track:
+            self.noteScheduler = NoteScheduler(track)
+        return self.noteScheduler
+
     def getMissedNotes(self, song, pos):
         if not song:
             return
 
-        m1      = self.lateMargin
-        m2      = self.lateMargin * 2
-        track   = song.track
-        notes   = [(time, event) for time, event in track.getEvents(pos - m1, pos - m2) if isinstance(event, Note)]
-        notes   = [(time, event) for time, event in notes if (time >= (pos - m2)) and (time <= (pos - m1))]
-        notes   = [(time, event) for time, event in notes if not event.played]
-
-        return notes
+        return self.getNoteScheduler(song).getMissedNotes(pos, self.lateMargin)
 
     def getRequiredNotes(self, song, pos):
-        track = song.track
-        notes = [(time, event) for time, event in track.getEvents(pos - self.lateMargin, pos + self.earlyMargin) if isinstance(event, Note)]
-        notes = [(time, event) for time, event in notes if not event.played]
-        notes = [(time, event) for time, event in notes if (time >= (pos - self.lateMargin)) and (time <= (pos + self.earlyMargin))]
-        if notes:
-            t     = min([time for time, event in notes])
-            notes = [(time, event) for time, event in notes if time - t < 1e-3]
-        return notes
+        return self.getNoteScheduler(song).getRequiredNotes(pos, self.earlyMargin, self.lateMargin)
 
     def controlsMatchNotes(self, controls, notes):
-        result = True
-
         # no notes?
         if not notes:
-            result = False
+            return False
 
-        # check each valid chord
-        chords = {}
+        # Each note carries the masks of its chord. The lower frets can be
+        # held down, since they are not part of the match mask.
+        frets = (controls.flags >> KEY_SHIFT) & CHORD_MASK
         for time, note in notes:
-            if not time in chords:
-                chords[time] = []
-            chords[time].append((time, note))
-
-        for notes in chords.values():
-            # matching keys?
-            requiredKeys = [note.number for time, note in notes]
-
-            for n, k in enumerate(KEYS):
-                if n in requiredKeys and not controls.getState(k):
-                    result = False
-                    break
-                if not n in requiredKeys and controls.getState(k):
-                    # The lower frets can be held down
-                    if n > max(requiredKeys):
-                        result = False
-                        break
-        return result
+            if (frets & note.matchMask) != note.chordMask:
+                return False
+        return True
 
     def areNotesTappable(self, notes):
         if not notes:
             return
         for time, note in notes:
-            if not note.tappable:
+            if not note.chordTappable:
                 return False
         return True
 
@@ -618,8 +763,21 @@ class Guitar(object):
             pickLength = min(pickLength, note.length)
         return pickLength
 
+    def interpolate(self, previous, current):
+        """
+        Interpolate a rendered value between the previous and the current run.
+
+        @param previous:  Value after the previous run
+        @param current:   Value after the current run
+        @return:          Value at the current interpolation point
+        """
+        return previous + (current - previous) * self.interpolation
+
     def run(self, ticks, pos, controls):
         self.time += ticks
+        self.previousFretWeight[:]   = self.fretWeight
+        self.previousFretActivity[:] = self.fretActivity
+        self.previousBpm             = self.currentBpm
 
         # update frets
         if self.editorMode:
@@ -644,8 +802,8 @@ class Guitar(object):
             if pos > time + note.length:
                 return False
 
-        # update bpm
+        # update bpm, the smoothing rate was originally tuned for 80 fps
         diff = self.targetBpm - self.currentBpm
-        self.currentBpm += diff * .03
+        self.currentBpm += diff * (1.0 - .97 ** (ticks / 12.5))
 
         return True
@@ -21,7 +21,7 @@
 #####################################################################
 
 from Scene import Scene
-from Song import Note, TextEvent, PictureEvent, loadSong
+from Song import TextEvent, PictureEvent, loadSong
 from Menu import Menu
 from Guitar import Guitar, KEYS
 from Language import _
@@ -31,6 +31,8 @@ import Data
 import Theme
 import Stage
 import Settings
+import Clock
+import GLState
 
 import math
 import os
@@ -57,8 +59,13 @@ class GuitarScene(Scene):
         self.autoPlay         = False
         self.lastPickPos      = None
         self.lastSongPos      = 0.0
+        self.keyBurstTime     = None
         self.keyBurstTimeout  = None
         self.keyBurstPeriod   = 30
+        self.stepTime         = 2.0
+        self.maxStepLag       = 250.0
+        self.stepLag          = 0.0
+        self.lastFramePos     = 0.0
         self.camera.target    = (0, 0, 4)
         self.camera.origin    = (0, 3, -3)
 
@@ -121,9 +128,7 @@ class GuitarScene(Scene):
 
         # If tapping is disabled, remove the tapping indicators
         if not self.engine.config.get("game", "tapping"):
-            for time, event in self.song.track.getAllEvents():
-                if isinstance(event, Note):
-                    event.tappable = False
+            self.song.track.clearTappable()
 
     def quit(self):
         if self.song:
@@ -157,6 +162,10 @@ class GuitarScene(Scene):
         self.guitar.endPick(0)
         self.song.stop()
 
+        # Start the fixed steps over from the countdown
+        self.stepLag      = 0.0
+        self.lastFramePos = self.getSongPosition()
+
     def run(self, ticks):
         super(GuitarScene, self).run(ticks)
         pos = self.getSongPosition()
@@ -164,30 +173,12 @@ class GuitarScene(Scene):
         # update song
         if self.song:
             # update stage
-            self.stage.run(pos, self.guitar.currentPeriod)
+            self.stage.run(pos, self.guitar.currentPeriod, self.song.tempoMap)
 
             if self.countdown <= 0 and not self.song.isPlaying() and not self.done:
                 self.goToResults()
                 return
 
-            if self.autoPlay:
-                notes = self.guitar.getRequiredNotes(self.song, pos)
-                notes = [note.number for time, note in notes]
-
-                changed = False
-                held = 0
-                for n, k in enumerate(KEYS):
-                    if n in notes and not self.controls.getState(k):
-                        changed = True
-                        self.controls.toggle(k, True)
-                    elif not n in notes and self.controls.getState(k):
-                        changed = True
-                        self.controls.toggle(k, False)
-                    if self.controls.getState(k):
-                        held += 1
-                if changed and held:
-                    self.doPick()
-
             self.song.update(ticks)
             if self.countdown > 0:
                 self.guitar.setBPM(self.song.bpm)
@@ -199,10 +190,51 @@ class GuitarScene(Scene):
                     self.song.setRhythmVolume(self.rhythmVolume)
                     self.song.play()
 
+        # Run the gameplay in fixed steps regardless of the frame rate. The
+        # song position of each step is interpolated between the positions of
+        # the previous and the current frame, and the guitar is rendered
+        # between its two latest steps.
+        lastPos      = self.lastFramePos
+        self.stepLag = min(self.stepLag + ticks, self.maxStepLag)
+        while self.stepLag >= self.stepTime:
+            self.stepLag -= self.stepTime
+            if ticks:
+                f = max(0.0, 1.0 - self.stepLag / ticks)
+            else:
+                f = 1.0
+            self.runStep(self.stepTime, lastPos + (pos - lastPos) * f)
+        self.lastFramePos         = pos
+        self.guitar.interpolation = self.stepLag / self.stepTime
+
+    def runStep(self, ticks, pos):
+        """
+        Advance the gameplay by one fixed simulation step.
+
+        @param ticks:   Step length in milliseconds
+        @param pos:     Song position at the end of the step
+        """
+        if self.song and self.autoPlay:
+            notes = self.guitar.getRequiredNotes(self.song, pos)
+            notes = [note.number for time, note in notes]
+
+            changed = False
+            held = 0
+            for n, k in enumerate(KEYS):
+                if n in notes and not self.controls.getState(k):
+                    changed = True
+                    self.controls.toggle(k, True)
+                elif not n in notes and self.controls.getState(k):
+                    changed = True
+                    self.controls.toggle(k, False)
+                if self.controls.getState(k):
+                    held += 1
+            if changed and held:
+                self.doPick(pos)
+
         # update board
         if not self.guitar.run(ticks, pos, self.controls):
             # done playing the current notes
-            self.endPick()
+            self.endPick(pos)
 
         # missed some notes?
         if self.guitar.getMissedNotes(self.song, pos) and not self.guitar.playedNotes:
@@ -210,15 +242,62 @@ class GuitarScene(Scene):
             self.player.streak = 0
 
         # late pick
-        if self.keyBurstTimeout is not None and self.engine.timer.delta_time() > self.keyBurstTimeout:
-            self.keyBurstTimeout = None
-            notes = self.guitar.getRequiredNotes(self.song, pos)
-            if self.guitar.controlsMatchNotes(self.controls, notes):
-                self.doPick()
+        self.handleKeyBurst(Clock.getTime())
 
-    def endPick(self):
-        score = self.getExtraScoreForCurrentlyPlayedNotes()
-        if not self.guitar.endPick(self.song.getPosition()):
+    def handleKeyBurst(self, time):
+        """
+        Judge a pick that was waiting for the frets to be pressed once the
+        key burst period has passed. The pick is judged at its own time.
+
+        @param time:    Current L{Clock} time
+        """
+        if self.keyBurstTimeout is None or time <= self.keyBurstTimeout:
+            return
+
+        self.keyBurstTimeout = None
+        if not self.song:
+            return
+
+        pos   = self.getSongPosition() - self.getInputLag(self.keyBurstTime)
+        notes = self.guitar.getRequiredNotes(self.song, pos)
+        if self.guitar.controlsMatchNotes(self.controls, notes):
+            self.doPick(pos)
+
+    def getEventTime(self):
+        """
+        @return: L{Clock} time stamp of the input event being handled or
+                 the current time outside the event handlers
+        """
+        eventTime = self.engine.input.eventTime
+        if eventTime is None:
+            return Clock.getTime()
+        return eventTime
+
+    def getInputLag(self, eventTime = None):
+        """
+        Get the time that has passed since an input event. Subtracting this
+        from the song position gives the song position at the time of the
+        event, so the judgement does not depend on the frame rate.
+
+        @param eventTime:   L{Clock} time stamp of the event, defaults to
+                            the input event being handled
+        @return:            Time in milliseconds
+        """
+        if eventTime is None:
+            eventTime = self.getEventTime()
+        return max(0.0, Clock.getTime() - eventTime)
+
+    def getEventSongPosition(self):
+        """@return: Song position at the time of the input event being handled"""
+        return self.getSongPosition() - self.getInputLag()
+
+    def endPick(self, pos = None):
+        if pos is None:
+            pos = self.getEventSongPosition()
+
+        lag   = self.getSongPosition() - pos
+        score = self.getExtraScoreForCurrentlyPlayedNotes(pos)
+        if not self.guitar.endPick(self.song.getPosition() - lag):
             self.song.setGuitarVolume(0.0)
         self.player.addScore(score)
 
@@ -238,11 +317,12 @@ class GuitarScene(Scene):
                 return self.lastSongPos + 4.0 * (1 - self.visibility) * self.song.period - self.delay
         return 0.0
 
-    def doPick(self):
+    def doPick(self, pos = None):
         if not self.song:
             return
 
-        pos = self.getSongPosition()
+        if pos is None:
+            pos = self.getEventSongPosition()
 
         if self.guitar.playedNotes:
             # If all the played notes are tappable, there are no required notes and
@@ -251,7 +331,7 @@ class GuitarScene(Scene):
                not self.guitar.getRequiredNotes(self.song, pos) and \
                pos - self.lastPickPos <= self.song.period / 2:
                 return
-            self.endPick()
+            self.endPick(pos)
 
         self.lastPickPos = pos
 
@@ -287,6 +367,7 @@ class GuitarScene(Scene):
             self.engine.world.createScene("GameResultsScene", libraryName = self.libraryName, songName = self.songName)
 
     def keyPressed(self, key, unicode):
+        self.handleKeyBurst(self.getEventTime())
         control = self.controls.keyPressed(key)
 
         if control in (Player.ACTION1, Player.ACTION2):
@@ -295,14 +376,15 @@ class GuitarScene(Scene):
                     self.keyBurstTimeout = None
                     break
             else:
-                self.keyBurstTimeout = self.engine.timer.delta_time() + self.keyBurstPeriod
+                self.keyBurstTime    = self.getEventTime()
+                self.keyBurstTimeout = self.keyBurstTime + self.keyBurstPeriod
                 return True
 
         if control in (Player.ACTION1, Player.ACTION2) and self.song:
             self.doPick()
         elif control in KEYS and self.song:
             # Check whether we can tap the currently required notes
-            pos   = self.getSongPosition()
+            pos   = self.getEventSongPosition()
             notes = self.guitar.getRequiredNotes(self.song, pos)
 
             if self.player.streak > 0 and \
@@ -327,20 +409,24 @@ class GuitarScene(Scene):
             else:
                 self.enteredCode = []
 
-    def getExtraScoreForCurrentlyPlayedNotes(self):
+    def getExtraScoreForCurrentlyPlayedNotes(self, pos = None):
         if not self.song:
             return 0
 
+        if pos is None:
+            pos = self.getSongPosition()
+
         noteCount  = len(self.guitar.playedNotes)
-        pickLength = self.guitar.getPickLength(self.getSongPosition())
+        pickLength = self.guitar.getPickLength(pos)
         if pickLength > 1.1 * self.song.period / 4:
             return int(.1 * pickLength * noteCount)
         return 0
 
     def keyReleased(self, key):
+        self.handleKeyBurst(self.getEventTime())
         if self.controls.keyReleased(key) in KEYS and self.song:
             # Check whether we can tap the currently required notes
-            pos   = self.getSongPosition()
+            pos   = self.getEventSongPosition()
             notes = self.guitar.getRequiredNotes(self.song, pos)
             if self.player.streak > 0 and \
                self.guitar.areNotesTappable(notes) and \
@@ -368,9 +454,8 @@ class GuitarScene(Scene):
                 if self.countdown < 6:
                     scale = 0.002 + 0.0005 * (self.countdown % 1) ** 3
                     text = "%d" % (self.countdown)
-                    w, h = bigFont.getStringSize(text, scale = scale)
                     Theme.setSelectedColor()
-                    bigFont.render(text,  (.5 - w / 2, .45 - h / 2), scale = scale)
+                    bigFont.renderHud(text,  (.5, .45), scale = scale, align = (.5, .5))
 
             w, h = font.getStringSize(" ")
             y = .05 - h / 2 - (1.0 - v) * .2
@@ -382,8 +467,8 @@ class GuitarScene(Scene):
 
             Theme.setSelectedColor()
 
-            font.render("%d" % (self.player.score + self.getExtraScoreForCurrentlyPlayedNotes()),  (.6, y))
-            font.render("%dx" % self.player.getScoreMultiplier(), (.6, y + h))
+            font.renderHud("%d" % (self.player.score + self.getExtraScoreForCurrentlyPlayedNotes()),  (.6, y))
+            font.renderHud("%dx" % self.player.getScoreMultiplier(), (.6, y + h))
 
             # show the streak counter and miss message
             if self.player.streak > 0 and self.song:
@@ -394,8 +479,7 @@ class GuitarScene(Scene):
                     if diff > 0 and diff < self.song.period * 2:
                         factor = .25 * (1.0 - (diff / (self.song.period * 2))) ** 2
                 factor = (1.0 + factor) * 0.002
-                tw, th = font.getStringSize(text, scale = factor)
-                font.render(text, (.16 - tw / 2, y + h / 2 - th / 2), scale = factor)
+                font.renderHud(text, (.16, y + h / 2), scale = factor, align = (.5, .5))
             elif self.lastPickPos is not None and self.countdown <= 0:
                 diff = self.getSongPosition() - self.lastPickPos
                 alpha = 1.0 - diff * 0.005
@@ -443,7 +527,7 @@ class GuitarScene(Scene):
                     f = (1.0 - abs(self.song.period * 1 - diff) / (self.song.period * 1)) ** 2
 
                     # Flash the screen
-                    gl.glBegin(gl.GL_TRIANGLE_STRIP)
+                    GLState.begin(gl.GL_TRIANGLE_STRIP, 4)
                     gl.glColor4f(c[0], c[1], c[2], (f - .5) * 1)
                     gl.glVertex2f(0, 0)
                     gl.glColor4f(c[0], c[1], c[2], (f - .5) * 1)
@@ -452,20 +536,20 @@ class GuitarScene(Scene):
                     gl.glVertex2f(0, 1)
                     gl.glColor4f(c[0], c[1], c[2], (f - .5) * .25)
                     gl.glVertex2f(1, 1)
-                    gl.glEnd()
+                    GLState.end()
 
                     if texture:
                         gl.glPushMatrix()
-                        gl.glEnable(gl.GL_TEXTURE_2D)
+                        GLState.enable(gl.GL_TEXTURE_2D)
                         texture.bind()
                         size = (texture.pixelSize[0] * .002, texture.pixelSize[1] * .002)
 
                         gl.glTranslatef(.5, .15, 0)
-                        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
+                        GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE)
 
                         f = .5 + .5 * (diff / self.song.period) ** 3
                         gl.glColor4f(1, 1, 1, min(1, 2 - f))
-                        gl.glBegin(gl.GL_TRIANGLE_STRIP)
+                        GLState.begin(gl.GL_TRIANGLE_STRIP, 4)
                         gl.glTexCoord2f(0.0, 0.0)
                         gl.glVertex2f(-size[0] * f, -size[1] * f)
                         gl.glTexCoord2f(1.0, 0.0)
@@ -474,9 +558,9 @@ class GuitarScene(Scene):
                         gl.glVertex2f(-size[0] * f,  size[1] * f)
                         gl.glTexCoord2f(1.0, 1.0)
                         gl.glVertex2f( size[0] * f,  size[1] * f)
-                        gl.glEnd()
+                        GLState.end()
 
-                        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+                        GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
                         gl.glPopMatrix()
 
             # show the comments
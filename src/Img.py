@@ -27,6 +27,7 @@ from math import sin, cos
 
 from fretwork import log
 import Config
+import GLState
 from Texture import Texture
 
 
@@ -71,8 +72,8 @@ class ImgContext:
 
 
     def clear(self, r = 0, g = 0, b = 0, a = 0):
-        glDepthMask(1)
-        glEnable(GL_COLOR_MATERIAL)
+        GLState.depthMask(1)
+        GLState.enable(GL_COLOR_MATERIAL)
         glClearColor(r, g, b, a)
         glClear(GL_COLOR_BUFFER_BIT | GL_STENCIL_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
@@ -121,7 +122,13 @@ class ImgTransform:
         glMultMatrixf(m)
 
 class ImgDrawing:
-    def __init__(self, context, imgPath):
+    def __init__(self, context, imgPath, background = False):
+        """
+        @param context:     L{ImgContext} the drawing is drawn in
+        @param imgPath:     Path to the image file
+        @param background:  Load the image in the background, see
+                            L{Texture.loadFileInBackground}
+        """
         self.imgPath = None
         self.texture = None
         self.context = context
@@ -130,7 +137,11 @@ class ImgDrawing:
 
         # Load PNG files directly
         if imgPath.endswith(".png"):
-            self.texture = Texture(imgPath)
+            if background:
+                self.texture = Texture()
+                self.texture.loadFileInBackground(imgPath)
+            else:
+                self.texture = Texture(imgPath)
         else:
             e = "Unsupported Image format."
             log.error(e)
@@ -174,8 +185,8 @@ class ImgDrawing:
             glColor4f(*color)
 
             self.texture.bind()
-            glEnable(GL_TEXTURE_2D)
-            glBegin(GL_TRIANGLE_STRIP)
+            GLState.enable(GL_TEXTURE_2D)
+            GLState.begin(GL_TRIANGLE_STRIP, 4)
             glTexCoord2f(0.0, 1.0)
             glVertex2f(0.0, 1.0)
             glTexCoord2f(1.0, 1.0)
@@ -184,8 +195,8 @@ class ImgDrawing:
             glVertex2f(0.0, 0.0)
             glTexCoord2f(1.0, 0.0)
             glVertex2f(1.0, 0.0)
-            glEnd()
-            glDisable(GL_TEXTURE_2D)
+            GLState.end()
+            GLState.disable(GL_TEXTURE_2D)
         glMatrixMode(GL_TEXTURE)
         glPopMatrix()
         glMatrixMode(GL_MODELVIEW)
@@ -26,6 +26,7 @@ from fretwork import audio
 from fretwork.task import Task
 
 from Player import Controls
+import Clock
 
 class KeyListener(object):
     def keyPressed(self, key, unicode):
@@ -77,6 +78,8 @@ class Input(Task):
         self.systemListeners      = []
         self.priorityKeyListeners = []
         self.controls             = Controls()
+        self.events               = []
+        self.eventTime            = None
         self.disableKeyRepeat()
 
         # Initialize joysticks
@@ -183,9 +186,28 @@ class Input(Task):
             return "Joy #%d, %s" % (joy + 1, chr(ord('A') + but))
         return self.getSystemKeyName(id)
 
-    def run(self, ticks):
+    def pollEvents(self):
+        """
+        Move the pending events from the event queue to the input buffer and
+        stamp them with the current L{Clock} time. The events are dispatched
+        on the next run, but polling them more often than once per frame
+        gives them more accurate time stamps.
+        """
         pygame.event.pump()
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        if events:
+            now = Clock.getTime()
+            self.events.extend([(now, event) for event in events])
+
+    def run(self, ticks):
+        self.pollEvents()
+        events      = self.events
+        self.events = []
+
+        # The listeners can read the time stamp of the event being dispatched
+        # from eventTime. It is None outside the event handlers.
+        for eventTime, event in events:
+            self.eventTime = eventTime
             if event.type == pygame.KEYDOWN:
                 if not self.broadcastEvent(self.priorityKeyListeners, "keyPressed", event.key, event.unicode):
                     self.broadcastEvent(self.keyListeners, "keyPressed", event.key, event.unicode)
@@ -259,3 +281,5 @@ class Input(Task):
                             self.broadcastEvent(self.keyListeners, keyEvent, *args)
                 except KeyError:
                     pass
+
+        self.eventTime = None
@@ -31,6 +31,7 @@ from Language import _
 import MainMenu
 import Dialogs
 import Player
+import GLState
 import Song
 
 class Lobby(Layer, KeyListener):
@@ -88,9 +89,9 @@ class Lobby(Layer, KeyListener):
         try:
             v = 1.0 - ((1 - visibility) ** 2)
 
-            glEnable(GL_BLEND)
-            glBlendFunc(GL_SRC_ALPHA, GL_ONE)
-            glEnable(GL_COLOR_MATERIAL)
+            GLState.enable(GL_BLEND)
+            GLState.blendFunc(GL_SRC_ALPHA, GL_ONE)
+            GLState.enable(GL_COLOR_MATERIAL)
 
             text = _("Lobby (%d players)") % len(self.engine.world.players)
             w, h = font.getStringSize(text)
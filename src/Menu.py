@@ -30,6 +30,7 @@ import Data
 import Theme
 import Dialogs
 import Player
+import GLState
 
 class Choice(object):
     def __init__(self, text, callback, values = None, valueIndex = 0):
@@ -106,6 +107,7 @@ class Menu(Layer, KeyListener):
     def shown(self):
         self.engine.input.addKeyListener(self)
         self.engine.input.enableKeyRepeat()
+        self.engine.data.font.warmUp([c.getText(True) for c in self.choices])
 
     def hidden(self):
         self.engine.input.removeKeyListener(self)
@@ -151,11 +153,11 @@ class Menu(Layer, KeyListener):
 
     def renderTriangle(self, up = (0, 1), s = .2):
         left = (-up[1], up[0])
-        gl.glBegin(gl.GL_TRIANGLES)
+        GLState.begin(gl.GL_TRIANGLES, 3)
         gl.glVertex2f( up[0] * s,  up[1] * s)
         gl.glVertex2f((-up[0] + left[0]) * s, (-up[1] + left[1]) * s)
         gl.glVertex2f((-up[0] - left[0]) * s, (-up[1] - left[1]) * s)
-        gl.glEnd()
+        GLState.end()
 
     def render(self, visibility, topMost):
         if not visibility:
@@ -169,9 +171,9 @@ class Menu(Layer, KeyListener):
             if self.fadeScreen:
                 Dialogs.fadeScreen(v)
 
-            gl.glEnable(gl.GL_BLEND)
-            gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
-            gl.glEnable(gl.GL_COLOR_MATERIAL)
+            GLState.enable(gl.GL_BLEND)
+            GLState.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+            GLState.enable(gl.GL_COLOR_MATERIAL)
 
             n = len(self.choices)
             x, y = self.pos
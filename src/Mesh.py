@@ -23,6 +23,9 @@
 from OpenGL.GL import *
 
 import Collada
+import GLState
+import math
+import numpy
 
 class Mesh:
     def __init__(self, fileName):
@@ -30,6 +33,7 @@ class Mesh:
         self.doc.LoadDocumentFromFile(fileName)
         self.geoms = {}
         self.fullGeoms = {}
+        self.arrays = {}
 
     def _unflatten(self, array, stride):
         return [tuple(array[i * stride : (i + 1) * stride]) for i in range(len(array) / stride)]
@@ -54,9 +58,125 @@ class Mesh:
                             glMaterialfv(GL_FRONT_AND_BACK, GL_DIFFUSE,   shader.diffuse.color.rgba)
                             glMaterialfv(GL_FRONT_AND_BACK, GL_SPECULAR,  shader.specular.color.rgba)
 
+    def setupLights(self):
+        for scene in self.doc.visualScenesLibrary.items:
+            for node in scene.nodes:
+                for n, light in enumerate(node.iLights):
+                    if light.object:
+                        # TODO: hierarchical node transformation, other types of lights
+                        pos = [0.0, 0.0, 0.0, 1.0]
+                        for t in node.transforms:
+                            if t[0] == "translate":
+                                pos = t[1]
+                        self.setupLight(light.object, n, pos)
+
+    def disableLights(self):
+        glDisable(GL_LIGHTING)
+        for n in range(8):
+            glDisable(GL_LIGHT0 + n)
+
+    def _nodeTransform(self, node):
+        """
+        @return: 4x4 matrix of the node transformations as applied by render()
+        """
+        matrix = numpy.identity(4)
+        for t in node.transforms:
+            m = numpy.identity(4)
+            if t[0] == "translate":
+                m[:3, 3] = t[1]
+            elif t[0] == "rotate":
+                axis  = numpy.array(t[1][:3], numpy.float64)
+                axis /= numpy.sqrt((axis ** 2).sum())
+                a     = math.radians(t[1][3])
+                x     = numpy.array([[       0, -axis[2],  axis[1]],
+                                     [ axis[2],        0, -axis[0]],
+                                     [-axis[1],  axis[0],        0]])
+                m[:3, :3] = math.cos(a) * numpy.identity(3) + math.sin(a) * x + \
+                            (1 - math.cos(a)) * numpy.outer(axis, axis)
+            elif t[0] == "scale":
+                m[:3, :3] = numpy.diag(t[1])
+            matrix = numpy.dot(matrix, m)
+        return matrix
+
+    def getGeometry(self, geomName):
+        """
+        Get the polygons of a node as triangle vertex arrays for batched
+        rendering. The node transformations are applied to the vertices and
+        the normals, so the arrays can be drawn like render(geomName) would
+        draw the node, except for the lights. See L{setupLights}.
+
+        @param geomName:  Node name
+        @return:          (vertices, normals) tuple of float32 arrays with
+                          three rows per triangle
+        """
+        if geomName in self.arrays:
+            return self.arrays[geomName]
+
+        vertexArray = []
+        normalArray = []
+
+        for scene in self.doc.visualScenesLibrary.items:
+            for node in scene.nodes:
+                if node.name != geomName:
+                    continue
+                matrix = self._nodeTransform(node)
+                for geom in node.iGeometries:
+                    if not geom.object:
+                        continue
+                    geom     = geom.object
+                    vertices = []
+                    normals  = []
+
+                    for prim in geom.data.primitives:
+                        maxOffset    = 0
+                        vertexOffset = None
+                        normalOffset = None
+                        for input in prim.inputs:
+                            maxOffset = max(maxOffset, input.offset)
+                            if input.semantic == "VERTEX":
+                                vertexOffset = input.offset
+                                source       = geom.data.FindSource(geom.data.vertices.FindInput("POSITION"))
+                                positions    = self._unflatten(source.source.data, 3)
+                            elif input.semantic == "NORMAL":
+                                normalOffset = input.offset
+                                directions   = self._unflatten(geom.data.FindSource(input).source.data, 3)
+
+                        if normalOffset is None:
+                            directions   = self._unflatten(geom.data.FindSource(geom.data.vertices.FindInput("NORMAL")).source.data, 3)
+                            normalOffset = vertexOffset
+
+                        if hasattr(prim, "polygons"):
+                            polygons = prim.polygons
+                        else:
+                            polygons = [prim.triangles[i:i + 3 * (maxOffset + 1)] for i in range(0, len(prim.triangles), 3 * (maxOffset + 1))]
+
+                        # Split the polygons into triangle fans
+                        for poly in polygons:
+                            indices = self._unflatten(poly, maxOffset + 1)
+                            for i in range(1, len(indices) - 1):
+                                for j in (0, i, i + 1):
+                                    vertices.append(positions[indices[j][vertexOffset]])
+                                    normals.append(directions[indices[j][normalOffset]])
+
+                    # Normals are transformed like the fixed function pipeline does it, without normalization
+                    vertices = numpy.array(vertices, numpy.float64)
+                    normals  = numpy.array(normals,  numpy.float64)
+                    vertexArray.append(numpy.dot(vertices, matrix[:3, :3].T) + matrix[:3, 3])
+                    normalArray.append(numpy.dot(normals, numpy.linalg.inv(matrix[:3, :3])))
+
+        if vertexArray:
+            vertices = numpy.concatenate(vertexArray).astype(numpy.float32)
+            normals  = numpy.concatenate(normalArray).astype(numpy.float32)
+        else:
+            vertices = numpy.zeros((0, 3), numpy.float32)
+            normals  = numpy.zeros((0, 3), numpy.float32)
+
+        self.arrays[geomName] = (vertices, normals)
+        return self.arrays[geomName]
+
     def render(self, geomName = None):
         if geomName in self.fullGeoms:
-            glCallList(self.fullGeoms[geomName])
+            GLState.callList(self.fullGeoms[geomName])
             return
 
         # Prepare a new list for all the geometry
@@ -123,16 +243,7 @@ class Mesh:
 
         if self.geoms:
             # setup lights
-            for scene in self.doc.visualScenesLibrary.items:
-                for node in scene.nodes:
-                    for n, light in enumerate(node.iLights):
-                        if light.object:
-                            # TODO: hierarchical node transformation, other types of lights
-                            pos = [0.0, 0.0, 0.0, 1.0]
-                            for t in node.transforms:
-                                if t[0] == "translate":
-                                    pos = t[1]
-                            self.setupLight(light.object, n, pos)
+            self.setupLights()
 
             # render geometry
             for scene in self.doc.visualScenesLibrary.items:
@@ -155,9 +266,7 @@ class Mesh:
                             if geom.object.name in self.geoms:
                                 glCallList(self.geoms[geom.object.name])
                             glPopMatrix()
-            glDisable(GL_LIGHTING)
-            for n in range(8):
-                glDisable(GL_LIGHT0 + n)
+            self.disableLights()
         glEndList()
 
         # Render the new list
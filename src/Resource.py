@@ -26,6 +26,7 @@ from threading import Thread, BoundedSemaphore
 import time
 import shutil
 import stat
+import sha
 
 from fretwork import log
 from fretwork.task import Task
@@ -187,3 +188,20 @@ def getWritableResourcePath():
     except:
         pass
     return path
+
+def getFileHash(fileName):
+    """
+    Calculate the SHA-1 hash of a file.
+
+    @param fileName:  Path to the file
+    @return:          Hex digest of the file contents
+    """
+    h = sha.new()
+    f = open(fileName, "rb")
+    bs = 1024
+    while True:
+        data = f.read(bs)
+        if not data: break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
@@ -172,6 +172,7 @@ class SettingsMenu(Menu.Menu):
             ConfigChoice(engine.config, "video",  "fps"),
             ConfigChoice(engine.config, "video",  "multisamples"),
             ConfigChoice(engine.config, "video", "fontscale"),
+            ConfigChoice(engine.config, "video", "sdffonts"),
         ]
         videoSettingsMenu = Menu.Menu(engine, videoSettings + applyItem)
 
@@ -28,14 +28,25 @@ import sha
 import binascii
 import cerealizer
 import urllib
+import struct
+import heapq
+import itertools
+import numpy
+from bisect import bisect_left, bisect_right
+from threading import Thread, Lock
+from collections import OrderedDict
 
 from fretwork import audio
 from fretwork import log
-from fretwork import midi
+
+import midi
 
 import Config
 import Version
 import Theme
+import Clock
+from Resource import getWritableResourcePath, getFileHash
+from SongIndex import SongIndex
 from Language import _
 
 DEFAULT_LIBRARY         = "songs"
@@ -63,21 +74,110 @@ difficulties = {
     AMAZING_DIFFICULTY:  Difficulty(AMAZING_DIFFICULTY,  _("Amazing")),
 }
 
+# Contents of parsed song.ini files by file name, see getInfoParser
+_infoParsers         = OrderedDict()
+_infoParserCacheSize = 256
+_infoParsersLock     = Lock()
+
+def _getInfoSnapshot(info):
+    # The option values are strings, so copying the dictionaries is enough
+    # to keep the cached contents from changing
+    sections = tuple([(name, tuple(options.items())) for name, options in info._sections.items()])
+    return (tuple(info._defaults.items()), sections)
+
+def _createInfoParser(snapshot):
+    defaults, sections = snapshot
+    info = ConfigParser()
+    info._defaults.update(defaults)
+    for name, options in sections:
+        info._sections[name] = info._dict(options)
+    return info
+
+def getInfoParser(fileName):
+    """
+    Get the parsed contents of an ini file.
+
+    The file is only parsed again once it is modified on disk. Every
+    caller gets a copy of its own, so changes made to it are not seen by
+    the others until they are saved.
+
+    @param fileName:  Path to the ini file
+    @return:          ConfigParser instance
+    """
+    try:
+        stat = os.stat(fileName)
+        key  = (stat.st_mtime, stat.st_size)
+    except OSError:
+        key  = None
+
+    if key is not None:
+        _infoParsersLock.acquire()
+        try:
+            cachedKey, snapshot = _infoParsers.pop(fileName, (None, None))
+            if snapshot is not None and cachedKey == key:
+                _infoParsers[fileName] = (key, snapshot)
+                return _createInfoParser(snapshot)
+        finally:
+            _infoParsersLock.release()
+
+    info = ConfigParser()
+    try:
+        info.read(fileName)
+    except:
+        pass
+    if key is not None:
+        _storeInfoParser(fileName, info)
+    return info
+
+def _storeInfoParser(fileName, info):
+    try:
+        stat = os.stat(fileName)
+    except OSError:
+        return
+    # The caller keeps using its parser, so the cache gets a copy
+    snapshot = _getInfoSnapshot(info)
+    _infoParsersLock.acquire()
+    try:
+        _infoParsers.pop(fileName, None)
+        _infoParsers[fileName] = ((stat.st_mtime, stat.st_size), snapshot)
+        while len(_infoParsers) > _infoParserCacheSize:
+            _infoParsers.popitem(last = False)
+    finally:
+        _infoParsersLock.release()
+
 class SongInfo(object):
-    def __init__(self, infoFileName):
+    def __init__(self, infoFileName, record = None):
+        """
+        @param infoFileName:  Path to the song.ini file
+        @param record:        Optional song record from the L{SongIndex}. The
+                              song.ini file is only read once a value that
+                              is not in the record is needed.
+        """
         self.songName      = os.path.basename(os.path.dirname(infoFileName))
         self.fileName      = infoFileName
-        self.info          = ConfigParser()
+        self.record        = record
+        self._info         = None
+        self._highScores   = None
         self._difficulties = None
 
-        try:
-            self.info.read(infoFileName)
-        except:
-            pass
+        if record and record.get("difficulties") is not None:
+            self._difficulties = [difficulties[d] for d in record["difficulties"]]
+
+    def getInfo(self):
+        if self._info is None:
+            self._info = getInfoParser(self.fileName)
+        return self._info
+
+    def getHighscoreTable(self):
+        if self._highScores is None:
+            self._readHighscores()
+        return self._highScores
 
-        # Read highscores and verify their hashes.
+    def _readHighscores(self):
+        # Read highscores and verify their hashes. This is only done once
+        # the scores are needed, browsing the songs doesn't show them.
         # There ain't no security like security throught obscurity :)
-        self.highScores = {}
+        self._highScores = {}
 
         scores = self._get("scores", str, "")
         if scores:
@@ -87,11 +187,15 @@ class SongInfo(object):
                     difficulty = difficulties[difficulty]
                 except KeyError:
                     continue
+                table = []
                 for score, stars, name, hash in scores[difficulty.id]:
                     if self.getScoreHash(difficulty, score, stars, name) == hash:
-                        self.addHighscore(difficulty, score, stars, name)
+                        table.append((score, stars, name))
                     else:
                         log.warn("Weak hack attempt detected. Better luck next time.")
+                if table:
+                    table.sort(key = lambda s: s[0], reverse = True)
+                    self._highScores[difficulty] = table[:5]
 
     def _set(self, attr, value):
         if not self.info.has_section("song"):
@@ -109,17 +213,25 @@ class SongInfo(object):
         return binascii.hexlify(cerealizer.dumps(s))
 
     def save(self):
-        self._set("scores", self.getObfuscatedScores())
+        # Scores that were never read are still stored as they were
+        if self._highScores is not None:
+            self._set("scores", self.getObfuscatedScores())
 
         f = open(self.fileName, "w")
         self.info.write(f)
         f.close()
+        _storeInfoParser(self.fileName, self.info)
 
     def _get(self, attr, type = None, default = ""):
-        try:
-            v = self.info.get("song", attr)
-        except:
-            v = default
+        if self._info is None and self.record is not None and attr in self.record:
+            v = self.record[attr]
+            if v is None:
+                v = default
+        else:
+            try:
+                v = self.info.get("song", attr)
+            except:
+                v = default
         if v is not None and type:
             v = type(v)
         return v
@@ -135,14 +247,7 @@ class SongInfo(object):
         # See which difficulties are available
         try:
             noteFileName = os.path.join(os.path.dirname(self.fileName), "notes.mid")
-            info = MidiInfoReader()
-            midiIn = midi.MidiInFile(info, noteFileName)
-            try:
-                midiIn.read()
-            except MidiInfoReader.Done:
-                pass
-            info.difficulties.sort(lambda a, b: cmp(b.id, a.id))
-            self._difficulties = info.difficulties
+            self._difficulties = scanDifficulties(noteFileName)
         except:
             self._difficulties = difficulties.values()
         return self._difficulties
@@ -216,6 +321,8 @@ class SongInfo(object):
     def isTutorial(self):
         return self._get("tutorial", int, 0) == 1
 
+    info          = property(getInfo)
+    highScores    = property(getHighscoreTable)
     name          = property(getName, setName)
     artist        = property(getArtist, setArtist)
     delay         = property(getDelay, setDelay)
@@ -224,11 +331,11 @@ class SongInfo(object):
     cassetteColor = property(getCassetteColor, setCassetteColor)
 
 class LibraryInfo(object):
-    def __init__(self, libraryName, infoFileName):
+    def __init__(self, libraryName, infoFileName, songCount = None):
         self.libraryName   = libraryName
         self.fileName      = infoFileName
         self.info          = ConfigParser()
-        self.songCount     = 0
+        self.songCount     = songCount
 
         try:
             self.info.read(infoFileName)
@@ -239,7 +346,10 @@ class LibraryInfo(object):
         if not self.name:
             self.name = os.path.basename(os.path.dirname(self.fileName))
 
-        # Count the available songs
+        # Count the available songs unless the song index already did
+        if self.songCount is not None:
+            return
+        self.songCount = 0
         libraryRoot = os.path.dirname(self.fileName)
         for name in os.listdir(libraryRoot):
             if not os.path.isdir(os.path.join(libraryRoot, name)) or name.startswith("."):
@@ -288,11 +398,29 @@ class LibraryInfo(object):
     name          = property(getName, setName)
     color         = property(getColor, setColor)
 
+# Event kinds stored in the Track.kinds column
+EVENT_OTHER   = 0
+EVENT_NOTE    = 1
+EVENT_TEMPO   = 2
+EVENT_TEXT    = 3
+EVENT_PICTURE = 4
+
+# Bits stored in the Track.flags column
+FLAG_SPECIAL  = 0x1
+FLAG_TAPPABLE = 0x2
+
+# Bits of all the note numbers in a chord mask
+CHORD_MASK    = 0x1f
+
 class Event:
+    kind = EVENT_OTHER
+
     def __init__(self, length):
         self.length = length
 
 class Note(Event):
+    kind = EVENT_NOTE
+
     def __init__(self, number, length, special = False, tappable = False):
         Event.__init__(self, length)
         self.number   = number
@@ -300,10 +428,17 @@ class Note(Event):
         self.special  = special
         self.tappable = tappable
 
+        # Chord masks for matching the held frets, see NoteScheduler
+        self.chordMask     = 1 << number
+        self.matchMask     = CHORD_MASK & ~(self.chordMask - 1)
+        self.chordTappable = tappable
+
     def __repr__(self):
         return "<#%d>" % self.number
 
 class Tempo(Event):
+    kind = EVENT_TEMPO
+
     def __init__(self, bpm):
         Event.__init__(self, 0)
         self.bpm = bpm
@@ -312,6 +447,8 @@ class Tempo(Event):
         return "<%d bpm>" % self.bpm
 
 class TextEvent(Event):
+    kind = EVENT_TEXT
+
     def __init__(self, text, length):
         Event.__init__(self, length)
         self.text = text
@@ -320,56 +457,296 @@ class TextEvent(Event):
         return "<%s>" % self.text
 
 class PictureEvent(Event):
+    kind = EVENT_PICTURE
+
     def __init__(self, fileName, length):
         Event.__init__(self, length)
         self.fileName = fileName
 
-class Track:
-    granularity = 50
+def _eventFlags(event):
+    flags = 0
+    if event.kind == EVENT_NOTE:
+        if event.special:
+            flags |= FLAG_SPECIAL
+        if event.tappable:
+            flags |= FLAG_TAPPABLE
+    return flags
+
+class TempoMap(object):
+    """
+    Converts between MIDI ticks, milliseconds and beats in a song with tempo changes.
+
+    Each tempo segment stores its starting tick and its starting time in
+    milliseconds, so a conversion is a binary search for the segment followed
+    by a linear interpolation inside it. The first tempo also applies to any
+    time before it.
+    """
+    defaultBpm = 120.0
+
+    def __init__(self, ticksPerBeat = 480, bpm = None):
+        self.ticksPerBeat = ticksPerBeat
+        self.ticks        = []
+        self.times        = []
+        self.bpms         = []
+        if bpm:
+            self.addTempo(0, bpm)
+
+    def __len__(self):
+        return len(self.bpms)
+
+    def reset(self, bpm):
+        """Replace all the tempo changes with a single tempo."""
+        self.ticks = []
+        self.times = []
+        self.bpms  = []
+        self.addTempo(0, bpm)
+
+    def _ticksToMs(self, ticks, bpm):
+        return (60000.0 * ticks) / (bpm * self.ticksPerBeat)
+
+    def _msToTicks(self, time, bpm):
+        return (time * bpm * self.ticksPerBeat) / 60000.0
+
+    def addTempo(self, ticks, bpm):
+        """
+        Add a tempo change.
+
+        @param ticks:   Position of the tempo change in MIDI ticks
+        @param bpm:     New tempo in beats per minute
+        """
+        if self.ticks and ticks < self.ticks[-1]:
+            # Out of order tempo changes are rare, so just rebuild the segments
+            tempos = zip(self.ticks, self.bpms) + [(ticks, bpm)]
+            tempos.sort(key = lambda t: t[0])
+            self.ticks, self.times, self.bpms = [], [], []
+            for t, b in tempos:
+                self.addTempo(t, b)
+            return
 
+        if self.ticks and ticks == self.ticks[-1]:
+            self.ticks.pop()
+            self.times.pop()
+            self.bpms.pop()
+
+        if self.ticks:
+            time = self.times[-1] + self._ticksToMs(ticks - self.ticks[-1], self.bpms[-1])
+        else:
+            time = self._ticksToMs(ticks, bpm)
+
+        self.ticks.append(ticks)
+        self.times.append(time)
+        self.bpms.append(bpm)
+
+    def getTempos(self):
+        """@return: List of (time, bpm) tuples, one for each tempo change"""
+        return zip(self.times, self.bpms)
+
+    def ticksToTime(self, ticks):
+        """Convert MIDI ticks to milliseconds."""
+        if not self.bpms:
+            return self._ticksToMs(ticks, self.defaultBpm)
+        i = max(0, bisect_right(self.ticks, ticks) - 1)
+        return self.times[i] + self._ticksToMs(ticks - self.ticks[i], self.bpms[i])
+
+    def timeToTicks(self, time):
+        """Convert milliseconds to (fractional) MIDI ticks."""
+        if not self.bpms:
+            return self._msToTicks(time, self.defaultBpm)
+        i = max(0, bisect_right(self.times, time) - 1)
+        return self.ticks[i] + self._msToTicks(time - self.times[i], self.bpms[i])
+
+    def timeToBeats(self, time):
+        """Convert milliseconds to beats."""
+        return self.timeToTicks(time) / float(self.ticksPerBeat)
+
+    def timesToBeats(self, times):
+        """Convert an array of milliseconds to an array of beats."""
+        times = numpy.asarray(times, numpy.float64)
+        if not self.bpms:
+            return self._msToTicks(times, self.defaultBpm) / float(self.ticksPerBeat)
+        i = numpy.maximum(numpy.searchsorted(self.times, times, "right") - 1, 0)
+        ticks = numpy.take(self.ticks, i) + self._msToTicks(times - numpy.take(self.times, i), numpy.take(self.bpms, i))
+        return ticks / float(self.ticksPerBeat)
+
+    def beatsToTime(self, beats):
+        """Convert beats to milliseconds."""
+        return self.ticksToTime(beats * self.ticksPerBeat)
+
+    def beatsToTimes(self, beats):
+        """Convert an array of beats to an array of milliseconds."""
+        ticks = numpy.asarray(beats, numpy.float64) * self.ticksPerBeat
+        if not self.bpms:
+            return self._ticksToMs(ticks, self.defaultBpm)
+        i = numpy.maximum(numpy.searchsorted(self.ticks, ticks, "right") - 1, 0)
+        return numpy.take(self.times, i) + self._ticksToMs(ticks - numpy.take(self.ticks, i), numpy.take(self.bpms, i))
+
+    def getBpm(self, time):
+        """@return: The tempo in effect at the given time in milliseconds"""
+        if not self.bpms:
+            return self.defaultBpm
+        return self.bpms[max(0, bisect_right(self.times, time) - 1)]
+
+class Track(object):
+    """
+    A time sorted collection of song events.
+
+    The events are stored in parallel columns (times, lengths, ends, numbers,
+    flags, kinds and objects) sorted by start time, so that range queries are
+    binary searches that return slices of the columns. The columns are only
+    up to date after one of the query methods has been called.
+
+    The revision counter is bumped whenever events are added or removed.
+    """
     def __init__(self):
-        self.events = []
-        self.allEvents = []
+        self.times      = numpy.zeros(0, numpy.float64)
+        self.lengths    = numpy.zeros(0, numpy.float64)
+        self.ends       = numpy.zeros(0, numpy.float64)
+        self.numbers    = numpy.zeros(0, numpy.int8)
+        self.flags      = numpy.zeros(0, numpy.uint8)
+        self.kinds      = numpy.zeros(0, numpy.uint8)
+        self.objects    = numpy.zeros(0, object)
+        self.maxLength  = 0.0
+        self._pending   = []
+        self._allEvents = None
+        self.revision   = 0
 
     def addEvent(self, time, event):
-        for t in range(int(time / self.granularity), int((time + event.length) / self.granularity) + 1):
-            if len(self.events) < t + 1:
-                n = t + 1 - len(self.events)
-                n *= 8
-                self.events = self.events + [[] for n in range(n)]
-            self.events[t].append((time - (t * self.granularity), event))
-        self.allEvents.append((time, event))
+        self._pending.append((time, event))
+        self._allEvents = None
+        self.revision  += 1
 
     def removeEvent(self, time, event):
-        for t in range(int(time / self.granularity), int((time + event.length) / self.granularity) + 1):
-            e = (time - (t * self.granularity), event)
-            if t < len(self.events) and e in self.events[t]:
-                self.events[t].remove(e)
-        if (time, event) in self.allEvents:
-            self.allEvents.remove((time, event))
+        self._flush()
+        first = self.times.searchsorted(time, "left")
+        last  = self.times.searchsorted(time, "right")
+        for i in range(first, last):
+            if self.objects[i] is event:
+                self._delete(i)
+                break
+
+    def _delete(self, i):
+        self.times      = numpy.delete(self.times,   i)
+        self.lengths    = numpy.delete(self.lengths, i)
+        self.ends       = numpy.delete(self.ends,    i)
+        self.numbers    = numpy.delete(self.numbers, i)
+        self.flags      = numpy.delete(self.flags,   i)
+        self.kinds      = numpy.delete(self.kinds,   i)
+        self.objects    = numpy.delete(self.objects, i)
+        self._allEvents = None
+        self.revision  += 1
+
+    def _flush(self):
+        """Merge any newly added events into the sorted columns."""
+        if not self._pending:
+            return
+
+        pending       = self._pending
+        self._pending = []
+
+        events        = numpy.empty(len(pending), object)
+        events[:]     = [event for time, event in pending]
+        times         = numpy.array([time for time, event in pending], numpy.float64)
+        lengths       = numpy.array([event.length for time, event in pending], numpy.float64)
+        numbers       = numpy.array([getattr(event, "number", -1) for time, event in pending], numpy.int8)
+        flags         = numpy.array([_eventFlags(event) for time, event in pending], numpy.uint8)
+        kinds         = numpy.array([event.kind for time, event in pending], numpy.uint8)
+
+        # A stable sort keeps simultaneous events in the order they were added
+        times         = numpy.concatenate((self.times, times))
+        order         = times.argsort(kind = "mergesort")
+        self.times    = times[order]
+        self.lengths  = numpy.concatenate((self.lengths, lengths))[order]
+        self.ends     = self.times + self.lengths
+        self.numbers  = numpy.concatenate((self.numbers, numbers))[order]
+        self.flags    = numpy.concatenate((self.flags,   flags))[order]
+        self.kinds    = numpy.concatenate((self.kinds,   kinds))[order]
+        self.objects  = numpy.concatenate((self.objects, events))[order]
+        self.maxLength = max(self.maxLength, lengths.max())
+
+    def getEventRange(self, startTime, endTime):
+        """
+        Find the events that start inside a time range.
+
+        @param startTime:   Range start time in milliseconds
+        @param endTime:     Range end time in milliseconds
+        @return:            (first, last) index pair into the event columns
+        """
+        self._flush()
+        if startTime > endTime:
+            startTime, endTime = endTime, startTime
+        return (int(self.times.searchsorted(startTime, "left")),
+                int(self.times.searchsorted(endTime,   "right")))
+
+    def getOverlappingRange(self, startTime, endTime):
+        """
+        Find the events that may overlap a time range. Since long events
+        can start before the range, the returned slice may also contain
+        events that end before startTime; check the ends column to skip those.
+
+        @param startTime:   Range start time in milliseconds
+        @param endTime:     Range end time in milliseconds
+        @return:            (first, last) index pair into the event columns
+        """
+        self._flush()
+        if startTime > endTime:
+            startTime, endTime = endTime, startTime
+        return (int(self.times.searchsorted(startTime - self.maxLength, "left")),
+                int(self.times.searchsorted(endTime, "right")))
+
+    def getNotes(self, startTime, endTime):
+        """
+        Get the notes that start inside a time range.
+
+        @return: Time sorted list of (time, L{Note}) tuples
+        """
+        first, last = self.getEventRange(startTime, endTime)
+        indices     = numpy.flatnonzero(self.kinds[first:last] == EVENT_NOTE) + first
+        return zip(self.times[indices].tolist(), self.objects[indices].tolist())
+
+    def getNoteColumns(self):
+        """
+        Get the columns of all the notes.
+
+        @return: Tuple of (times, lengths, numbers, flags) arrays with one
+                 element for each note in time order
+        """
+        self._flush()
+        notes = self.kinds == EVENT_NOTE
+        return self.times[notes], self.lengths[notes], self.numbers[notes], self.flags[notes]
 
     def getEvents(self, startTime, endTime):
-        t1, t2 = [int(x) for x in [startTime / self.granularity, endTime / self.granularity]]
-        if t1 > t2:
-            t1, t2 = t2, t1
+        """
+        Get the events overlapping a time range.
 
-        events = set()
-        for t in range(max(t1, 0), min(len(self.events), t2)):
-            for diff, event in self.events[t]:
-                time = (self.granularity * t) + diff
-                events.add((time, event))
-        return events
+        @return: List of (time, event) tuples
+        """
+        if startTime > endTime:
+            startTime, endTime = endTime, startTime
+        first, last = self.getOverlappingRange(startTime, endTime)
+        indices     = numpy.flatnonzero(self.ends[first:last] >= startTime) + first
+        return zip(self.times[indices].tolist(), self.objects[indices].tolist())
 
     def getAllEvents(self):
-        return self.allEvents
+        self._flush()
+        if self._allEvents is None:
+            self._allEvents = zip(self.times.tolist(), self.objects.tolist())
+        return self._allEvents
 
-    def reset(self):
-        for eventList in self.events:
-            for time, event in eventList:
-                if isinstance(event, Note):
-                    event.played = False
+    allEvents = property(getAllEvents)
 
-    def update(self):
+    def reset(self):
+        self._flush()
+        for event in self.objects[self.kinds == EVENT_NOTE]:
+            event.played = False
+
+    def clearTappable(self):
+        self._flush()
+        for event in self.objects[self.kinds == EVENT_NOTE]:
+            event.tappable = False
+        self.flags &= ~numpy.uint8(FLAG_TAPPABLE)
+        self.revision += 1
+
+    def update(self, tempoMap = None):
         # Determine which notes are tappable. The rules are:
         #  1. Not the first note of the track
         #  2. Previous note not the same as this one
@@ -385,6 +762,8 @@ class Track:
         epsilon         = 1e-3
 
         def beatsToTicks(time):
+            if tempoMap:
+                return tempoMap.timeToBeats(time) * ticksPerBeat
             return (time * bpm * ticksPerBeat) / 60000.0
 
         if not self.allEvents:
@@ -438,6 +817,254 @@ class Track:
                 currentNotes = [event]
                 currentTicks = ticks
 
+        # Refresh the flag column with the new tappability
+        self.flags     = numpy.array([_eventFlags(event) for event in self.objects], numpy.uint8)
+        self.revision += 1
+
+class NoteScheduler(object):
+    """
+    Finds the notes to judge as the song position moves forward.
+
+    The scheduler keeps two cursors into the time sorted notes of a track.
+    The head cursor points to the first note that may still be hit and the
+    tail cursor to the first note that may still be reported as missed. Both
+    only move forward while the song plays, so each note is stepped over
+    once. Moving backwards, e.g. when a song is restarted, rewinds the
+    cursors with a binary search.
+
+    Loading the notes also stores the masks of each chord in its notes:
+    chordMask has a bit set for every note number in the chord and
+    matchMask for the frets whose state must match chordMask exactly, i.e.
+    the chord notes and all the frets above them. The held lower frets are
+    ignored. The chord can be played if held & matchMask == chordMask.
+    chordTappable is set if all the notes of the chord are tappable.
+    """
+    def __init__(self, track):
+        """
+        @param track:   L{Track} whose notes are judged
+        """
+        self.track    = track
+        self.revision = None
+        self.times    = []
+        self.notes    = []
+        self.head     = 0
+        self.headTime = 0.0
+        self.tail     = 0
+        self.tailTime = 0.0
+
+    def _update(self):
+        """Reload the notes if the track has been modified."""
+        if self.revision == self.track.revision:
+            return
+        track         = self.track
+        track._flush()
+        indices       = numpy.flatnonzero(track.kinds == EVENT_NOTE)
+        self.times    = track.times[indices].tolist()
+        self.notes    = track.objects[indices].tolist()
+        self.revision = track.revision
+        self._updateChords(track.times[indices], track.numbers[indices], track.flags[indices])
+        self.reset()
+
+    def _updateChords(self, times, numbers, flags):
+        """Store the chord masks in the notes."""
+        if not len(times):
+            return
+
+        # The notes of a chord start at the same time as the first one
+        starts     = numpy.flatnonzero(numpy.diff(times) >= 1e-3) + 1
+        starts     = numpy.concatenate(([0], starts))
+        sizes      = numpy.diff(numpy.concatenate((starts, [len(times)])))
+        bits       = numpy.left_shift(1, numbers.astype(numpy.int32))
+        masks      = numpy.bitwise_or.reduceat(bits, starts)
+        topBits    = numpy.left_shift(1, numpy.maximum.reduceat(numbers.astype(numpy.int32), starts))
+        matchMasks = masks | (CHORD_MASK & ~(topBits - 1))
+        tappable   = numpy.logical_and.reduceat((flags & FLAG_TAPPABLE) != 0, starts)
+
+        chords     = zip(numpy.repeat(masks, sizes).tolist(),
+                         numpy.repeat(matchMasks, sizes).tolist(),
+                         numpy.repeat(tappable, sizes).tolist())
+        for note, (chordMask, matchMask, chordTappable) in zip(self.notes, chords):
+            note.chordMask     = chordMask
+            note.matchMask     = matchMask
+            note.chordTappable = chordTappable
+
+    def reset(self):
+        """Move the cursors back to the start of the track."""
+        self.head     = 0
+        self.headTime = 0.0
+        self.tail     = 0
+        self.tailTime = 0.0
+
+    def _advance(self, cursor, cursorTime, time):
+        """
+        Move a cursor to the first unplayed note starting at or after a time.
+
+        @return: New cursor index
+        """
+        times = self.times
+        if time < cursorTime:
+            cursor = bisect_left(times, time)
+        notes = self.notes
+        count = len(times)
+        while cursor < count and (times[cursor] < time or notes[cursor].played):
+            cursor += 1
+        return cursor
+
+    def getRequiredNotes(self, pos, earlyMargin, lateMargin):
+        """
+        Get the earliest unplayed chord inside the hit window.
+
+        @param pos:           Song position in milliseconds
+        @param earlyMargin:   Hit window length before the song position
+        @param lateMargin:    Hit window length after the song position
+        @return:              Time sorted list of (time, L{Note}) tuples
+        """
+        self._update()
+        start         = pos - lateMargin
+        end           = pos + earlyMargin
+        self.head     = self._advance(self.head, self.headTime, start)
+        self.headTime = start
+
+        times, notes = self.times, self.notes
+        i            = self.head
+        if i == len(times) or times[i] > end:
+            return []
+
+        # The notes of a chord start at the same time as the first one
+        t      = times[i]
+        count  = len(times)
+        result = []
+        while i < count and times[i] <= end and times[i] - t < 1e-3:
+            if not notes[i].played:
+                result.append((times[i], notes[i]))
+            i += 1
+        return result
+
+    def getMissedNotes(self, pos, lateMargin):
+        """
+        Get the unplayed notes that have just left the hit window.
+
+        @param pos:           Song position in milliseconds
+        @param lateMargin:    Hit window length after the song position
+        @return:              Time sorted list of (time, L{Note}) tuples
+        """
+        self._update()
+        start         = pos - lateMargin * 2
+        end           = pos - lateMargin
+        self.tail     = self._advance(self.tail, self.tailTime, start)
+        self.tailTime = start
+
+        times, notes = self.times, self.notes
+        i            = self.tail
+        count        = len(times)
+        result       = []
+        while i < count and times[i] <= end:
+            if not notes[i].played:
+                result.append((times[i], notes[i]))
+            i += 1
+        return result
+
+class SongClock(object):
+    """
+    A smooth estimate of the playback position of a song.
+
+    The audio backend only updates its position every now and then, and
+    asking it is relatively slow. Instead the clock samples the audio
+    position at most once per frame and extrapolates the position from the
+    high resolution L{Clock} between the samples. Each sample corrects the
+    estimate a bit at a time: the phase error is reduced by phaseGain and
+    the playback rate by rateGain, so that a steady drift between the audio
+    device and the system clock is followed without visible jumps. Errors
+    larger than maxError, e.g. after a hitch in the audio, are corrected at
+    once.
+
+    Apart from those corrections the estimate never goes backwards while
+    playing. The jitter statistics describe how far the audio samples are
+    from the estimate.
+    """
+    phaseGain         = .1
+    rateGain          = .00002
+    maxRateError      = .02
+    maxError          = 100.0
+    maxSampleInterval = 100.0
+
+    def __init__(self):
+        self.reset(0.0)
+
+    def reset(self, position):
+        """
+        Stop the clock at a position.
+
+        @param position:  Song position in milliseconds
+        """
+        self.basePosition   = position
+        self.baseTime       = Clock.getTime()
+        self.lastPosition   = position
+        self.lastSampleTime = None
+        self.rate           = 1.0
+        self.running        = False
+        self.samples        = 0
+        self.jitter         = 0.0
+        self.maxJitter      = 0.0
+
+    def start(self):
+        """Start or continue advancing the position."""
+        if not self.running:
+            self.baseTime = Clock.getTime()
+            self.running  = True
+
+    def stop(self):
+        """Stop advancing the position."""
+        if self.running:
+            self.basePosition = self.estimate(Clock.getTime())
+            self.running      = False
+
+    def estimate(self, time):
+        """
+        @param time:  L{Clock} time
+        @return:      Estimated song position at the given time
+        """
+        if not self.running:
+            return self.basePosition
+        return self.basePosition + (time - self.baseTime) * self.rate
+
+    def sample(self, position):
+        """
+        Correct the estimate with the current audio position.
+
+        @param position:  Song position reported by the audio backend
+        """
+        now                 = Clock.getTime()
+        estimate            = self.estimate(now)
+        error               = position - estimate
+        self.lastSampleTime = now
+
+        if not self.running:
+            return
+
+        self.samples   += 1
+        self.jitter    += (abs(error) - self.jitter) * .05
+        self.maxJitter  = max(self.maxJitter, abs(error))
+
+        if abs(error) > self.maxError:
+            self.basePosition = position
+            self.lastPosition = min(self.lastPosition, position)
+            self.rate         = 1.0
+        else:
+            self.basePosition = estimate + error * self.phaseGain
+            self.rate         = min(max(self.rate + error * self.rateGain, 1.0 - self.maxRateError), 1.0 + self.maxRateError)
+        self.baseTime = now
+
+    def needsSample(self):
+        """@return: True if the clock has not been sampled recently enough"""
+        return self.lastSampleTime is None or Clock.getTime() - self.lastSampleTime > self.maxSampleInterval
+
+    def getPosition(self):
+        """@return: Estimated current song position in milliseconds"""
+        position          = max(self.lastPosition, self.estimate(Clock.getTime()))
+        self.lastPosition = position
+        return position
+
 class Song(object):
     def __init__(self, engine, infoFileName, songTrackName, guitarTrackName, rhythmTrackName, noteFileName, scriptFileName = None):
         self.engine        = engine
@@ -449,6 +1076,8 @@ class Song(object):
         self.noteFileName  = noteFileName
         self.bpm           = None
         self.period        = 0
+        self.tempoMap      = TempoMap()
+        self.clock         = SongClock()
 
         # load the tracks
         if songTrackName:
@@ -469,38 +1098,51 @@ class Song(object):
         except Exception, e:
             log.warn("Unable to load rhythm track: %s" % e)
 
-        # load the notes
+        # load the notes, preferably from the compiled chart cache
+        cached = False
         if noteFileName:
-            midiIn = midi.MidiInFile(MidiReader(self), noteFileName)
-            midiIn.read()
+            cache  = ChartCache()
+            cached = cache.load(self, noteFileName)
+            if not cached:
+                midiIn = midi.MidiInFile(MidiReader(self), noteFileName, tracks = MidiReader.tracks)
+                midiIn.read()
 
         # load the script
         if scriptFileName and os.path.isfile(scriptFileName):
             scriptReader = ScriptReader(self, open(scriptFileName))
             scriptReader.read()
 
-        # update all note tracks
-        for track in self.tracks:
-            track.update()
+        # update all note tracks unless they were already compiled
+        if not cached:
+            for track in self.tracks:
+                track.update(self.tempoMap)
+            if noteFileName:
+                cache.store(self, noteFileName)
 
     def getHash(self):
-        h = sha.new()
-        f = open(self.noteFileName, "rb")
-        bs = 1024
-        while True:
-            data = f.read(bs)
-            if not data: break
-            h.update(data)
-        return h.hexdigest()
+        return getFileHash(self.noteFileName)
 
     def setBpm(self, bpm):
+        """
+        Set the base tempo of the song.
+
+        The base tempo also replaces the tempo map of a song with at most a
+        single tempo. The tempo changes of a song that has several are left
+        alone, since they come from the chart.
+
+        @param bpm:   Tempo in beats per minute
+        """
         self.bpm    = bpm
         self.period = 60000.0 / self.bpm
 
+        # Songs without tempo changes follow the base tempo
+        if len(self.tempoMap) <= 1:
+            self.tempoMap.reset(bpm)
+
     def save(self):
         self.info.save()
         f = open(self.noteFileName + ".tmp", "wb")
-        midiOut = MidiWriter(self, midi.MidiOutFile(f))
+        midiOut = MidiWriter(self, f)
         midiOut.write()
         f.close()
 
@@ -509,6 +1151,8 @@ class Song(object):
 
     def play(self, start = 0.0):
         self.start = start
+        self.clock.reset(start)
+        self.clock.start()
         self.music.play(0, start / 1000.0)
         if self.guitarTrack:
             assert start == 0.0
@@ -519,12 +1163,14 @@ class Song(object):
         self._playing = True
 
     def pause(self):
+        self.clock.stop()
         self.music.pause()
         self.engine.audio.pause()
 
     def unpause(self):
         self.music.unpause()
         self.engine.audio.unpause()
+        self.clock.start()
 
     def setGuitarVolume(self, volume):
         if not self.rhythmTrack:
@@ -564,7 +1210,8 @@ class Song(object):
             self.rhythmTrack.fadeout(time)
         self._playing = False
 
-    def getPosition(self):
+    def getAudioPosition(self):
+        """@return: Playback position reported by the audio backend"""
         if not self._playing:
             pos = 0.0
         else:
@@ -573,6 +1220,13 @@ class Song(object):
             pos = 0.0
         return pos + self.start
 
+    def getPosition(self):
+        if not self._playing:
+            return self.start
+        if self.clock.needsSample():
+            self.clock.sample(self.getAudioPosition())
+        return self.clock.getPosition()
+
     def isPlaying(self):
         return self._playing and self.music.isPlaying()
 
@@ -580,7 +1234,9 @@ class Song(object):
         return self.getPosition() / self.period
 
     def update(self, ticks):
-        pass
+        # Sample the audio position once per frame
+        if self._playing:
+            self.clock.sample(self.getAudioPosition())
 
     def getTrack(self):
         return self.tracks[self.difficulty.id]
@@ -612,57 +1268,106 @@ noteMap = {     # difficulty, note
 
 reverseNoteMap = dict([(v, k) for k, v in noteMap.items()])
 
+def _varLen(value):
+    """
+    Encode a MIDI variable length quantity.
+
+    @param value:  Non-negative integer
+    @return:       Encoded bytes as a string
+    """
+    data = chr(value & 0x7f)
+    v    = value >> 7
+    while v:
+        data = chr(0x80 | (v & 0x7f)) + data
+        v  >>= 7
+    return data
+
 class MidiWriter:
     def __init__(self, song, out):
+        """
+        @param song:  L{Song} to write
+        @param out:   File object the MIDI data is written to
+        """
         self.song         = song
         self.out          = out
         self.ticksPerBeat = 480
 
     def midiTime(self, time):
-        return int(self.song.bpm * self.ticksPerBeat * time / 60000.0)
+        return int(self.song.tempoMap.timeToBeats(time) * self.ticksPerBeat + .5)
+
+    def midiTimes(self, times):
+        return (self.song.tempoMap.timesToBeats(times) * self.ticksPerBeat + .5).astype(numpy.int64)
 
     def write(self):
-        self.out.header(division = self.ticksPerBeat)
-        self.out.start_of_track()
-        self.out.update_time(0)
-        if self.song.bpm:
-            self.out.tempo(int(60.0 * 10.0**6 / self.song.bpm))
-        else:
-            self.out.tempo(int(60.0 * 10.0**6 / 122.0))
-
-        # Collect all events
-        events = [zip([difficulty] * len(track.getAllEvents()), track.getAllEvents()) for difficulty, track in enumerate(self.song.tracks)]
-        events = reduce(lambda a, b: a + b, events)
-        events.sort(lambda a, b: {True: 1, False: -1}[a[1][0] > b[1][0]])
-        heldNotes = []
-
-        for difficulty, event in events:
-            time, event = event
-            if isinstance(event, Note):
-                time = self.midiTime(time)
-
-                # Turn of any held notes that were active before this point in time
-                for note, endTime in list(heldNotes):
-                    if endTime <= time:
-                        self.out.update_time(endTime, relative = 0)
-                        self.out.note_off(0, note)
-                        heldNotes.remove((note, endTime))
-
-                note = reverseNoteMap[(difficulty, event.number)]
-                self.out.update_time(time, relative = 0)
-                self.out.note_on(0, note, event.special and 127 or 100)
-                heldNotes.append((note, time + self.midiTime(event.length)))
-                heldNotes.sort(lambda a, b: {True: 1, False: -1}[a[1] > b[1]])
+        # The tempo changes come before the notes at the same time, otherwise
+        # the events keep the order of the difficulties. The track tempo events
+        # are skipped since the tempo map is the authoritative source.
+        tempos     = self.song.tempoMap.getTempos()
+        tempoTicks = self.midiTimes([time for time, bpm in tempos]).tolist()
+        streams    = [[(time, 0, -1, i, tick, 0, int(60.0 * 10.0**6 / bpm))
+                       for i, ((time, bpm), tick) in enumerate(zip(tempos, tempoTicks))]]
+        noteCount  = 0
+
+        for difficulty, track in enumerate(self.song.tracks):
+            times, lengths, numbers, flags = track.getNoteColumns()
+            notes      = [reverseNoteMap[(difficulty, n)] for n in range(5)]
+            ticks      = self.midiTimes(times).tolist()
+            endTicks   = self.midiTimes(times + lengths).tolist()
+            velocities = numpy.where(flags & FLAG_SPECIAL, 127, 100).tolist()
+            streams.append([(time, 1, difficulty, i, tick, endTick, notes[number] | (velocity << 8))
+                            for i, (time, tick, endTick, number, velocity) in
+                            enumerate(zip(times.tolist(), ticks, endTicks, numbers.tolist(), velocities))])
+            noteCount += len(times)
+
+        # Every event takes at most 4 bytes of delta time and 6 bytes of data
+        buf = bytearray(14 + 8 + 10 * (len(tempos) + 2 * noteCount + 2))
+        buf[0:14] = struct.pack(">4sLHHH", "MThd", 6, 0, 1, self.ticksPerBeat)
+        pos       = 22
+        lastTick  = 0
+
+        # Songs without a tempo are timed with the default tempo of the tempo map
+        if not self.song.bpm:
+            data = "\x00\xff\x51\x03" + struct.pack(">L", int(60.0 * 10.0**6 / self.song.tempoMap.defaultBpm))[1:]
+            buf[pos:pos + len(data)] = data
+            pos += len(data)
+
+        # Held notes are kept in a heap ordered by their end ticks
+        heldNotes   = []
+        noteCounter = itertools.count()
+
+        for time, isNote, difficulty, i, tick, endTick, value in heapq.merge(*streams):
+            # Turn of any held notes that were active before this point in time
+            while heldNotes and heldNotes[0][0] <= tick:
+                noteEndTick, n, note = heapq.heappop(heldNotes)
+                data = _varLen(noteEndTick - lastTick) + "\x80" + chr(note) + "\x40"
+                buf[pos:pos + len(data)] = data
+                pos += len(data)
+                lastTick = noteEndTick
+
+            if isNote:
+                note, velocity = value & 0xff, value >> 8
+                data = _varLen(tick - lastTick) + "\x90" + chr(note) + chr(velocity)
+                heapq.heappush(heldNotes, (endTick, next(noteCounter), note))
+            else:
+                data = _varLen(tick - lastTick) + "\xff\x51\x03" + struct.pack(">L", value)[1:]
+            buf[pos:pos + len(data)] = data
+            pos += len(data)
+            lastTick = tick
 
         # Turn of any remaining notes
-        for note, endTime in heldNotes:
-            self.out.update_time(endTime, relative = 0)
-            self.out.note_off(0, note)
+        while heldNotes:
+            noteEndTick, n, note = heapq.heappop(heldNotes)
+            data = _varLen(noteEndTick - lastTick) + "\x80" + chr(note) + "\x40"
+            buf[pos:pos + len(data)] = data
+            pos += len(data)
+            lastTick = noteEndTick
 
-        self.out.update_time(0)
-        self.out.end_of_track()
-        self.out.eof()
-        self.out.write()
+        # End of track and the track length
+        buf[pos:pos + 4] = "\x00\xff\x2f\x00"
+        pos += 4
+        buf[14:22] = struct.pack(">4sL", "MTrk", pos - 22)
+
+        self.out.write(buffer(buf, 0, pos))
 
 class ScriptReader:
     def __init__(self, song, scriptFile):
@@ -687,13 +1392,15 @@ class ScriptReader:
                 track.addEvent(time, event)
 
 class MidiReader(midi.MidiOutStream):
+    # Only the tempo and guitar tracks are read, the rest are skipped without parsing
+    tracks = [0, 1]
+
     def __init__(self, song):
         midi.MidiOutStream.__init__(self)
         self.song = song
         self.heldNotes = {}
         self.velocity  = {}
         self.ticksPerBeat = 480
-        self.tempoMarkers = []
 
     def addEvent(self, track, event, time = None):
         if time is None:
@@ -706,32 +1413,17 @@ class MidiReader(midi.MidiOutStream):
             self.song.tracks[track].addEvent(time, event)
 
     def abs_time(self):
-        def ticksToBeats(ticks, bpm):
-            return (60000.0 * ticks) / (bpm * self.ticksPerBeat)
-
         if self.song.bpm:
-            currentTime = midi.MidiOutStream.abs_time(self)
-
-            # Find out the current scaled time.
-            # Yeah, this is reeally slow, but fast enough :)
-            scaledTime      = 0.0
-            tempoMarkerTime = 0.0
-            currentBpm      = self.song.bpm
-            for i, marker in enumerate(self.tempoMarkers):
-                time, bpm = marker
-                if time > currentTime:
-                    break
-                scaledTime += ticksToBeats(time - tempoMarkerTime, currentBpm)
-                tempoMarkerTime, currentBpm = time, bpm
-            return scaledTime + ticksToBeats(currentTime - tempoMarkerTime, currentBpm)
+            return self.song.tempoMap.ticksToTime(midi.MidiOutStream.abs_time(self))
         return 0.0
 
     def header(self, format, nTracks, division):
-        self.ticksPerBeat = division
+        self.ticksPerBeat  = division
+        self.song.tempoMap = TempoMap(ticksPerBeat = division)
 
     def tempo(self, value):
         bpm = 60.0 * 10.0**6 / value
-        self.tempoMarkers.append((midi.MidiOutStream.abs_time(self), bpm))
+        self.song.tempoMap.addTempo(midi.MidiOutStream.abs_time(self), bpm)
         if not self.song.bpm:
             self.song.setBpm(bpm)
         self.addEvent(None, Tempo(bpm))
@@ -756,6 +1448,132 @@ class MidiReader(midi.MidiOutStream):
         except KeyError:
             log.warn("MIDI note 0x%x on channel %d ending at %d was never started." % (note, channel, self.abs_time()))
 
+class ChartCache(object):
+    """
+    A persistent cache of compiled note charts.
+
+    Parsing a large notes.mid file and resolving the tappable notes takes
+    a noticeable amount of time, so the resulting note columns and tempo map
+    are stored as NumPy arrays in the writable resource directory. There is
+    one entry per note file and it is only used while the content hash and
+    the modification time of the note file still match the ones it was
+    compiled from.
+    """
+    version = 1
+
+    def __init__(self, path = None):
+        if path is None:
+            path = os.path.join(getWritableResourcePath(), "cache", "charts")
+        self.path = path
+
+    def getEntryFileName(self, noteFileName):
+        """
+        Get the name of the cache entry for a note file.
+
+        @param noteFileName:  Path to the MIDI file
+        @return:              Path to the cache entry
+        """
+        key = os.path.abspath(noteFileName)
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return os.path.join(self.path, sha.new(key).hexdigest() + ".npz")
+
+    def load(self, song, noteFileName):
+        """
+        Fill the tracks and the tempo map of a song from the cache.
+
+        @param song:          L{Song} with empty tracks
+        @param noteFileName:  Path to the MIDI file the song was created from
+        @return:              True if a valid entry was found and loaded, False otherwise
+        """
+        fileName = self.getEntryFileName(noteFileName)
+        if not os.path.isfile(fileName):
+            return False
+
+        try:
+            entry = numpy.load(fileName)
+            try:
+                if int(entry["version"]) != self.version or \
+                   float(entry["mtime"]) != os.path.getmtime(noteFileName) or \
+                   str(entry["hash"]) != getFileHash(noteFileName):
+                    return False
+                columns = dict(entry.items())
+            finally:
+                entry.close()
+        except Exception, e:
+            log.warn("Unable to read chart cache entry %s: %s" % (fileName, e))
+            return False
+
+        tempoMap = TempoMap(ticksPerBeat = int(columns["ticksPerBeat"]))
+        for ticks, bpm in zip(columns["tempoTicks"].tolist(), columns["tempoBpms"].tolist()):
+            tempoMap.addTempo(ticks, bpm)
+        song.tempoMap = tempoMap
+        if float(columns["bpm"]):
+            song.setBpm(float(columns["bpm"]))
+
+        # Tempo events are shared by all the difficulties like in MidiReader
+        tempos = [(time, Tempo(bpm)) for time, bpm in zip(columns["tempoEventTimes"].tolist(),
+                                                          columns["tempoEventBpms"].tolist())]
+        for i, track in enumerate(song.tracks):
+            for time, event in tempos:
+                track.addEvent(time, event)
+            notes = zip(columns["times%d" % i].tolist(), columns["lengths%d" % i].tolist(),
+                        columns["numbers%d" % i].tolist(), columns["flags%d" % i].tolist())
+            for time, length, number, flags in notes:
+                note = Note(number, length, special = bool(flags & FLAG_SPECIAL), tappable = bool(flags & FLAG_TAPPABLE))
+                track.addEvent(time, note)
+        return True
+
+    def store(self, song, noteFileName, background = True):
+        """
+        Write the compiled chart of a song to the cache.
+
+        The columns are copied right away, so the song can be modified while
+        the entry is being written.
+
+        @param song:          L{Song} whose tracks have been updated
+        @param noteFileName:  Path to the MIDI file the song was created from
+        @param background:    Write the entry in a separate thread
+        """
+        columns = {
+          "version":      numpy.array(self.version),
+          "mtime":        numpy.array(os.path.getmtime(noteFileName)),
+          "hash":         numpy.array(getFileHash(noteFileName)),
+          "bpm":          numpy.array(song.bpm or 0.0),
+          "ticksPerBeat": numpy.array(song.tempoMap.ticksPerBeat),
+          "tempoTicks":   numpy.array(song.tempoMap.ticks, numpy.float64),
+          "tempoBpms":    numpy.array(song.tempoMap.bpms, numpy.float64),
+        }
+
+        for i, track in enumerate(song.tracks):
+            columns["times%d" % i], columns["lengths%d" % i], \
+            columns["numbers%d" % i], columns["flags%d" % i] = track.getNoteColumns()
+
+        track  = song.tracks[0]
+        tempos = track.kinds == EVENT_TEMPO
+        columns["tempoEventTimes"] = track.times[tempos]
+        columns["tempoEventBpms"]  = numpy.array([event.bpm for event in track.objects[tempos]], numpy.float64)
+
+        if background:
+            thread = Thread(target = self._write, args = (self.getEntryFileName(noteFileName), columns))
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            self._write(self.getEntryFileName(noteFileName), columns)
+
+    def _write(self, fileName, columns):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            f = open(fileName + ".tmp", "wb")
+            numpy.savez(f, **columns)
+            f.close()
+
+            # Rename the output file after it has been succesfully written
+            shutil.move(fileName + ".tmp", fileName)
+        except Exception, e:
+            log.warn("Unable to write chart cache entry %s: %s" % (fileName, e))
+
 class MidiInfoReader(midi.MidiOutStream):
     # We exit via this exception so that we don't need to read the whole file in
     class Done: pass
@@ -771,10 +1589,101 @@ class MidiInfoReader(midi.MidiOutStream):
             if not diff in self.difficulties:
                 self.difficulties.append(diff)
                 if len(self.difficulties) == len(difficulties):
-                    raise Done
+                    raise MidiInfoReader.Done
         except KeyError:
             pass
 
+# Difficulty bit of every MIDI note number, see scanDifficulties
+_noteDifficultyBits = [0] * 128
+for _note, (_difficulty, _number) in noteMap.items():
+    _noteDifficultyBits[_note] = 1 << _difficulty
+
+# Data bytes of the channel messages by their high nibble
+_channelDataSizes = [0] * 8 + [2, 2, 2, 2, 1, 1, 2, 0]
+
+def _scanNoteBits(data, noteBits, allBits):
+    """
+    Combine the bits of all the notes that are played in a MIDI file.
+
+    @param data:      MIDI file contents as a bytearray
+    @param noteBits:  List of 128 bitmasks, one for each note number
+    @param allBits:   Stop scanning once these bits are all set
+    @return:          Bitwise or of the masks of the played notes
+    """
+    if data[:4] != "MThd":
+        raise ValueError("Not a MIDI file")
+
+    bits = 0
+    size = len(data)
+    pos  = 8 + ((data[4] << 24) | (data[5] << 16) | (data[6] << 8) | data[7])
+
+    while pos + 8 <= size:
+        chunkType = data[pos:pos + 4]
+        end       = pos + 8 + ((data[pos + 4] << 24) | (data[pos + 5] << 16) | (data[pos + 6] << 8) | data[pos + 7])
+        pos      += 8
+        running   = 0
+        if chunkType != "MTrk":
+            pos = end
+            continue
+        end = min(end, size)
+
+        while pos < end:
+            # Skip the delta time
+            while data[pos] & 0x80:
+                pos += 1
+            pos += 1
+
+            status = data[pos]
+            if status & 0x80:
+                pos += 1
+                if status >= 0xf0:
+                    # Meta and sysex events carry their length, the rest are system common messages
+                    if status == 0xff or status == 0xf0 or status == 0xf7:
+                        if status == 0xff:
+                            pos += 1
+                        length = 0
+                        while data[pos] & 0x80:
+                            length = (length << 7) | (data[pos] & 0x7f)
+                            pos += 1
+                        pos += 1 + ((length << 7) | data[pos])
+                    elif status == 0xf2:
+                        pos += 2
+                    elif status == 0xf1 or status == 0xf3:
+                        pos += 1
+                    continue
+                running = status
+            else:
+                status = running
+
+            # Note ons with a zero velocity are note offs
+            if status & 0xf0 == 0x90 and data[pos + 1]:
+                bits |= noteBits[data[pos]]
+                if bits == allBits:
+                    return bits
+            pos += _channelDataSizes[status >> 4]
+        pos = end
+    return bits
+
+def scanDifficulties(noteFileName):
+    """
+    Find out which difficulties a MIDI file has notes for.
+
+    Only the note on events of the raw track data are decoded and the scan
+    stops as soon as every difficulty has been seen, which is a lot faster
+    than a full parse with L{MidiInfoReader}.
+
+    @param noteFileName:  Path to the MIDI file
+    @return:              List of L{Difficulty} objects from the easiest to the hardest
+    """
+    f = open(noteFileName, "rb")
+    try:
+        data = bytearray(f.read())
+    finally:
+        f.close()
+
+    bits = _scanNoteBits(data, _noteDifficultyBits, (1 << len(difficulties)) - 1)
+    return [difficulties[d] for d in sorted(difficulties.keys(), reverse = True) if bits & (1 << d)]
+
 def loadSong(engine, name, library = DEFAULT_LIBRARY, seekable = False, playbackOnly = False, notesOnly = False):
     guitarFile = engine.resource.fileName(library, name, "guitar.ogg")
     songFile   = engine.resource.fileName(library, name, "song.ogg")
@@ -851,42 +1760,78 @@ def createSong(engine, name, guitarTrackName, backgroundTrackName, rhythmTrackNa
 def getDefaultLibrary(engine):
     return LibraryInfo(DEFAULT_LIBRARY, engine.resource.fileName(DEFAULT_LIBRARY, "library.ini"))
 
+def _scanSongInfo(infoFileName):
+    """
+    Read the song index record of a song.
+
+    @param infoFileName:  Path to the song.ini file
+    @return:              Record dictionary for L{SongIndex}
+    """
+    info   = SongInfo(infoFileName)
+    record = dict([(field, info._get(field, default = None)) for field in ["name", "artist", "cassettecolor", "tutorial"]])
+    record["difficulties"] = [d.id for d in info.getDifficulties()]
+    return record
+
 def getAvailableLibraries(engine, library = DEFAULT_LIBRARY):
     # Search for libraries in both the read-write and read-only directories
     songRoots    = [engine.resource.fileName(library),
                     engine.resource.fileName(library, writable = True)]
     libraries    = []
     libraryRoots = []
+    index        = SongIndex()
+
+    try:
+        for songRoot in songRoots:
+            for libraryRoot in index.getDirectory(songRoot)[0]:
+                libraryRoot = os.path.join(songRoot, libraryRoot)
+                names, songIni, libraryIni = index.getDirectory(libraryRoot)
 
-    for songRoot in songRoots:
-        for libraryRoot in os.listdir(songRoot):
-            libraryRoot = os.path.join(songRoot, libraryRoot)
-            if not os.path.isdir(libraryRoot):
-                continue
-            for name in os.listdir(libraryRoot):
                 # If the directory has at least one song under it or a file called "library.ini", add it
-                if os.path.isfile(os.path.join(libraryRoot, name, "song.ini")) or \
-                   name == "library.ini":
+                if libraryIni or any(index.getDirectory(os.path.join(libraryRoot, name))[1] for name in names):
                     if not libraryRoot in libraryRoots:
                         libName = library + os.path.join(libraryRoot.replace(songRoot, ""))
-                        libraries.append(LibraryInfo(libName, os.path.join(libraryRoot, "library.ini")))
+                        songCount = len(index.getSongNames(libraryRoot))
+                        libraries.append(LibraryInfo(libName, os.path.join(libraryRoot, "library.ini"), songCount))
                         libraryRoots.append(libraryRoot)
-                        break
+    finally:
+        index.close()
     libraries.sort(lambda a, b: cmp(a.name, b.name))
     return libraries
 
-def getAvailableSongs(engine, library = DEFAULT_LIBRARY, includeTutorials = False):
+def getAvailableSongs(engine, library = DEFAULT_LIBRARY, includeTutorials = False, progress = None):
+    """
+    Get the songs of a library.
+
+    @param engine:            Game engine
+    @param library:           Library name
+    @param includeTutorials:  Include the tutorial songs
+    @param progress:          Optional function called with the number of scanned
+                              songs and the number of songs that need scanning
+    @return:                  List of L{SongInfo} objects sorted by name
+    """
     # Search for songs in both the read-write and read-only directories
     songRoots = [engine.resource.fileName(library), engine.resource.fileName(library, writable = True)]
-    names = []
-    for songRoot in songRoots:
-        for name in os.listdir(songRoot):
-            if not os.path.isfile(os.path.join(songRoot, name, "song.ini")) or name.startswith("."):
-                continue
-            if not name in names:
-                names.append(name)
+    names     = []
+    seen      = set()
+    songs     = []
+    index     = SongIndex()
+
+    try:
+        for songRoot in songRoots:
+            for name in index.getSongNames(songRoot):
+                if not name in seen:
+                    names.append(name)
+                    seen.add(name)
+
+        # New and modified songs are scanned in parallel
+        infoFiles = [engine.resource.fileName(library, name, "song.ini", writable = True) for name in names]
+        index.updateSongRecords(infoFiles, _scanSongInfo, progress)
+
+        for infoFile in infoFiles:
+            songs.append(SongInfo(infoFile, index.getSongRecord(infoFile, _scanSongInfo)))
+    finally:
+        index.close()
 
-    songs = [SongInfo(engine.resource.fileName(library, name, "song.ini", writable = True)) for name in names]
     if not includeTutorials:
         songs = [song for song in songs if not song.tutorial]
     songs.sort(lambda a, b: cmp(a.name, b.name))
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import os
+import sqlite3
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from fretwork import log
+
+from Resource import getWritableResourcePath
+
+def _scanWorker(args):
+    """Scan a song record in a worker thread of L{SongIndex.updateSongRecords}."""
+    scan, infoFileName = args
+    try:
+        record = scan(infoFileName)
+    except Exception:
+        return (infoFileName, None)
+    return (infoFileName, [record.get(field) for field in SongIndex.songFields])
+
+class SongIndex(object):
+    """
+    A persistent index of the song library.
+
+    The index remembers the contents of every directory it has visited
+    along with its modification time, so browsing a library only needs to
+    stat the directories and song.ini files instead of listing and parsing
+    them. A directory is only listed again when its modification time has
+    changed and a song record is only rebuilt when its song.ini file or the
+    song directory has changed.
+    """
+    version = 1
+
+    # Song record fields in the order they are stored in the database
+    songFields = ["name", "artist", "cassettecolor", "tutorial", "difficulties"]
+
+    # Smallest number of outdated songs worth starting worker threads for
+    parallelThreshold = 64
+
+    def __init__(self, fileName = None):
+        if fileName is None:
+            fileName = os.path.join(getWritableResourcePath(), "songindex.db")
+        self.fileName    = fileName
+        self.directories = {}
+        self.db          = self._open(fileName)
+
+        # Read the whole index at once, one query per directory is too slow
+        self.directoryRows = dict([(row[0], row[1:]) for row in self.db.execute("SELECT * FROM directories")])
+        self.songRows      = dict([(row[0], row[1:]) for row in self.db.execute("SELECT * FROM songs")])
+
+    def _open(self, fileName):
+        try:
+            db = sqlite3.connect(fileName)
+            self._createTables(db)
+        except sqlite3.DatabaseError, e:
+            # Start over with an empty index if the file is damaged
+            log.warn("Song index %s is unusable, rebuilding it: %s" % (fileName, e))
+            os.unlink(fileName)
+            db = sqlite3.connect(fileName)
+            self._createTables(db)
+        return db
+
+    def _createTables(self, db):
+        # Paths and song.ini values are stored as they are on disk
+        db.text_factory = str
+        if db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            db.execute("DROP TABLE IF EXISTS directories")
+            db.execute("DROP TABLE IF EXISTS songs")
+            db.execute("PRAGMA user_version = %d" % self.version)
+        db.execute("CREATE TABLE IF NOT EXISTS directories "
+                   "(path TEXT PRIMARY KEY, mtime REAL, dirs TEXT, songIni INTEGER, libraryIni INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS songs "
+                   "(path TEXT PRIMARY KEY, mtime REAL, dirMtime REAL, %s TEXT)" % " TEXT, ".join(self.songFields))
+        db.commit()
+
+    def close(self):
+        """Write the pending changes to disk and close the index."""
+        self.db.commit()
+        self.db.close()
+
+    def _getMtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def getDirectory(self, path):
+        """
+        Get the contents of a directory.
+
+        @param path:  Directory path
+        @return:      Tuple (subdirectory names, has song.ini, has library.ini)
+        """
+        if path in self.directories:
+            return self.directories[path]
+
+        mtime = self._getMtime(path)
+        if mtime is None:
+            entry = ([], False, False)
+            self.directories[path] = entry
+            return entry
+
+        row = self.directoryRows.get(path)
+        if row and row[0] == mtime:
+            entry = (row[1] and row[1].split("\n") or [], bool(row[2]), bool(row[3]))
+        else:
+            entry = self._scanDirectory(path)
+            if row:
+                self._removeChildren(path, row[1] and row[1].split("\n") or [], entry[0])
+            row = (mtime, "\n".join(entry[0]), int(entry[1]), int(entry[2]))
+            self.directoryRows[path] = row
+            self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", (path, ) + row)
+        self.directories[path] = entry
+        return entry
+
+    def _scanDirectory(self, path):
+        dirs, songIni, libraryIni = [], False, False
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        names.sort()
+        for name in names:
+            if name == "song.ini":
+                songIni = os.path.isfile(os.path.join(path, name))
+            elif name == "library.ini":
+                libraryIni = os.path.isfile(os.path.join(path, name))
+            elif os.path.isdir(os.path.join(path, name)):
+                dirs.append(name)
+        return (dirs, songIni, libraryIni)
+
+    def _removeChildren(self, path, oldDirs, newDirs):
+        # Forget the directories that no longer exist
+        for name in set(oldDirs) - set(newDirs):
+            child = os.path.join(path, name)
+            self.directoryRows.pop(child, None)
+            self.songRows.pop(os.path.join(child, "song.ini"), None)
+            self.db.execute("DELETE FROM directories WHERE path = ?", (child, ))
+            self.db.execute("DELETE FROM songs WHERE path = ?", (os.path.join(child, "song.ini"), ))
+
+    def getSongNames(self, songRoot):
+        """
+        Get the names of the songs in a song directory.
+
+        @param songRoot:  Directory that contains song directories
+        @return:          List of song directory names
+        """
+        return [name for name in self.getDirectory(songRoot)[0]
+                if not name.startswith(".") and self.getDirectory(os.path.join(songRoot, name))[1]]
+
+    def getSongRecord(self, infoFileName, scan):
+        """
+        Get the indexed information of a song.
+
+        @param infoFileName:  Path to the song.ini file
+        @param scan:          Function that reads a song record from the song.ini
+                              file if the indexed record is missing or outdated.
+                              The record is a dictionary with the keys in
+                              L{songFields}.
+        @return:              Song record dictionary
+        """
+        if self._isSongRecordValid(infoFileName):
+            record = dict(zip(self.songFields, self.songRows[infoFileName][2:]))
+            if record["difficulties"] is not None:
+                record["difficulties"] = [int(d) for d in record["difficulties"].split(",") if d]
+            return record
+
+        record = scan(infoFileName)
+        record = dict([(field, record.get(field)) for field in self.songFields])
+        self._storeSongRecord(infoFileName, [record[field] for field in self.songFields])
+        return record
+
+    def updateSongRecords(self, infoFileNames, scan, progress = None, threads = None):
+        """
+        Rescan all the outdated song records in one go.
+
+        Scanning a song means reading its song.ini and notes.mid files, so
+        large batches are shared by a pool of worker threads that keep the
+        disk busy. The records are stored as they come back from the workers.
+        Threads are used instead of processes because this is called while
+        the game is running other threads, which makes forking unsafe.
+
+        @param infoFileNames:  List of song.ini paths
+        @param scan:           Thread safe function that reads a song record,
+                               see L{getSongRecord}
+        @param progress:       Optional function called with the number of
+                               scanned songs and the total number of songs to scan
+        @param threads:        Number of worker threads, defaults to the number of CPUs
+        """
+        outdated = [f for f in infoFileNames if not self._isSongRecordValid(f)]
+        if not outdated:
+            return
+
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+
+        pool = None
+        if threads > 1 and len(outdated) >= self.parallelThreshold:
+            try:
+                pool = ThreadPool(threads)
+            except Exception, e:
+                log.warn("Unable to start song scanner threads: %s" % e)
+
+        if pool:
+            chunkSize = max(1, min(64, len(outdated) / (threads * 4)))
+            results   = pool.imap_unordered(_scanWorker, [(scan, f) for f in outdated], chunkSize)
+        else:
+            results   = (_scanWorker((scan, f)) for f in outdated)
+
+        try:
+            for i, (infoFileName, values) in enumerate(results):
+                # Report the error in the calling thread if a worker failed
+                if values is None:
+                    record = scan(infoFileName)
+                    values = [record.get(field) for field in self.songFields]
+                self._storeSongRecord(infoFileName, values)
+                if progress:
+                    progress(i + 1, len(outdated))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def _isSongRecordValid(self, infoFileName):
+        row = self.songRows.get(infoFileName)
+        return row is not None and \
+               row[0] == self._getMtime(infoFileName) and \
+               row[1] == self._getMtime(os.path.dirname(infoFileName))
+
+    def _storeSongRecord(self, infoFileName, values):
+        values = list(values)
+        if values[-1] is not None:
+            values[-1] = ",".join([str(d) for d in values[-1]])
+        row = tuple([self._getMtime(infoFileName), self._getMtime(os.path.dirname(infoFileName))] + values)
+        self.songRows[infoFileName] = row
+        self.db.execute("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, %s)" % ", ".join(["?"] * len(self.songFields)),
+                        (infoFileName, ) + row)
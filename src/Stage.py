@@ -25,6 +25,7 @@ from OpenGL.GL import *
 import math
 
 import Theme
+import GLState
 
 class Layer(object):
     """
@@ -72,9 +73,9 @@ class Layer(object):
         for effect in self.effects:
             effect.apply()
 
-        glBlendFunc(self.srcBlending, self.dstBlending)
+        GLState.blendFunc(self.srcBlending, self.dstBlending)
         self.drawing.draw(color = self.color)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        GLState.blendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
 class Effect(object):
     """
@@ -326,10 +327,13 @@ class Stage(object):
         finally:
             self.engine.view.resetProjection()
 
-    def run(self, pos, period):
+    def run(self, pos, period, tempoMap = None):
         self.pos        = pos
         self.beatPeriod = period
-        quarterBeat = int(4 * pos / period)
+        if tempoMap:
+            quarterBeat = int(4 * tempoMap.timeToBeats(pos))
+        else:
+            quarterBeat = int(4 * pos / period)
 
         if quarterBeat > self.quarterBeat:
             self.triggerQuarterBeat(pos, quarterBeat)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+
+"""
+Vectorized text measurement and cached text layouts.
+
+Every font has a L{GlyphTable} holding the advances, heights and texture
+coordinates of its glyphs in arrays indexed by character code, so that
+whole strings are measured and turned into glyph quads with NumPy gathers
+instead of a dictionary lookup per character. Wrapped paragraphs are laid
+out once by L{wrapText} and then redrawn from their cached glyph quads.
+"""
+
+import sys
+import numpy
+from collections import OrderedDict
+
+# Python strings are indexed by UTF-16 code units on narrow builds
+if sys.maxunicode > 0xffff:
+    UNICODE_CODEC, UNICODE_TYPE = "utf-32-le", numpy.uint32
+else:
+    UNICODE_CODEC, UNICODE_TYPE = "utf-16-le", numpy.uint16
+
+# Maximum number of wrapped layouts kept by wrapText
+LAYOUT_CACHE_SIZE = 1024
+
+def getCharacterCodes(text):
+    """
+    Get the character codes of a string.
+
+    @param text:  String or unicode string
+    @return:      Array with one character code per character
+    """
+    if isinstance(text, unicode):
+        return numpy.frombuffer(text.encode(UNICODE_CODEC), UNICODE_TYPE)
+    return numpy.frombuffer(text, numpy.uint8)
+
+class GlyphTable(object):
+    """Glyph metrics and texture coordinates of a font indexed by character code."""
+    def __init__(self, font):
+        self.font       = font
+        self.advances   = numpy.zeros(0, numpy.float64)
+        self.heights    = numpy.zeros(0, numpy.float64)
+        self.measured   = numpy.zeros(0, bool)
+        self.texCoords  = numpy.zeros((0, 4, 2), numpy.float32)
+        self.textureIds = numpy.zeros(0, numpy.int32)
+        self.rasterized = numpy.zeros(0, bool)
+        self.paddings   = numpy.zeros(0, numpy.float64)
+        self.textures   = []
+
+    def _reserve(self, code):
+        size = max(256, len(self.measured))
+        while size <= code:
+            size *= 2
+        if size == len(self.measured):
+            return
+
+        def grow(array):
+            result = numpy.zeros((size, ) + array.shape[1:], array.dtype)
+            result[:len(array)] = array
+            return result
+
+        self.advances   = grow(self.advances)
+        self.heights    = grow(self.heights)
+        self.measured   = grow(self.measured)
+        self.texCoords  = grow(self.texCoords)
+        self.textureIds = grow(self.textureIds)
+        self.rasterized = grow(self.rasterized)
+        self.paddings   = grow(self.paddings)
+
+    def invalidate(self, ch):
+        """
+        Forget the metrics of a character after its glyph has been replaced.
+
+        @param ch:    Character
+        """
+        code = ord(ch)
+        if code < len(self.measured):
+            self.measured[code]   = False
+            self.rasterized[code] = False
+
+    def measure(self, codes):
+        """
+        Get the unscaled advances and heights of some characters.
+
+        @param codes:   Character code array
+        @return:        (advances, heights) arrays
+        """
+        if len(codes) and codes.max() >= len(self.measured):
+            self._reserve(codes.max())
+
+        measured = self.measured[codes]
+        if not measured.all():
+            for code in set(codes[~measured].tolist()):
+                self.advances[code], self.heights[code] = self.font.getGlyphSize(unichr(code))
+                self.measured[code] = True
+        return self.advances[codes], self.heights[codes]
+
+    def getQuads(self, codes, scale, direction = (1, 0)):
+        """
+        Lay out the glyph quads of a string starting at the origin.
+
+        @param codes:       Character code array
+        @param scale:       Scale factor
+        @param direction:   Text direction vector (x, y)
+        @return:            (vertices, texture coordinates, texture indices)
+                            tuple, where the first two are arrays of four
+                            points per glyph, see L{getRuns}
+        """
+        advances, heights = self.measure(codes)
+
+        rasterized = self.rasterized[codes]
+        if not rasterized.all():
+            for code in set(codes[~rasterized].tolist()):
+                texture, (tx1, ty1, tx2, ty2) = self.font.getGlyph(unichr(code))
+                if not texture in self.textures:
+                    self.textures.append(texture)
+                self.textureIds[code] = self.textures.index(texture)
+                self.texCoords[code]  = ((tx1, ty2), (tx2, ty2), (tx2, ty1), (tx1, ty1))
+                self.paddings[code]   = self.font.getGlyphPadding(texture)
+                self.rasterized[code] = True
+
+        w = advances * scale
+        h = heights * scale
+        s = numpy.zeros(len(w) + 1)
+        numpy.cumsum(w, out = s[1:])
+        x = s[:-1] * direction[0]
+        y = s[:-1] * direction[1]
+
+        # Glyphs with a border around them are drawn on larger quads
+        p = self.paddings[codes] * scale
+
+        vertices = numpy.empty((len(codes), 4, 2), numpy.float32)
+        vertices[:, 0, 0] = x - p
+        vertices[:, 0, 1] = y - p
+        vertices[:, 1, 0] = x + w + p
+        vertices[:, 1, 1] = y - p
+        vertices[:, 2, 0] = x + w + p
+        vertices[:, 2, 1] = y + h + p
+        vertices[:, 3, 0] = x - p
+        vertices[:, 3, 1] = y + h + p
+
+        return vertices, self.texCoords[codes], self.textureIds[codes]
+
+    def getRuns(self, textureIds):
+        """
+        Split a sequence of glyphs into runs sharing a texture.
+
+        @param textureIds:  Texture index of each glyph
+        @return:            List of (texture, first glyph, glyph count) tuples
+        """
+        starts = [0] + (numpy.flatnonzero(numpy.diff(textureIds)) + 1).tolist()
+        ends   = starts[1:] + [len(textureIds)]
+        return [(self.textures[textureIds[i]], i, j - i) for i, j in zip(starts, ends) if j > i]
+
+class WrappedText(object):
+    """A paragraph of text wrapped inside some margins."""
+    def __init__(self, font, scale, words, end):
+        """
+        @param font:    L{Font} the text is drawn with
+        @param scale:   Scale factor
+        @param words:   List of (word index, word, x, y) tuples, where y is
+                        relative to the top of the paragraph
+        @param end:     (x, y) position where the text ends, y relative to the
+                        top of the paragraph
+        """
+        self.font     = font
+        self.scale    = scale
+        self.words    = words
+        self.end      = end
+        self.geometry = None
+
+    def render(self, y):
+        """
+        Draw the paragraph from its cached glyph quads.
+
+        @param y:   Top of the paragraph
+        """
+        if self.geometry is None:
+            self.geometry = self.font.getWordsGeometry([(word, x, wy) for n, word, x, wy in self.words], self.scale)
+        self.font.renderGeometry(self.geometry, (0, y))
+
+_layoutCache = OrderedDict()
+
+def wrapText(font, x, text, rightMargin = 0.9, scale = 0.002, hide = 0, hidestring = ""):
+    """
+    Wrap a piece of text inside given margins. The layouts are cached, so
+    wrapping the same text again is cheap.
+
+    @param font:        L{Font} the text is drawn with
+    @param x:           Left margin
+    @param text:        Text to wrap
+    @param rightMargin: Right margin
+    @param scale:       Text scale
+    @param hide:        Cut the text with hidestring instead of wrapping it
+    @param hidestring:  Text drawn in place of the cut part
+    @return:            L{WrappedText} instance
+    """
+    key = (font, x, text, rightMargin, scale, hide, hidestring)
+    try:
+        layout = _layoutCache.pop(key)
+        _layoutCache[key] = layout
+        return layout
+    except KeyError:
+        pass
+
+    words   = []
+    left, y = x, 0.0
+    space   = font.getStringSize(" ", scale = scale)[0]
+    hidew   = font.getStringSize(hidestring, scale = scale)[0]
+    rightMargin -= hidew
+    for n, word in enumerate(text.split(" ")):
+        w, h = font.getStringSize(word, scale = scale)
+        if x + w > rightMargin and hide:
+            word = hidestring
+        if (x + w > rightMargin and not hide) or word == "\n":
+            x = left
+            y += h
+        if word == "\n":
+            continue
+        if word:
+            words.append((n, word, x, y))
+        if x + w > rightMargin and hide:
+            x += hidew + space
+            break
+        x += w + space
+
+    layout = WrappedText(font, scale, words, (x - space, y))
+    _layoutCache[key] = layout
+    if len(_layoutCache) > LAYOUT_CACHE_SIZE:
+        _layoutCache.popitem(last = False)
+    return layout
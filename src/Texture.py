@@ -23,17 +23,23 @@
 from __future__ import division
 
 import pygame
+import numpy
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from Queue import Queue, Empty
+from threading import Thread
+import sys
+import time
 
 from PIL import Image
 
 from fretwork import log
 
 import Config
+import GLState
 
 Config.define("opengl", "supportfbo", bool, False)
+Config.define("opengl", "uploadbudget", float, 4.0)
 
 class TextureException(Exception):
     pass
@@ -50,6 +56,13 @@ def _getGlExtension(ext):
 # The functions are called in the main OpenGL thread.
 cleanupQueue = Queue()
 
+# Queues of the textures being loaded in the background, see Texture.loadFileInBackground
+decodeQueue  = Queue()
+uploadQueue  = Queue()
+
+# Number of threads decoding images for background loaded textures
+DECODER_THREADS = 2
+
 class Framebuffer:
     fboSupported = None
 
@@ -72,7 +85,7 @@ class Framebuffer:
             glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.fb)
             self._checkError()
 
-        glBindTexture(GL_TEXTURE_2D, self.colorbuf)
+        GLState.bindTexture(GL_TEXTURE_2D, self.colorbuf)
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         # PyOpenGL does not support NULL textures, so we must make a temporary buffer here
         glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0,
@@ -153,7 +166,7 @@ class Framebuffer:
 
     def setAsRenderTarget(self):
         if not self.emulated:
-            glBindTexture(GL_TEXTURE_2D, 0)
+            GLState.bindTexture(GL_TEXTURE_2D, 0)
             glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.fb)
             self._checkError()
 
@@ -161,14 +174,14 @@ class Framebuffer:
         glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
         if not self.emulated:
             glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
-            glBindTexture(GL_TEXTURE_2D, self.colorbuf)
+            GLState.bindTexture(GL_TEXTURE_2D, self.colorbuf)
             if self.generateMipmap:
                 glGenerateMipmapEXT(GL_TEXTURE_2D)
                 glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
             else:
                 glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         else:
-            glBindTexture(GL_TEXTURE_2D, self.colorbuf)
+            GLState.bindTexture(GL_TEXTURE_2D, self.colorbuf)
             glCopyTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, 0, 0, self.size[0], self.size[1])
             glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
 
@@ -180,6 +193,8 @@ class Texture:
         try:
             func, args = cleanupQueue.get_nowait()
             func(*args)
+            # A deleted texture may have been bound
+            GLState.invalidate()
         except Empty:
             pass
 
@@ -187,6 +202,7 @@ class Texture:
         self.texEnv = GL_MODULATE
         self.glTarget = target
         self.framebuffer = None
+        self.pending = False
 
         self.setDefaults()
         self.name = name
@@ -199,6 +215,21 @@ class Texture:
         self.loadImage(Image.open(name))
         self.name = name
 
+    def loadFileInBackground(self, name):
+        """
+        Load the texture from disk without blocking the main thread. The
+        image is decoded and its mipmaps are built by a worker thread, and
+        the result is uploaded by L{processUploads}. Until then the texture
+        is a single transparent pixel.
+
+        @param name:  Image file name
+        """
+        self.loadEmpty((1, 1), GL_RGBA)
+        self.name    = name
+        self.pending = True
+        _startDecoders()
+        decodeQueue.put((self, name, glGetInteger(GL_MAX_TEXTURE_SIZE)))
+
     def loadImage(self, image):
         """Load the texture from a PIL image"""
         image = image.transpose(Image.FLIP_TOP_BOTTOM)
@@ -291,18 +322,40 @@ class Texture:
         glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
         gluBuild2DMipmaps(self.glTarget, components, w, h, format, GL_UNSIGNED_BYTE, string)
 
+    def loadMipmaps(self, size, format, components, levels):
+        """
+        Load a texture from a full set of prebuilt mipmap levels.
+
+        @param size:        Size of the original image
+        @param format:      Pixel format, e.g. GL_RGBA
+        @param components:  Number of color components
+        @param levels:      List of ((width, height), string) pairs
+        """
+        self.pixelSize = size
+        self.size = (1.0, 1.0)
+        self.format = format
+        self.components = components
+        Texture.bind(self)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for level, ((w, h), string) in enumerate(levels):
+            glTexImage2D(self.glTarget, level, components, w, h, 0, format, GL_UNSIGNED_BYTE, string)
+
     def loadSubRaw(self, size, position, string, format):
         Texture.bind(self)
         glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
         glTexSubImage2D(self.glTarget, 0, position[0], position[1], size[0], size[1], format, GL_UNSIGNED_BYTE, string)
 
-    def loadEmpty(self, size, format):
+    def loadEmpty(self, size, format, string = None):
+        """Allocate the texture without mipmaps, optionally with some initial pixel data"""
         self.pixelSize = size
         self.size = (1.0, 1.0)
         self.format = format
+        if string is None:
+            string = "\x00" * (size[0] * size[1] * 4)
         Texture.bind(self)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
         glTexImage2D(GL_TEXTURE_2D, 0, format, size[0], size[1], 0,
-                     format, GL_UNSIGNED_BYTE, "\x00" * (size[0] * size[1] * 4))
+                     format, GL_UNSIGNED_BYTE, string)
 
     def setDefaults(self):
         """Set the default OpenGL options for this texture"""
@@ -331,8 +384,98 @@ class Texture:
         """Bind this texture to self.glTarget in the current OpenGL context"""
         if not glTarget:
             glTarget = self.glTarget
-        glBindTexture(glTarget, self.texture)
-        glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, self.texEnv)
+        GLState.bindTexture(glTarget, self.texture)
+        GLState.texEnv(self.texEnv)
+
+#
+# Background loading
+#
+def _nearestPowerOfTwo(n):
+    # Round to a power of two the same way as gluBuild2DMipmaps
+    m = 1
+    while n > 3:
+        n >>= 1
+        m <<= 1
+    if n == 3:
+        m <<= 2
+    elif n == 2:
+        m <<= 1
+    return m
+
+def decodeImage(image, maxSize):
+    """
+    Prepare an image for L{Texture.loadMipmaps}. The image is scaled to
+    power of two dimensions and a full chain of mipmaps is built, like
+    gluBuild2DMipmaps does on the main thread.
+
+    @param image:     PIL image
+    @param maxSize:   Maximum texture size
+    @return:          (size, format, components, levels) tuple
+    """
+    formats = {
+      "RGBA": (GL_RGBA,      4),
+      "RGB":  (GL_RGB,       3),
+      "L":    (GL_LUMINANCE, 1),
+    }
+    try:
+        format, components = formats[image.mode]
+    except KeyError:
+        raise TextureException("Unsupported image mode '%s'" % image.mode)
+
+    size  = image.size
+    image = image.transpose(Image.FLIP_TOP_BOTTOM)
+    w, h  = [min(_nearestPowerOfTwo(n), maxSize) for n in size]
+    if (w, h) != size:
+        image = image.resize((w, h), Image.BILINEAR)
+
+    levels = [((w, h), image.tobytes("raw", image.mode, 0, -1))]
+    while w > 1 or h > 1:
+        w, h  = max(1, w >> 1), max(1, h >> 1)
+        image = image.resize((w, h), Image.ANTIALIAS)
+        levels.append(((w, h), image.tobytes("raw", image.mode, 0, -1)))
+    return size, format, components, levels
+
+def _decode():
+    while True:
+        texture, name, maxSize = decodeQueue.get()
+        try:
+            uploadQueue.put((texture, decodeImage(Image.open(name), maxSize), None))
+        except:
+            uploadQueue.put((texture, None, sys.exc_info()))
+
+def _startDecoders():
+    while len(_decoders) < DECODER_THREADS:
+        thread = Thread(target = _decode)
+        thread.setDaemon(True)
+        thread.start()
+        _decoders.append(thread)
+
+_decoders = []
+
+def processUploads(budget):
+    """
+    Upload the textures decoded in the background. This is called once
+    per frame by the main loop. At least one texture is uploaded per call,
+    but no more are started once the time budget has been used up.
+
+    @param budget:    Time budget in seconds
+    @return:          Number of textures uploaded
+    """
+    start = time.time()
+    count = 0
+    while not count or time.time() - start < budget:
+        try:
+            texture, result, exception = uploadQueue.get_nowait()
+        except Empty:
+            break
+
+        texture.pending = False
+        count += 1
+        if exception:
+            log.error("Unable to load texture %s: %s" % (texture.name, exception[1]))
+            continue
+        texture.loadMipmaps(*result)
+    return count
 
 #
 # Texture atlas
@@ -343,12 +486,33 @@ class TextureAtlasFullException(Exception):
     pass
 
 class TextureAtlas(object):
-    def __init__(self, size = TEXTURE_ATLAS_SIZE):
+    def __init__(self, size = TEXTURE_ATLAS_SIZE, pixels = None, mirror = False):
+        """
+        @param size:    Width and height of the atlas in pixels
+        @param pixels:  Optional RGBA array with the initial contents of the
+                        topmost rows of the atlas, uploaded along with the
+                        rest of the texture
+        @param mirror:  Keep a copy of the used rows of the atlas in
+                        L{pixels} so that they can be saved
+        """
         self.texture      = Texture()
         self.cursor       = (0, 0)
         self.rowHeight    = 0
         self.surfaceCount = 0
-        self.texture.loadEmpty((size, size), GL_RGBA)
+        self.pixels       = None
+
+        if pixels is None:
+            self.texture.loadEmpty((size, size), GL_RGBA)
+        else:
+            data = numpy.zeros((size, size, 4), numpy.uint8)
+            data[:len(pixels)] = pixels
+            self.texture.loadEmpty((size, size), GL_RGBA, data.tostring())
+
+        if mirror:
+            if pixels is None:
+                self.pixels = numpy.zeros((0, size, 4), numpy.uint8)
+            else:
+                self.pixels = numpy.array(pixels, numpy.uint8)
 
     def add(self, surface, margin = 0):
         w, h = surface.get_size()
@@ -369,11 +533,19 @@ class TextureAtlas(object):
             log.debug("Texture atlas %s full after %d surfaces." % (self.texture.pixelSize, self.surfaceCount))
             raise TextureAtlasFullException()
 
-        self.texture.loadSubsurface(surface, position = (x, y), alphaChannel = True)
+        string = pygame.image.tostring(surface, "RGBA", True)
+        self.texture.loadSubRaw(surface.get_size(), (x, y), string, GL_RGBA)
+
+        if self.pixels is not None:
+            sw, sh = surface.get_size()
+            if len(self.pixels) < y + sh:
+                rows        = numpy.zeros((y + sh - len(self.pixels), self.pixels.shape[1], 4), numpy.uint8)
+                self.pixels = numpy.concatenate((self.pixels, rows))
+            self.pixels[y:y + sh, x:x + sw] = numpy.frombuffer(string, numpy.uint8).reshape((sh, sw, 4))
 
         self.surfaceCount += 1
         self.rowHeight = max(self.rowHeight, h)
-        self.cursor = (x + w, y + h)
+        self.cursor = (x + w, y)
 
         # Return the coordinates for the uploaded texture patch
         w -= margin
@@ -0,0 +1,370 @@
+# -*- coding: ISO-8859-1 -*-
+
+# third party
+import numpy
+
+# custom
+from EventDispatcher import EventDispatcher
+from constants import *
+
+
+# One row per event. Channel messages use data1 and data2, meta and sysex
+# events point into the file data with offset and length.
+EVENT_DTYPE = numpy.dtype([
+    ('tick',    numpy.int64),
+    ('status',  numpy.uint8),
+    ('channel', numpy.uint8),
+    ('data1',   numpy.uint8),
+    ('data2',   numpy.uint8),
+    ('meta',    numpy.uint8),
+    ('offset',  numpy.uint32),
+    ('length',  numpy.uint32),
+])
+
+# number of data bytes of a channel message by its high nibble
+CHANNEL_DATA_SIZES = [0] * 8 + [2, 2, 2, 2, 1, 1, 2, 0]
+
+# number of data bytes of the system common messages
+COMMON_DATA_SIZES = {
+    0xF1:1,
+    0xF2:2,
+    0xF3:1,
+}
+
+
+
+def parseTrack(data, start, end):
+
+    """
+    Parses the events of a track chunk body in data[start:end] into an
+    array of EVENT_DTYPE. data must index to integers, like a bytearray.
+    Nothing is copied out of data, meta and sysex events only remember 
+    where their data is.
+    Like MidiFileParser, the track ends at the first meta event without 
+    data, which normally is the end of track event. That event is the 
+    last row of the array.
+    """
+
+    ticks, statuses, data1s, data2s, metas, offsets, lengths = [], [], [], [], [], [], []
+
+    tick = 0
+    running_status = 0
+    pos = start
+
+    while pos < end:
+
+        # variable length delta time
+        value = data[pos]
+        pos += 1
+        delta = value & 0x7F
+        while value & 0x80:
+            value = data[pos]
+            pos += 1
+            delta = (delta << 7) | (value & 0x7F)
+        tick += delta
+
+        # be aware of running status
+        status = data[pos]
+        if status & 0x80:
+            pos += 1
+            if status < 0xF0:
+                running_status = status
+        elif running_status:
+            status = running_status
+        else:
+            raise ValueError, 'Running status without a status byte at %d' % pos
+
+        data1 = data2 = meta = offset = length = 0
+
+        if status < 0xF0:
+            # channel voice message
+            size = CHANNEL_DATA_SIZES[status >> 4]
+            data1 = data[pos]
+            if size == 2:
+                data2 = data[pos + 1]
+            pos += size
+
+        elif status == META_EVENT or status == SYSTEM_EXCLUSIVE or status == END_OFF_EXCLUSIVE:
+            if status == META_EVENT:
+                meta = data[pos]
+                pos += 1
+            value = data[pos]
+            pos += 1
+            length = value & 0x7F
+            while value & 0x80:
+                value = data[pos]
+                pos += 1
+                length = (length << 7) | (value & 0x7F)
+            offset = pos
+            pos += length
+
+        else:
+            # system common message
+            size = COMMON_DATA_SIZES.get(status, 0)
+            if size:
+                data1 = data[pos]
+            if size == 2:
+                data2 = data[pos + 1]
+            pos += size
+
+        ticks.append(tick)
+        statuses.append(status)
+        data1s.append(data1)
+        data2s.append(data2)
+        metas.append(meta)
+        offsets.append(offset)
+        lengths.append(length)
+
+        if status == META_EVENT and (meta == END_OF_TRACK or not length):
+            break
+
+    events = numpy.zeros(len(ticks), EVENT_DTYPE)
+    events['tick'] = ticks
+    events['status'] = statuses
+    events['data1'] = data1s
+    events['data2'] = data2s
+    events['meta'] = metas
+    events['offset'] = offsets
+    events['length'] = lengths
+    channel_messages = events['status'] < 0xF0
+    events['channel'][channel_messages] = events['status'][channel_messages] & 0x0F
+    return events
+
+
+
+class MidiEventTable:
+
+    """
+
+    Parses a whole midi file into NumPy structured arrays, one array of
+    EVENT_DTYPE per track, with absolute tick times. This is a lot faster
+    than triggering a callback per event and the arrays can be processed
+    with vectorized NumPy operations.
+
+    >>> table = MidiEventTable('notes.mid')
+    >>> events = table.tracks[0]
+    >>> notes = events[(events['status'] & 0xF0) == NOTE_ON]
+
+    The callback interface is still available through dispatch().
+
+    Only some of the tracks can be decoded by passing a list of track 
+    numbers and/or track names as 'tracks'. The other track chunks are 
+    skipped by their length and get an empty event array.
+
+    >>> table = MidiEventTable('notes.mid', tracks=[0, 'PART GUITAR'])
+
+    """
+
+    def __init__(self, infile=None, tracks=None):
+
+        """
+        If 'infile' is a string we assume it is a path and read from 
+        that file. If it is a file descriptor we read from the file, 
+        but we don't close it.
+        """
+
+        self.data = bytearray()
+        self.format = 0
+        self.nTracks = 0
+        self.division = 96
+        self.tracks = []
+        self.skipped = []
+        if infile:
+            self.read(infile, tracks)
+
+
+    def read(self, infile, tracks=None):
+
+        "Reads and parses a midi file"
+
+        if type(infile) in [str, unicode]:
+            f = open(infile, 'rb')
+            self.setData(f.read(), tracks)
+            f.close()
+        else:
+            self.setData(infile.read(), tracks)
+
+
+    def setData(self, data='', tracks=None):
+
+        """
+        Parses the midi data in a string, mmap, memoryview or bytearray.
+        """
+
+        # Indexing a bytearray gives integers, so the data is copied 
+        # only this once and never sliced per event
+        self.data = bytearray(data)
+        self.parseMThdChunk()
+        self.tracks = []
+        self.skipped = []
+
+        for index, (offset, length, name) in enumerate(self.getChunkDirectory()):
+            if tracks is None or index in tracks or (name is not None and name in tracks):
+                self.tracks.append(parseTrack(self.data, offset, offset + length))
+            else:
+                self.tracks.append(numpy.zeros(0, EVENT_DTYPE))
+                self.skipped.append(index)
+
+
+    def parseMThdChunk(self):
+
+        "Parses the header chunk"
+
+        data = self.data
+        if data[:4] != 'MThd':
+            raise TypeError, "It is not a valid midi file!"
+        self.format = (data[8] << 8) | data[9]
+        self.nTracks = (data[10] << 8) | data[11]
+        self.division = (data[12] << 8) | data[13]
+
+
+    def getChunkDirectory(self):
+
+        """
+        Returns a list of (offset, length, name) tuples, one for each 
+        track chunk. offset and length give the position of the chunk 
+        body in the data and name is the track name meta event or None. 
+        Only the chunk headers and the first events of each track are 
+        looked at. Chunks of unknown type are skipped.
+        """
+
+        data = self.data
+        chunks = []
+        pos = 8 + self._readLength(4)
+        while pos + 8 <= len(data) and len(chunks) < self.nTracks:
+            chunk_type = data[pos:pos + 4]
+            start = pos + 8
+            end = start + self._readLength(pos + 4)
+            if chunk_type == 'MTrk':
+                end = min(end, len(data))
+                chunks.append((start, end - start, self._readTrackName(start, end)))
+            pos = end
+        return chunks
+
+
+    def getTrackChunks(self):
+
+        "Returns a list of (start, end) tuples of the track chunk bodies."
+
+        return [(offset, offset + length) for offset, length, name in self.getChunkDirectory()]
+
+
+    def _readTrackName(self, pos, end):
+
+        """
+        Returns the name of a track. The name comes before the first 
+        channel message, so only the leading meta events are read.
+        """
+
+        data = self.data
+        while pos < end:
+            # skip the delta time
+            while data[pos] & 0x80:
+                pos += 1
+            pos += 1
+            if data[pos] != META_EVENT:
+                return None
+            meta_type = data[pos + 1]
+            pos += 2
+            length = 0
+            while data[pos] & 0x80:
+                length = (length << 7) | (data[pos] & 0x7F)
+                pos += 1
+            length = (length << 7) | data[pos]
+            pos += 1
+            if meta_type == SEQUENCE_NAME:
+                return str(data[pos:pos + length])
+            if meta_type == END_OF_TRACK:
+                return None
+            pos += length
+        return None
+
+
+    def _readLength(self, pos):
+        "Reads a big endian 32 bit value"
+        data = self.data
+        return (data[pos] << 24) | (data[pos + 1] << 16) | (data[pos + 2] << 8) | data[pos + 3]
+
+
+    def getData(self, event):
+
+        "Returns the data of a meta or sysex event as a string"
+
+        offset = int(event['offset'])
+        return str(self.data[offset:offset + int(event['length'])])
+
+
+    def dispatch(self, outstream):
+
+        """
+        Triggers the events of the table on an outstream in the same 
+        order as MidiFileParser does.
+        """
+
+        dispatch = EventDispatcher(outstream)
+        data = self.data
+
+        dispatch.header(self.format, self.nTracks, self.division)
+
+        for track, events in enumerate(self.tracks):
+            if track in self.skipped:
+                continue
+            dispatch.reset_time()
+            dispatch.start_of_track(track)
+
+            rows = zip(events['tick'].tolist(), events['status'].tolist(), events['data1'].tolist(),
+                       events['data2'].tolist(), events['meta'].tolist(), events['offset'].tolist(),
+                       events['length'].tolist())
+
+            for tick, status, data1, data2, meta, offset, length in rows:
+                outstream.update_time(tick, relative=0)
+
+                if status < 0xF0:
+                    hi_nible, channel = status & 0xF0, status & 0x0F
+                    if hi_nible == NOTE_ON:
+                        if data2 == 0 and dispatch.convert_zero_velocity:
+                            outstream.note_off(channel, data1, 0x40)
+                        else:
+                            outstream.note_on(channel, data1, data2)
+                    elif hi_nible == NOTE_OFF:
+                        outstream.note_off(channel, data1, data2)
+                    elif hi_nible == AFTERTOUCH:
+                        outstream.aftertouch(channel, data1, data2)
+                    elif hi_nible == CONTINUOUS_CONTROLLER:
+                        outstream.continuous_controller(channel, data1, data2)
+                    elif hi_nible == PATCH_CHANGE:
+                        outstream.patch_change(channel, data1)
+                    elif hi_nible == CHANNEL_PRESSURE:
+                        outstream.channel_pressure(channel, data1)
+                    elif hi_nible == PITCH_BEND:
+                        outstream.pitch_bend(channel, (data1 << 7) + data2)
+
+                elif status == META_EVENT:
+                    # MidiFileParser ends the track at an empty meta event 
+                    # without triggering it, so a regular end of track 
+                    # event is never passed on
+                    if not length:
+                        break
+                    dispatch.meta_event(meta, str(data[offset:offset + length]))
+
+                elif status == SYSTEM_EXCLUSIVE or status == END_OFF_EXCLUSIVE:
+                    # don't pass the sysex terminator
+                    if length and data[offset + length - 1] == END_OFF_EXCLUSIVE:
+                        length -= 1
+                    dispatch.sysex_event(str(data[offset:offset + length]))
+
+                else:
+                    size = COMMON_DATA_SIZES.get(status, 0)
+                    common_data = ''.join([chr(b) for b in (data1, data2)[:size]])
+                    dispatch.system_commons(status, common_data)
+
+        dispatch.eof()
+
+
+
+if __name__ == '__main__':
+
+    import sys
+    from MidiToText import MidiToText
+
+    MidiEventTable(sys.argv[1]).dispatch(MidiToText())
@@ -2,6 +2,7 @@
 
 from RawInstreamFile import RawInstreamFile
 from MidiFileParser import MidiFileParser
+from MidiEventTable import MidiEventTable
 
 
 class MidiInFile:
@@ -35,17 +36,22 @@ class MidiInFile:
 
     """
 
-    def __init__(self, outStream, infile):
+    def __init__(self, outStream, infile, tracks=None):
         # these could also have been mixins, would that be better? Nah!
         self.raw_in = RawInstreamFile(infile)
         self.parser = MidiFileParser(self.raw_in, outStream)
+        self.outStream = outStream
+        # track numbers and/or names to read, see MidiEventTable
+        self.tracks = tracks
 
 
     def read(self):
         "Start parsing the file"
-        p = self.parser
-        p.parseMThdChunk()
-        p.parseMTrkChunks()
+        # The whole file is parsed into event tables first, which is 
+        # much faster than the event by event MidiFileParser
+        table = MidiEventTable()
+        table.setData(self.raw_in.data, self.tracks)
+        table.dispatch(self.outStream)
 
 
     def setData(self, data=''):
@@ -4,4 +4,5 @@ from MidiOutStream import MidiOutStream
 from MidiOutFile import MidiOutFile
 from MidiInStream import MidiInStream
 from MidiInFile import MidiInFile
+from MidiEventTable import MidiEventTable
 from MidiToText import MidiToText
@@ -0,0 +1,69 @@
+#####################################################################
+# -*- coding: iso-8859-1 -*-                                        #
+#                                                                   #
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kystil                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+
+import unittest
+import time
+import Clock
+
+class ClockTest(unittest.TestCase):
+    def testMonotonic(self):
+        times = [Clock.getTime() for i in range(1000)]
+        assert times == sorted(times)
+
+    def testResolution(self):
+        t1 = Clock.getTime()
+        time.sleep(.05)
+        t2 = Clock.getTime()
+        assert 40 < t2 - t1 < 500
+
+    def testSystemTimeChange(self):
+        clock, getTicks = Clock._clock, Clock._getTicks
+        now             = [1000.0]
+        ticks           = [5000]
+
+        def advance(ms, jump = 0.0):
+            now[0]   += ms / 1000.0 + jump
+            ticks[0] += int(ms)
+            return Clock.getTime()
+
+        try:
+            Clock._clock    = lambda: now[0]
+            Clock._getTicks = lambda: ticks[0]
+            t = Clock.getTime()
+
+            # The high resolution clock is used while it agrees with the ticks
+            assert abs(advance(10.5) - t - 10.5) < 1e-6
+            t = advance(16)
+
+            # The ticks are used when the system time goes backwards or forwards
+            assert abs(advance(16, -60.0) - t - 16) < 1e-6
+            t = Clock.getTime()
+            assert abs(advance(16, 3600.0) - t - 16) < 1e-6
+            t = Clock.getTime()
+            assert abs(advance(16) - t - 16) < 1e-6
+        finally:
+            Clock._clock    = clock
+            Clock._getTicks = getTicks
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+import numpy
+from GameEngine import GameEngine
+from Font import Font, createDistanceField, SDF_PADDING, SDF_SHADOW
+
+def createCoverage():
+    # A square glyph with an antialiased left edge
+    coverage = numpy.zeros((24, 24), numpy.uint8)
+    coverage[4:20, 6:20] = 255
+    coverage[4:20, 5]    = 100
+    return coverage
+
+class DistanceFieldTest(unittest.TestCase):
+    def testEdge(self):
+        coverage = createCoverage()
+        field    = createDistanceField(coverage)
+        p        = SDF_PADDING
+
+        assert field.shape == (24 + 2 * p, 24 + 2 * p, 4)
+
+        # The half alpha level lies on the edge of the covered texels
+        inside = numpy.zeros(field.shape[:2], bool)
+        inside[p:p + 24, p:p + 24] = coverage >= 128
+        assert ((field[..., 3] >= 128) == inside).all()
+        assert (field[..., :3][inside] == 255).all()
+        assert (field[..., :3][~inside] == 0).all()
+
+        # The texels next to a straight edge are as far above the half
+        # level as the ones on the other side are below it
+        alpha = field[..., 3].astype(int)
+        for y in range(p + 6, p + 18):
+            assert abs(alpha[y, p + 5] + alpha[y, p + 6] - 255) <= 2
+            assert abs(alpha[y, p + 19] + alpha[y, p + 20] - 255) <= 2
+
+    def testShadow(self):
+        coverage = createCoverage()
+        plain    = createDistanceField(coverage)
+        shadowed = createDistanceField(coverage, SDF_SHADOW)
+        s        = SDF_SHADOW
+
+        # The shadow is black and does not change the glyph itself
+        assert (shadowed[..., :3] == plain[..., :3]).all()
+        assert (shadowed[..., 3] >= plain[..., 3]).all()
+
+        # The alpha is the glyph and its copy offset by the shadow
+        expected = plain[..., 3].copy()
+        expected[s:, s:] = numpy.maximum(expected[s:, s:], plain[:-s, :-s, 3])
+        assert (shadowed[..., 3] == expected).all()
+
+        # Below and right of the glyph the shadow is opaque
+        p = SDF_PADDING
+        assert plain[p + 20, p + 20, 3] < 128
+        assert shadowed[p + 20, p + 20, 3] >= 128
+        assert shadowed[p + 20, p + 20, :3].tolist() == [0, 0, 0]
+
+    def testDistanceFieldSize(self):
+        font = Font(self.e.resource.fileName("default.ttf"), 22, sdf = True)
+        for f in [font, font.derive(108)]:
+            w, h     = f.getStringSize("Hello")
+            geometry = f._getStringGeometry("Hello", (1, 0), 0.002 * f.scale)
+            vertices = numpy.concatenate([v for texture, count, v, t in geometry])
+
+            # The quads have a border around the glyphs
+            pad = 2 * f.getGlyphPadding(geometry[0][0]) * 0.002 * f.scale
+            assert abs(vertices[:, 0].max() - vertices[:, 0].min() - pad - w) < 1e-6
+            assert abs(vertices[:, 1].max() - vertices[:, 1].min() - pad - h) < 1e-6
+
+    def setUp(self):
+        self.e = GameEngine()
+
+if __name__ == "__main__":
+    unittest.main()
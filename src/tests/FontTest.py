@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+import shutil, os
+import numpy
+
+from GameEngine import GameEngine
+from Font import Font, GlyphAtlasCache, parseCharacterSet, HUD_TEXT_LENGTH
+from Texture import Texture
+
+class FontTest(unittest.TestCase):
+    def setUp(self):
+        self.e   = GameEngine()
+        self.tmp = "fonttest_tmp"
+        os.mkdir(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testCharacterSet(self):
+        assert parseCharacterSet("65-67,0x61") == u"ABCa"
+        assert parseCharacterSet(" 32 , 33-33,") == u" !"
+        assert parseCharacterSet("") == u""
+
+        # Invalid parts are skipped
+        assert parseCharacterSet("x-y,65,70-66,-5,66-") == u"A"
+
+    def testAtlasCacheEntries(self):
+        cache   = GlyphAtlasCache(os.path.join(self.tmp, "fonts"))
+        key     = ("0123abcd", 22, False, False, False, False, False)
+        columns = {
+          "pixels": numpy.arange(64, dtype = numpy.uint8).reshape((2, 8, 4)),
+          "cursor": numpy.array((3, 4)),
+        }
+        assert cache.read(key) is None
+
+        cache.store(key, columns, background = False)
+        entry = cache.read(key)
+        assert sorted(entry.keys()) == ["cursor", "key", "pixels", "version"]
+        assert (entry["pixels"] == columns["pixels"]).all()
+        assert tuple(entry["cursor"]) == (3, 4)
+
+        # Entries of other fonts are not used
+        otherKey = key[:1] + (23, ) + key[2:]
+        shutil.copy(cache.getEntryFileName(key), cache.getEntryFileName(otherKey))
+        assert cache.read(otherKey) is None
+
+        # Neither are entries from other versions of the cache
+        cache.version += 1
+        assert cache.read(key) is None
+
+    def testAtlasReload(self):
+        fileName = self.e.resource.fileName("default.ttf")
+        cache    = GlyphAtlasCache(os.path.join(self.tmp, "fonts"))
+        text     = u"Frets on Fire 123"
+
+        font = Font(fileName, 22, atlasCache = cache)
+        font.warmUp([text])
+        font.saveGlyphAtlas(background = False)
+
+        # A new font reads the glyphs back from the cache
+        font2 = Font(fileName, 22, atlasCache = cache)
+        assert font2.atlasEntry is not None
+        for ch in text:
+            assert font2.getGlyph(ch)[1] == font.getGlyph(ch)[1]
+            assert font2.getGlyphSize(ch) == font.getGlyphSize(ch)
+        assert len(font2.glyphTextures) == 1
+        assert font2.glyphTextures[0].cursor == font.glyphTextures[0].cursor
+        assert (font2.glyphTextures[0].pixels == font.glyphTextures[0].pixels).all()
+
+        # Other sizes have entries of their own
+        assert Font(fileName, 23, atlasCache = cache).atlasEntry is None
+
+    def testStringCache(self):
+        font     = Font(self.e.resource.fileName("default.ttf"), 22)
+        geometry = lambda text: font._getStringGeometry(text, (1, 0), 0.002)
+
+        # Each glyph takes 64 bytes of vertices and texture coordinates
+        font.stringCacheBudget = 64 * 10
+        for text in ["abc", "defg", "hij"]:
+            geometry(text)
+        assert font.stringCacheBytes == font.stringCacheBudget
+
+        # The least recently used string is evicted first
+        entry = geometry("abc")
+        geometry("kl")
+        assert [key[0] for key in font.stringCache.keys()] == ["hij", "abc", "kl"]
+        assert geometry("abc") is entry
+        assert font.stringCacheHits == 2
+        assert font.stringCacheMisses == 4
+        assert font.stringCacheEvictions == 1
+
+        # Strings larger than the budget are not cached
+        geometry("x" * 11)
+        assert len(font.stringCache) == 3
+
+        size = 0
+        for entry in font.stringCache.values():
+            size += sum([vertices.nbytes + texCoords.nbytes for texture, count, vertices, texCoords in entry])
+        assert font.stringCacheBytes == size == sum(font.stringCacheSizes.values())
+
+    def testOutlineArrays(self):
+        font  = Font(self.e.resource.fileName("default.ttf"), 22, outline = True)
+        calls = []
+        font._drawString = lambda geometry, pos, setup = True: calls.append(setup)
+
+        # The outline leaves the arrays of a single texture bound for the text
+        geometry = font._getStringGeometry("abc", (1, 0), 0.002)
+        assert len(geometry) == 1
+        font.renderGeometry(geometry)
+        assert calls == [True, False]
+
+        del calls[:]
+        font.renderGeometry(geometry * 2)
+        assert calls == [True, True]
+
+    def testHudText(self):
+        font = Font(self.e.resource.fileName("default.ttf"), 22)
+        for text in ["12345", "98x", u"123 hit"]:
+            w, h = font.getStringSize(text)
+            hw, hh = font.getHudSize(text)
+            assert abs(hw - w) < 1e-6 and abs(hh - h) < 1e-6
+
+        # Long strings and characters outside of Latin-1 are measured like render() does
+        for text in ["1" * (HUD_TEXT_LENGTH + 1), u"\u20ac 1"]:
+            assert font._layoutHud(text, 0.002) is None
+            assert font.getHudSize(text) == font.getStringSize(text)
+
+        # Replaced glyphs are laid out again
+        font.getHudSize("1")
+        font.setCustomGlyph("1", Texture(self.e.resource.fileName("ball1.png")))
+        assert not font.hudLoaded[ord("1")]
+        assert font.getHudSize("1") == font.getStringSize("1")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#####################################################################
+# -*- coding: iso-8859-1 -*-                                        #
+#                                                                   #
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kystil                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+from GameEngine import GameEngine
+from Texture import Texture
+import GLState
+
+from OpenGL.GL import *
+
+class GLStateTest(unittest.TestCase):
+    def testRedundantCalls(self):
+        GLState.beginFrame()
+        GLState.enable(GL_TEXTURE_2D)
+        GLState.enable(GL_TEXTURE_2D)
+        GLState.blendFunc(GL_SRC_ALPHA, GL_ONE)
+        GLState.blendFunc(GL_SRC_ALPHA, GL_ONE)
+        GLState.depthMask(1)
+        GLState.depthMask(True)
+
+        assert glIsEnabled(GL_TEXTURE_2D)
+        assert GLState.counters.stateChanges == 2
+        assert GLState.counters.blendChanges == 1
+        assert GLState.counters.skipped      == 3
+
+        GLState.disable(GL_TEXTURE_2D)
+        assert not glIsEnabled(GL_TEXTURE_2D)
+
+    def testTextureBinds(self):
+        t1 = Texture()
+        t2 = Texture()
+
+        GLState.beginFrame()
+        t1.bind()
+        t1.bind()
+        t2.bind()
+        assert GLState.counters.binds == 2
+        assert glGetIntegerv(GL_TEXTURE_BINDING_2D) == t2.texture
+
+    def testFrameCounters(self):
+        GLState.beginFrame()
+        GLState.begin(GL_QUADS, 4)
+        glVertex2f(0, 0)
+        glVertex2f(1, 0)
+        glVertex2f(1, 1)
+        glVertex2f(0, 1)
+        GLState.end()
+        GLState.beginFrame()
+
+        assert GLState.lastFrame.draws    == 1
+        assert GLState.lastFrame.vertices == 4
+        assert GLState.counters.draws     == 0
+
+    def setUp(self):
+        self.e = GameEngine()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+import GameEngine
+from GuitarScene import GuitarScene
+
+class Stub(object):
+    """An object that ignores everything done with it."""
+    def __getattr__(self, name):
+        return Stub()
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+class StubSong(Stub):
+    bpm    = 120.0
+    period = 500.0
+
+    def __init__(self):
+        self.position = 0.0
+
+    def getPosition(self):
+        return self.position
+
+    def isPlaying(self):
+        return True
+
+    def stop(self):
+        self.position = 0.0
+
+class GuitarSceneTest(unittest.TestCase):
+    def setUp(self):
+        # Only the fixed step logic is tested, so skip the resource loading
+        scene = GuitarScene.__new__(GuitarScene)
+        scene.engine       = Stub()
+        scene.stage        = Stub()
+        scene.player       = Stub()
+        scene.guitar       = Stub()
+        scene.song         = StubSong()
+        scene.menu         = None
+        scene.time         = 0.0
+        scene.done         = False
+        scene.delay        = 0.0
+        scene.countdown    = 0.0
+        scene.stepTime     = 2.0
+        scene.maxStepLag   = 250.0
+        scene.stepLag      = 0.0
+        scene.lastFramePos = 0.0
+
+        self.steps    = []
+        scene.runStep = lambda ticks, pos: self.steps.append(pos)
+        self.scene    = scene
+
+    def testRestartSong(self):
+        scene = self.scene
+
+        # Play for a while and leave part of a step pending
+        scene.song.position = 60000.0
+        scene.run(15.0)
+        assert scene.stepLag == 1.0
+
+        scene.restartSong()
+        del self.steps[:]
+        scene.run(16.0)
+
+        # The steps after the restart are all in the countdown
+        assert len(self.steps) == 8
+        assert max(self.steps) <= scene.getSongPosition()
+        assert min(self.steps) >= -8.0 * scene.song.period
+        assert scene.guitar.interpolation == 0.0
+
+if __name__ == "__main__":
+    unittest.main()
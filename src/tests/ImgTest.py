@@ -80,9 +80,20 @@ class ImgTest(unittest.TestCase):
         import time
         time.sleep(2)
 
+    def testBackgroundLoading(self):
+        fileName = self.e.resource.fileName("koopa.png")
+        t        = Texture()
+        t.loadFileInBackground(fileName)
+        assert t.pending
+        assert t.pixelSize == (1, 1)
+
+        while t.pending:
+            self.e.run()
+        assert t.pixelSize == Texture(fileName).pixelSize
+
     def setUp(self):
         self.e = GameEngine()
-        self.e.loadImgDrawing(self, "img", "koopa.png")
+        self.e.loadImgDrawing(self, "img", "koopa.png", synch = True)
 
         while not self.img:
             self.e.run()
@@ -0,0 +1,207 @@
+#####################################################################
+# -*- coding: iso-8859-1 -*-                                        #
+#                                                                   #
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kystil                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+from cStringIO import StringIO
+
+import midi
+from midi.MidiFileParser import MidiFileParser
+from midi.RawInstreamFile import RawInstreamFile
+from midi.constants import NOTE_ON, META_EVENT, TEXT
+
+class EventRecorder(midi.MidiOutStream):
+    def __init__(self):
+        midi.MidiOutStream.__init__(self)
+        self.events = []
+
+    def header(self, format, nTracks, division):
+        self.events.append(("header", format, nTracks, division))
+
+    def note_on(self, channel, note, velocity):
+        self.events.append(("note_on", self.get_current_track(), self.abs_time(), channel, note, velocity))
+
+    def note_off(self, channel, note, velocity):
+        self.events.append(("note_off", self.get_current_track(), self.abs_time(), channel, note, velocity))
+
+    def tempo(self, value):
+        self.events.append(("tempo", self.abs_time(), value))
+
+    def text(self, text):
+        self.events.append(("text", self.abs_time(), text))
+
+class CallbackRecorder(midi.MidiOutStream):
+    """
+    Records every callback of the outstream with the track and the absolute
+    time it was triggered at.
+    """
+    def __init__(self):
+        midi.MidiOutStream.__init__(self)
+        self.callbacks = []
+
+def _recordCallback(name):
+    def record(self, *args):
+        self.callbacks.append((name, self.get_current_track(), self.abs_time()) + args)
+    return record
+
+for name in ["header", "eof", "start_of_track", "end_of_track", "note_on", "note_off", "aftertouch",
+             "continuous_controller", "patch_change", "channel_pressure", "pitch_bend", "sysex_event",
+             "meta_event", "sequence_number", "text", "copyright", "sequence_name", "instrument_name",
+             "lyric", "marker", "cuepoint", "midi_ch_prefix", "midi_port", "tempo", "smtp_offset",
+             "time_signature", "key_signature", "sequencer_specific"]:
+    setattr(CallbackRecorder, name, _recordCallback(name))
+
+def createMidiData():
+    f = StringIO()
+    m = midi.MidiOutFile(f)
+    m.header(1, 2, 480)
+    m.start_of_track(0)
+    m.update_time(0)
+    m.tempo(500000)
+    m.update_time(0)
+    m.end_of_track()
+    m.start_of_track(1)
+    m.update_time(0)
+    m.sequence_name("PART GUITAR")
+    m.update_time(0)
+    m.text("hello")
+    for i in range(4):
+        m.update_time(240)
+        m.note_on(1, 0x60 + i, 100)
+        m.update_time(120)
+        m.note_on(1, 0x60 + i, 0)
+    m.update_time(0)
+    m.end_of_track()
+    m.eof()
+    return f.getvalue()
+
+def createCallbackData():
+    f = StringIO()
+    m = midi.MidiOutFile(f)
+    m.header(1, 2, 480)
+    m.start_of_track(0)
+    m.update_time(0)
+    m.tempo(500000)
+    m.update_time(0)
+    m.time_signature(4, 2, 24, 8)
+    m.update_time(0)
+    m.end_of_track()
+    m.start_of_track(1)
+    m.update_time(0)
+    m.sequence_name("PART GUITAR")
+    m.update_time(10)
+    m.patch_change(2, 30)
+    m.update_time(10)
+    m.continuous_controller(2, 7, 100)
+    m.update_time(10)
+    m.pitch_bend(2, 0x2000)
+    m.update_time(10)
+    m.system_exclusive("\x43\x12")
+    m.update_time(10)
+    m.marker("verse")
+    for i in range(4):
+        m.update_time(240)
+        m.note_on(1, 0x60 + i, 100)
+        m.update_time(120)
+        m.note_off(1, 0x60 + i, 64)
+    # An empty meta event ends the track, the note after it is never read
+    m.update_time(10)
+    m.text("")
+    m.update_time(10)
+    m.note_on(1, 0x64, 100)
+    m.update_time(0)
+    m.end_of_track()
+    m.eof()
+    return f.getvalue()
+
+class MidiTest(unittest.TestCase):
+    def testEventTable(self):
+        table = midi.MidiEventTable()
+        table.setData(createMidiData())
+
+        assert (table.format, table.nTracks, table.division) == (1, 2, 480)
+        assert len(table.tracks) == 2
+        # The file is parsed up to its very end, there is no trailing data
+        assert table.getTrackChunks()[-1][1] == len(table.data)
+
+        events = table.tracks[1]
+        notes  = events[((events["status"] & 0xf0) == NOTE_ON) & (events["data2"] > 0)]
+        assert notes["tick"].tolist()  == [240, 600, 960, 1320]
+        assert notes["data1"].tolist() == [0x60, 0x61, 0x62, 0x63]
+        assert notes["channel"].tolist() == [1] * 4
+
+        text = events[(events["status"] == META_EVENT) & (events["meta"] == TEXT)][0]
+        assert table.getData(text) == "hello"
+
+    def testDispatch(self):
+        data = createMidiData()
+
+        old = EventRecorder()
+        parser = MidiFileParser(RawInstreamFile(StringIO(data)), old)
+        parser.parseMThdChunk()
+        parser.parseMTrkChunks()
+
+        new = EventRecorder()
+        midi.MidiInFile(new, StringIO(data)).read()
+
+        assert old.events
+        assert new.events == old.events
+
+    def testCallbackSequence(self):
+        data = createCallbackData()
+
+        old = CallbackRecorder()
+        parser = MidiFileParser(RawInstreamFile(StringIO(data)), old)
+        parser.parseMThdChunk()
+        parser.parseMTrkChunks()
+
+        new = CallbackRecorder()
+        midi.MidiInFile(new, StringIO(data)).read()
+
+        names = [c[0] for c in new.callbacks]
+        assert "end_of_track" not in names
+        assert names.count("note_on") == 4
+        assert names[-1] == "eof"
+        assert new.callbacks == old.callbacks
+
+    def testChunkDirectory(self):
+        table = midi.MidiEventTable()
+        table.setData(createMidiData())
+
+        directory = table.getChunkDirectory()
+        assert [name for offset, length, name in directory] == [None, "PART GUITAR"]
+        assert sum([length + 8 for offset, length, name in directory]) + 14 == len(table.data)
+
+    def testTrackFilter(self):
+        data = createMidiData()
+
+        table = midi.MidiEventTable()
+        table.setData(data, tracks = ["PART GUITAR"])
+        assert table.skipped == [0]
+        assert len(table.tracks[0]) == 0
+        assert len(table.tracks[1]) > 0
+
+        events = EventRecorder()
+        midi.MidiInFile(events, StringIO(data), tracks = [0]).read()
+        assert [e[0] for e in events.events] == ["header", "tempo"]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+import shutil, os, time
+
+from SongIndex import SongIndex
+
+class SongIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = "songindex_tmp"
+        os.mkdir(self.tmp)
+        os.mkdir(os.path.join(self.tmp, "songs"))
+        for name in ["a", "b", ".hidden"]:
+            self.addSong(name)
+        self.scanned = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def addSong(self, name):
+        path = os.path.join(self.tmp, "songs", name)
+        os.mkdir(path)
+        f = open(os.path.join(path, "song.ini"), "w")
+        f.write("[song]\nname = %s\n" % name)
+        f.close()
+
+    def scan(self, infoFileName):
+        self.scanned.append(infoFileName)
+        return {"name": os.path.basename(os.path.dirname(infoFileName)), "difficulties": [0, 1]}
+
+    def openIndex(self):
+        return SongIndex(os.path.join(self.tmp, "index.db"))
+
+    def testSongNames(self):
+        index = self.openIndex()
+        songRoot = os.path.join(self.tmp, "songs")
+        assert index.getSongNames(songRoot) == ["a", "b"]
+        assert index.getDirectory(songRoot) == ([".hidden", "a", "b"], False, False)
+        index.close()
+
+        # New songs show up once the directory has changed
+        time.sleep(.01)
+        self.addSong("c")
+        os.utime(songRoot, None)
+        index = self.openIndex()
+        assert index.getSongNames(songRoot) == ["a", "b", "c"]
+        index.close()
+
+    def testSongRecords(self):
+        infoFile = os.path.join(self.tmp, "songs", "a", "song.ini")
+
+        index = self.openIndex()
+        record = index.getSongRecord(infoFile, self.scan)
+        index.close()
+
+        index = self.openIndex()
+        assert index.getSongRecord(infoFile, self.scan) == record
+        assert record["name"] == "a"
+        assert record["difficulties"] == [0, 1]
+        assert self.scanned == [infoFile]
+
+        # Modified song.ini files are scanned again
+        os.utime(infoFile, (0, 0))
+        index.getSongRecord(infoFile, self.scan)
+        assert self.scanned == [infoFile, infoFile]
+        index.close()
+
+    def testUpdateSongRecords(self):
+        infoFiles = [os.path.join(self.tmp, "songs", name, "song.ini") for name in ["a", "b"]]
+        progress  = []
+
+        index = self.openIndex()
+        index.updateSongRecords(infoFiles, self.scan, lambda count, total: progress.append((count, total)), threads = 1)
+        assert progress == [(1, 2), (2, 2)]
+        assert sorted(self.scanned) == infoFiles
+
+        # Up to date records are neither scanned again nor reported
+        index.updateSongRecords(infoFiles, self.scan, lambda count, total: progress.append((count, total)), threads = 1)
+        assert len(progress) == 2
+        assert index.getSongRecord(infoFiles[1], self.scan)["name"] == "b"
+        assert len(self.scanned) == 2
+        index.close()
+
+    def testUpdateSongRecordsInParallel(self):
+        names = ["song%02d" % i for i in range(20)]
+        for name in names:
+            self.addSong(name)
+        infoFiles = [os.path.join(self.tmp, "songs", name, "song.ini") for name in ["a", "b"] + names]
+        progress  = []
+
+        index = self.openIndex()
+        index.parallelThreshold = 4
+        index.updateSongRecords(infoFiles, self.scan, lambda count, total: progress.append((count, total)), threads = 2)
+        assert progress == [(i + 1, len(infoFiles)) for i in range(len(infoFiles))]
+        assert sorted(self.scanned) == sorted(infoFiles)
+        index.close()
+
+        # The records were stored in the index
+        index = self.openIndex()
+        for infoFile in infoFiles:
+            assert index.getSongRecord(infoFile, self.scan)["name"] == os.path.basename(os.path.dirname(infoFile))
+        assert len(self.scanned) == len(infoFiles)
+        index.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,9 +22,12 @@
 
 import unittest, pygame
 import shutil, os, sys
+from ConfigParser import ConfigParser
 
 from GameEngine import GameEngine
-from Song import Song, Note
+from Song import Song, SongInfo, SongClock, Note, Tempo, TempoMap, Track, NoteScheduler, ChartCache, MidiInfoReader, scanDifficulties, difficulties, EASY_DIFFICULTY
+import midi
+import Clock
 
 class SongTest(unittest.TestCase):
     def testLoading(self):
@@ -37,6 +40,199 @@ class SongTest(unittest.TestCase):
 
         assert int(song.bpm) == 122
 
+    def testScanDifficulties(self):
+        e = GameEngine()
+        noteFile = e.resource.fileName("songs", "defy", "notes.mid")
+
+        info = MidiInfoReader()
+        try:
+            midi.MidiInFile(info, noteFile).read()
+        except MidiInfoReader.Done:
+            pass
+        info.difficulties.sort(lambda a, b: cmp(b.id, a.id))
+
+        assert scanDifficulties(noteFile) == info.difficulties
+
+    def testTrackQueries(self):
+        track = Track()
+        longNote = Note(0, 5000)
+        short    = Note(1, 100)
+        track.addEvent(0.0, Tempo(120))
+        track.addEvent(1000.0, longNote)
+        track.addEvent(3000.0, short)
+
+        # Long notes overlap ranges that start after their start time
+        assert [e for t, e in track.getEvents(4000, 4500)] == [longNote]
+        assert [e for t, e in track.getEvents(2900, 3050)] == [longNote, short]
+        assert track.getNotes(2900, 3050) == [(3000.0, short)]
+        assert track.getNotes(3200, 4000) == []
+
+        track.removeEvent(1000.0, longNote)
+        assert [e for t, e in track.getEvents(0, 10000)] == [track.allEvents[0][1], short]
+
+    def testNoteScheduler(self):
+        track = Track()
+        notes = [(100.0, Note(0, 10.0)), (100.0, Note(2, 10.0)), (200.0, Note(1, 10.0)), (300.0, Note(3, 10.0))]
+        for time, note in notes:
+            track.addEvent(time, note)
+        scheduler = NoteScheduler(track)
+
+        assert scheduler.getRequiredNotes(0.0, 50.0, 50.0) == []
+        assert scheduler.getRequiredNotes(90.0, 50.0, 50.0) == notes[:2]
+
+        # The chord masks cover both notes and the frets above the chord
+        for time, note in notes[:2]:
+            assert note.chordMask == 0x05
+            assert note.matchMask == 0x1d
+            assert not note.chordTappable
+        assert notes[3][1].chordMask == 0x08
+        assert notes[3][1].matchMask == 0x18
+        assert scheduler.getMissedNotes(90.0, 50.0) == []
+
+        # Played notes are skipped
+        notes[0][1].played = True
+        notes[1][1].played = True
+        assert scheduler.getRequiredNotes(140.0, 50.0, 50.0) == []
+        assert scheduler.getRequiredNotes(160.0, 50.0, 50.0) == notes[2:3]
+
+        # The unplayed note has left the hit window
+        assert scheduler.getMissedNotes(260.0, 50.0) == notes[2:3]
+        assert scheduler.getRequiredNotes(260.0, 50.0, 50.0) == notes[3:4]
+
+        # Rewinding finds the earlier notes again
+        track.reset()
+        assert scheduler.getRequiredNotes(100.0, 50.0, 50.0) == notes[:2]
+
+        # Modifying the track reloads the notes
+        note = Note(4, 10.0)
+        track.addEvent(120.0, note)
+        notes[0][1].played = True
+        notes[1][1].played = True
+        assert scheduler.getRequiredNotes(100.0, 50.0, 50.0) == [(120.0, note)]
+
+    def testSongClock(self):
+        now           = [1000.0]
+        getTime       = Clock.getTime
+        Clock.getTime = lambda: now[0]
+        try:
+            clock = SongClock()
+            clock.reset(500.0)
+            assert clock.getPosition() == 500.0
+
+            # The position is extrapolated between the samples
+            clock.start()
+            now[0] += 100.0
+            assert clock.getPosition() == 600.0
+
+            # Small errors are corrected gradually
+            clock.sample(610.0)
+            assert 600.0 < clock.getPosition() < 610.0
+            assert clock.samples == 1 and clock.maxJitter == 10.0
+
+            # The position does not go backwards
+            position = clock.getPosition()
+            clock.sample(580.0)
+            assert clock.getPosition() == position
+
+            # Large errors are corrected at once
+            clock.sample(2000.0)
+            assert clock.getPosition() == 2000.0
+
+            # A stopped clock stays put
+            clock.stop()
+            now[0] += 100.0
+            assert clock.getPosition() == 2000.0
+        finally:
+            Clock.getTime = getTime
+
+    def testTempoMap(self):
+        tempoMap = TempoMap(ticksPerBeat = 480)
+        tempoMap.addTempo(0,    120)
+        tempoMap.addTempo(960,  60)
+        tempoMap.addTempo(1920, 240)
+
+        assert abs(tempoMap.ticksToTime(960)  - 1000) < 1e-6
+        assert abs(tempoMap.ticksToTime(1920) - 3000) < 1e-6
+        assert abs(tempoMap.timeToTicks(3125) - 2160) < 1e-6
+        assert abs(tempoMap.timeToBeats(2000) - 3.0)  < 1e-6
+        assert abs(tempoMap.beatsToTime(3.0)  - 2000) < 1e-6
+        assert max(abs(tempoMap.beatsToTimes([0.0, 3.0, 4.5]) - (0, 2000, 3125))) < 1e-6
+        assert tempoMap.getBpm(2999) == 60
+        assert tempoMap.getBpm(3000) == 240
+
+    def testHighscores(self):
+        tmp = "songtest_tmp"
+        try:
+            os.mkdir(tmp)
+            infoFile = os.path.join(tmp, "song.ini")
+            easy     = difficulties[EASY_DIFFICULTY]
+
+            info = SongInfo(infoFile)
+            info.name = "Test"
+            for score in [100, 600, 300, 200, 500, 400]:
+                info.addHighscore(easy, score, 3, "Player")
+            info.save()
+
+            # Scores are only decoded when they are asked for
+            info = SongInfo(infoFile)
+            assert info.name == "Test"
+            assert info._highScores is None
+            assert [score for score, stars, name in info.getHighscores(easy)] == [600, 500, 400, 300, 200]
+
+            # Saving without reading the scores keeps them
+            info = SongInfo(infoFile)
+            info.name = "Renamed"
+            info.save()
+            assert len(SongInfo(infoFile).getHighscores(easy)) == 5
+        finally:
+            shutil.rmtree(tmp)
+
+    def testInfoCopies(self):
+        tmp = "songtest_tmp"
+        try:
+            os.mkdir(tmp)
+            infoFile = os.path.join(tmp, "song.ini")
+            info = SongInfo(infoFile)
+            info.name = "Test"
+            info.save()
+
+            # Unsaved changes are not seen by other instances
+            info1 = SongInfo(infoFile)
+            info2 = SongInfo(infoFile)
+            info1.name = "Renamed"
+            assert info2.name == "Test"
+            assert SongInfo(infoFile).name == "Test"
+
+            # Saved changes are
+            info1.save()
+            info1.name = "Unsaved"
+            assert SongInfo(infoFile).name == "Renamed"
+        finally:
+            shutil.rmtree(tmp)
+
+    def testInfoCache(self):
+        tmp   = "songtest_tmp"
+        reads = []
+        parse = ConfigParser._read
+        try:
+            os.mkdir(tmp)
+            infoFile = os.path.join(tmp, "song.ini")
+            info = SongInfo(infoFile)
+            info.name = "Test"
+            info.save()
+
+            ConfigParser._read = lambda self, f, fileName: reads.append(fileName)
+            info1 = SongInfo(infoFile)
+            info2 = SongInfo(infoFile)
+            assert info1.name == info2.name == "Test"
+            assert info1.getInfo() is not info2.getInfo()
+
+            # The cached contents are used without reading the file again
+            assert reads == []
+        finally:
+            ConfigParser._read = parse
+            shutil.rmtree(tmp)
+
     def testSaving(self):
         e = GameEngine()
 
@@ -80,6 +276,100 @@ class SongTest(unittest.TestCase):
             pygame.mixer.music.load(e.resource.fileName("songs", "defy", "guitar.ogg"))
             shutil.rmtree(tmp)
 
+    def testWriting(self):
+        e = GameEngine()
+
+        tmp = "songtest_tmp"
+        try:
+            os.mkdir(tmp)
+            shutil.copy(e.resource.fileName("songs", "defy", "song.ini"), tmp)
+            shutil.copy(e.resource.fileName("songs", "defy", "notes.mid"), tmp)
+
+            infoFile = os.path.join(tmp, "song.ini")
+            noteFile = os.path.join(tmp, "notes.mid")
+            song     = Song(e, infoFile, None, None, None, noteFile)
+            song.save()
+            copy     = Song(e, infoFile, None, None, None, noteFile)
+
+            assert not os.path.exists(noteFile + ".tmp")
+
+            for track1, track2 in zip(song.tracks, copy.tracks):
+                notes1 = sorted([(time, event.number, event.length) for time, event in track1.getNotes(0, 1e9)])
+                notes2 = sorted([(time, event.number, event.length) for time, event in track2.getNotes(0, 1e9)])
+                assert len(notes1) == len(notes2)
+
+                for (t1, n1, l1), (t2, n2, l2) in zip(notes1, notes2):
+                    # Allow 2ms of rounding error
+                    assert abs(t1 - t2) < 2
+                    assert abs(l1 - l2) < 2
+                    assert n1 == n2
+        finally:
+            shutil.rmtree(tmp)
+
+    def testWritingWithoutBpm(self):
+        e = GameEngine()
+
+        tmp = "songtest_tmp"
+        try:
+            os.mkdir(tmp)
+            shutil.copy(e.resource.fileName("songs", "defy", "song.ini"), tmp)
+
+            infoFile = os.path.join(tmp, "song.ini")
+            noteFile = os.path.join(tmp, "notes.mid")
+            song     = Song(e, infoFile, None, None, None, None)
+
+            assert song.bpm is None
+
+            for i in range(16):
+                song.tracks[0].addEvent(250.0 * i, Note(i % 5, 100.0 * (i % 3)))
+
+            song.noteFileName = noteFile
+            song.save()
+            copy = Song(e, infoFile, None, None, None, noteFile)
+
+            notes1 = sorted([(time, event.number, event.length) for time, event in song.tracks[0].getNotes(0, 1e9)])
+            notes2 = sorted([(time, event.number, event.length) for time, event in copy.tracks[0].getNotes(0, 1e9)])
+            assert len(notes1) == len(notes2) == 16
+
+            for (t1, n1, l1), (t2, n2, l2) in zip(notes1, notes2):
+                # Allow 2ms of rounding error
+                assert abs(t1 - t2) < 2
+                assert abs(l1 - l2) < 2
+                assert n1 == n2
+        finally:
+            shutil.rmtree(tmp)
+
+    def testChartCache(self):
+        e = GameEngine()
+
+        tmp = "songtest_tmp"
+        try:
+            os.mkdir(tmp)
+            shutil.copy(e.resource.fileName("songs", "defy", "song.ini"), tmp)
+            shutil.copy(e.resource.fileName("songs", "defy", "notes.mid"), tmp)
+
+            infoFile = os.path.join(tmp, "song.ini")
+            noteFile = os.path.join(tmp, "notes.mid")
+            song     = Song(e, infoFile, None, None, None, noteFile)
+            cache    = ChartCache(os.path.join(tmp, "cache"))
+            cache.store(song, noteFile, background = False)
+
+            copy = Song(e, infoFile, None, None, None, None)
+            assert cache.load(copy, noteFile)
+            assert copy.bpm == song.bpm
+            assert copy.tempoMap.getTempos() == song.tempoMap.getTempos()
+
+            for track1, track2 in zip(song.tracks, copy.tracks):
+                events1 = [(time, event.number, event.length, event.tappable) for time, event in track1.getNotes(0, 1e9)]
+                events2 = [(time, event.number, event.length, event.tappable) for time, event in track2.getNotes(0, 1e9)]
+                assert events1 == events2
+
+            # A modified note file invalidates the entry
+            os.utime(noteFile, (0, 0))
+            assert not cache.load(Song(e, infoFile, None, None, None, None), noteFile)
+        finally:
+            shutil.rmtree(tmp)
+
 
 if __name__ == "__main__":
     unittest.main()
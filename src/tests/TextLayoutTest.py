@@ -0,0 +1,65 @@
+#####################################################################
+# -*- coding: iso-8859-1 -*-                                        #
+#                                                                   #
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kystil                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+from GameEngine import GameEngine
+from Font import Font
+import TextLayout
+
+class TextLayoutTest(unittest.TestCase):
+    def testStringSize(self):
+        text = "Frets on Fire"
+        w, h = self.font.getStringSize(text)
+
+        widths  = [self.font.getStringSize(ch)[0] for ch in text]
+        heights = [self.font.getStringSize(ch)[1] for ch in text]
+        assert abs(w - sum(widths)) < 1e-9
+        assert h == max(heights)
+        assert self.font.getStringSize(u"Frets on Fire") == (w, h)
+        assert self.font.getStringSize("") == (0.0, 0.0)
+
+    def testWrap(self):
+        text   = "the quick brown fox jumps over the lazy dog"
+        layout = TextLayout.wrapText(self.font, .1, text, rightMargin = .4)
+
+        assert [word for n, word, x, y in layout.words] == text.split(" ")
+        assert len(set([y for n, word, x, y in layout.words])) > 1
+        for n, word, x, y in layout.words:
+            assert x >= .1 and x + self.font.getStringSize(word)[0] <= .4
+
+        # The layout is reused as long as the parameters stay the same
+        assert TextLayout.wrapText(self.font, .1, text, rightMargin = .4) is layout
+        assert TextLayout.wrapText(self.font, .1, text, rightMargin = .5) is not layout
+
+    def testHide(self):
+        text   = "the quick brown fox jumps over the lazy dog"
+        layout = TextLayout.wrapText(self.font, .1, text, rightMargin = .4, hide = 1, hidestring = "...")
+
+        assert layout.words[-1][1] == "..."
+        assert len(set([y for n, word, x, y in layout.words])) == 1
+
+    def setUp(self):
+        self.e    = GameEngine()
+        self.font = Font(self.e.resource.fileName("default.ttf"), 22)
+
+if __name__ == "__main__":
+    unittest.main()
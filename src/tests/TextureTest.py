@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+#####################################################################
+# Frets on Fire                                                     #
+# Copyright (C) 2006 Sami Kyöstilä                                  #
+#                                                                   #
+# This program is free software; you can redistribute it and/or     #
+# modify it under the terms of the GNU General Public License       #
+# as published by the Free Software Foundation; either version 2    #
+# of the License, or (at your option) any later version.            #
+#                                                                   #
+# This program is distributed in the hope that it will be useful,   #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of    #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the     #
+# GNU General Public License for more details.                      #
+#                                                                   #
+# You should have received a copy of the GNU General Public License #
+# along with this program; if not, write to the Free Software       #
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,        #
+# MA  02110-1301, USA.                                              #
+#####################################################################
+
+import unittest
+import pygame
+
+from GameEngine import GameEngine
+from Texture import TextureAtlas, TextureAtlasFullException
+
+class TextureTest(unittest.TestCase):
+    def setUp(self):
+        self.e = GameEngine()
+
+    def testAtlasPacking(self):
+        atlas = TextureAtlas(size = 64, mirror = True)
+        small = pygame.Surface((20, 10), pygame.SRCALPHA, 32)
+        large = pygame.Surface((20, 16), pygame.SRCALPHA, 32)
+        large.fill((255, 0, 0, 255))
+
+        # Surfaces are placed side by side on a row
+        assert atlas.add(small) == (0.0, 0.0, 20 / 64.0, 10 / 64.0)
+        assert atlas.add(large) == (20 / 64.0, 0.0, 40 / 64.0, 16 / 64.0)
+        assert atlas.add(small) == (40 / 64.0, 0.0, 60 / 64.0, 10 / 64.0)
+        assert atlas.cursor == (60, 0) and atlas.rowHeight == 16
+
+        # The next row starts below the tallest surface of the previous one
+        assert atlas.add(small) == (0.0, 16 / 64.0, 20 / 64.0, 26 / 64.0)
+        assert atlas.cursor == (20, 16) and atlas.rowHeight == 10
+
+        # The used rows are mirrored
+        assert atlas.pixels.shape == (26, 64, 4)
+        assert (atlas.pixels[:16, 20:40, 0] == 255).all()
+        assert (atlas.pixels[:16, :20] == 0).all()
+
+        # Surfaces that no longer fit raise an exception
+        self.assertRaises(TextureAtlasFullException, lambda: [atlas.add(large) for i in range(16)])
+        self.assertRaises(ValueError, atlas.add, pygame.Surface((65, 1), pygame.SRCALPHA, 32))
+
+if __name__ == "__main__":
+    unittest.main()